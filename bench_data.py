@@ -0,0 +1,300 @@
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+import datasets
+from datasets import MatchDataset_v2 , PreDataset_v2 , TokenCache
+from helper import nbytes , process_memory_mb , child_pids
+
+# comment 每个品类会出现的属性，用来拼合成title
+CATEGORY_ATTRS = {
+    '上衣': ('领型', '袖长', '衣长', '版型', '穿着方式'),
+    '连衣裙': ('领型', '袖长', '裙长', '版型'),
+    '裤子': ('裤型', '裤长', '裤门襟'),
+    '包': ('类别',),
+    '鞋': ('闭合方式', '鞋帮高度'),
+}
+# comment 强制走某一个分支时的概率设置, random.random() < 1 一定成立, < -1 一定不成立
+# comment has_attrs: 这个分支需要有key_attrs的样本(False表示只用没有key_attrs的样本)
+MATCH_BRANCHES = {
+    'no_attr_keep':     (False, dict(p8=-1)),
+    'no_attr_swap':     (False, dict(p8=1)),
+    'keep':             (True, dict(p1=1)),
+    'swap_text':        (True, dict(p1=-1, p2=1)),
+    'attr_replace':     (True, dict(p1=-1, p2=-1, p3=1)),
+    'color_swap':       (True, dict(p1=-1, p2=-1, p3=-1, p5=1)),
+    'title_shuffle':    (True, dict(p1=1, p6=1)),
+    'feature_shuffle':  (True, dict(p1=1, p7=1)),
+}
+MATCH_BASE = dict(p6=-1, p7=-1, p8=-1)
+PRE_BRANCHES = {
+    'no_attr_keep':     (False, dict(p1=-1)),
+    'no_attr_swap':     (False, dict(p1=1)),
+    'keep':             (True, dict(p2=1)),
+    'swap_text':        (True, dict(p2=-1, p3=1)),
+    'attr_replace':     (True, dict(p2=-1, p3=-1, p4=1)),
+    'color_swap':       (True, dict(p2=-1, p3=-1, p4=-1)),
+    'title_shuffle':    (True, dict(p2=1, p5=1)),
+}
+PRE_BASE = dict(p5=-1)
+
+
+def synthetic_corpus(num, key_attr_values, label_list, color_set, no_attr_rate=0.3, seed=25):
+    # comment 和fine_data_sample.json同样格式的合成数据: 年份+季节+颜色+属性值+品类
+    rng = random.Random(seed)
+    colors = sorted(color_set)
+    texts , img_features , labels , label_masks , key_attrs = [] , [] , [] , [] , []
+    for _ in range(num):
+        category = rng.choice(list(CATEGORY_ATTRS))
+        sample_attrs = {}
+        if rng.random() >= no_attr_rate:
+            for attr in rng.sample(CATEGORY_ATTRS[category], rng.randint(1, len(CATEGORY_ATTRS[category]))):
+                sample_attrs[attr] = rng.choice(rng.choice(key_attr_values[attr]).split('='))
+        words = ['%d年' % (rng.choice([2020, 2021, 2022])), rng.choice(['春季', '夏季', '秋冬']), rng.choice(colors)]
+        words += list(sample_attrs.values()) + ['女装', category]
+        texts.append(''.join(words))
+        img_features.append(np.random.RandomState(rng.randint(0, 2 ** 31)).rand(2048).astype(np.float32).tolist())
+        labels.append([1] * len(label_list))
+        label_masks.append([1] + [int(label in sample_attrs) for label in label_list[1:]])
+        key_attrs.append(sample_attrs)
+    return {'texts': texts, 'img_features': img_features, 'labels': labels, 'label_masks': label_masks, 'key_attrs': key_attrs}
+
+def subset(corpus, has_attrs):
+    idxs = [i for i, attrs in enumerate(corpus['key_attrs']) if (len(attrs) > 0) == has_attrs]
+    return {key: [values[i] for i in idxs] for key, values in corpus.items()}
+
+def build_dataset(name, corpus, tokenizer, key_attr_values, label2id, color_set, token_cache=None, **kwargs):
+    if name == 'match':
+        return MatchDataset_v2(
+            tokenizer = tokenizer ,
+            texts = corpus['texts'] ,
+            labels = corpus['labels'] ,
+            visual_embeds = corpus['img_features'] ,
+            label_masks = corpus['label_masks'] ,
+            key_attrs = corpus['key_attrs'] ,
+            key_attr_values = key_attr_values ,
+            label2id = label2id ,
+            color_set = color_set ,
+            token_cache = token_cache ,
+            **kwargs
+        )
+    return PreDataset_v2(
+        tokenizer = tokenizer ,
+        texts = corpus['texts'] ,
+        visual_embeds = corpus['img_features'] ,
+        labels = corpus['labels'] ,
+        key_attrs = corpus['key_attrs'] ,
+        key_attr_values = key_attr_values ,
+        color_set = color_set ,
+        **kwargs
+    )
+
+def time_getitem(dataset, num_items, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    dataset[0]
+    since = time.perf_counter()
+    for i in range(num_items):
+        dataset[i % len(dataset)]
+    return (time.perf_counter() - since) / num_items * 1e6
+
+def worker_memory_mb():
+    # comment 当前所有子进程(DataLoader worker)的rss之和与pss之和; 写时复制的页被worker碰过之后rss和pss都会涨
+    workers = [process_memory_mb(pid) for pid in child_pids()]
+    rss , pss = [worker['rss_mb'] for worker in workers] , [worker['pss_mb'] for worker in workers]
+    return {
+        'workers': len(workers),
+        'workers_rss_mb': round(sum(rss), 1) if None not in rss else None,
+        'workers_pss_mb': round(sum(pss), 1) if None not in pss else None,
+    }
+
+def time_dataloader(dataset, batch_size, num_workers, num_batches, collate_fn=None):
+    # comment 第一个batch包含worker启动的时间，单独记录，吞吐只算后面的batch
+    # comment 跑完num_batches之后worker还活着，顺便记录主进程和worker的内存
+    since = time.perf_counter()
+    loader = DataLoader(dataset, shuffle=True, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn, drop_last=True)
+    iterator = iter(loader)
+    next(iterator)
+    first_batch_s = time.perf_counter() - since
+    since , num = time.perf_counter() , 0
+    for _ in range(num_batches):
+        try:
+            next(iterator)
+        except StopIteration:
+            iterator = iter(loader)
+            next(iterator)
+        num += batch_size
+    samples_per_s = num / (time.perf_counter() - since)
+    memory = dict(main_rss_mb=process_memory_mb()['rss_mb'], **worker_memory_mb())
+    del iterator
+    return first_batch_s , samples_per_s , memory
+
+STARTUP_MODULES = ('datasets', 'helper', 'model_avg', 'predictor', 'lxmert', 'vilt', 'vilbert')
+STARTUP_SCRIPTS = ('finetune_lxmert.py', 'finetune_lxmert_kfold.py', 'pretrain_lxmert.py', 'distill.py', 'run_predict.py', 'serve.py')
+
+def import_time_ms(module, repeat):
+    # comment 每次新开解释器，用 -X importtime 取这个模块的累计耗时(包括它import的torch/transformers等)，取中位数
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % (module)], capture_output=True, text=True, check=True)
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                times.append(int(fields[1]) / 1000)
+    return round(float(np.median(times)), 1)
+
+def help_time_ms(script, repeat):
+    # comment 命令行 --help 的总耗时，包括解释器启动
+    times = []
+    for _ in range(repeat):
+        since = time.perf_counter()
+        subprocess.run([sys.executable, script, '--help'], stdout=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - since) * 1000)
+    return round(float(np.median(times)), 1)
+
+def time_jieba():
+    # comment 没有缓存(建前缀词典+加载用户词典，再写缓存) 和 读缓存 各计时一次; 缓存写在临时目录，不影响正式的缓存
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = os.path.join(tmp_dir, os.path.basename(datasets.JIEBA_CACHE))
+        for name in ('jieba_build_ms', 'jieba_cached_ms'):
+            datasets.jieba_tokenizer = None
+            since = time.perf_counter()
+            datasets.load_jieba(cache_path=cache_path)
+            result[name] = round((time.perf_counter() - since) * 1000, 1)
+    datasets.jieba_tokenizer = None
+    return result
+
+def measure_startup(repeat):
+    startup = {
+        'imports_ms': {module: import_time_ms(module, repeat) for module in STARTUP_MODULES},
+        'help_ms': {script: help_time_ms(script, repeat) for script in STARTUP_SCRIPTS},
+    }
+    startup.update(time_jieba())
+    for group in ('imports_ms', 'help_ms'):
+        print(' , '.join('%s %.1f ms' % (name, value) for name, value in startup[group].items()))
+    print('jieba 建词典 %.1f ms , 读缓存 %.1f ms' % (startup['jieba_build_ms'], startup['jieba_cached_ms']))
+    return startup
+
+def main(opt):
+    from transformers import BertTokenizer , DataCollatorForLanguageModeling
+    tokenizer = BertTokenizer(vocab_file=opt.vocab_path) if opt.tokenizer_path is None else BertTokenizer.from_pretrained(opt.tokenizer_path)
+    with open(os.path.join('./data', 'attr_to_attrvals.json'), 'r') as f:
+        key_attr_values = json.loads(f.read())
+    with open(os.path.join('./data', 'sort_label_list.txt'), 'r') as f:
+        label_list = f.read().strip().split()
+    label2id = {label: i for i, label in enumerate(label_list)}
+    with open('./color.txt', 'r') as f:
+        color_set = set(line[:-1] for line in f.readlines())
+    since = time.time()
+    corpus = synthetic_corpus(opt.num_samples, key_attr_values, label_list, color_set, no_attr_rate=opt.no_attr_rate, seed=opt.seed)
+    print('合成 %d 条数据, 用时 %.2f s' % (opt.num_samples, time.time() - since))
+    token_cache = TokenCache(tokenizer, corpus['texts'], 37) if opt.token_cache else None
+    # comment 和训练脚本一样把list转成np.array, 分别记录list和array两种形式的大小
+    memory = {'corpus_rss_mb': process_memory_mb()['rss_mb'], 'structures_mb': {}}
+    for key , values in corpus.items():
+        memory['structures_mb']['%s(list)' % (key)] = round(nbytes(values) / 1024 / 1024, 1)
+        memory['structures_mb']['%s(np.array)' % (key)] = round(nbytes(np.array(values)) / 1024 / 1024, 1)
+    print('合成数据 rss %s MB, %s' % (memory['corpus_rss_mb'], json.dumps(memory['structures_mb'], ensure_ascii=False)))
+
+    report = {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__, 'cpu_count': os.cpu_count(), 'opt': vars(opt)}, 'memory': memory, 'branches': [], 'dataloader': []}
+    if opt.startup_repeat > 0:
+        report['startup'] = measure_startup(opt.startup_repeat)
+    for name in opt.datasets:
+        branches , base = (MATCH_BRANCHES, MATCH_BASE) if name == 'match' else (PRE_BRANCHES, PRE_BASE)
+        for branch , (has_attrs , probs) in branches.items():
+            dataset = build_dataset(name, subset(corpus, has_attrs), tokenizer, key_attr_values, label2id, color_set, token_cache=token_cache, **dict(base, **probs))
+            us = time_getitem(dataset, opt.num_items, opt.seed)
+            report['branches'].append({'dataset': name, 'branch': branch, 'us_per_item': round(us, 1)})
+            print('%-6s %-16s %9.1f us/条' % (name, branch, us))
+        # comment 端到端: 默认的增强概率，和训练时一样走DataLoader
+        dataset = build_dataset(name, corpus, tokenizer, key_attr_values, label2id, color_set, token_cache=token_cache)
+        collate_fn = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm_probability=0.15) if name == 'pre' else None
+        for num_workers in opt.num_workers:
+            first_batch_s , samples_per_s , loader_memory = time_dataloader(dataset, opt.batch_size, num_workers, opt.num_batches, collate_fn=collate_fn)
+            report['dataloader'].append(dict({'dataset': name, 'num_workers': num_workers, 'batch_size': opt.batch_size, 'first_batch_s': round(first_batch_s, 3), 'samples_per_s': round(samples_per_s, 1)}, **loader_memory))
+            print('%-6s num_workers %2d : 首个batch %.2f s , %9.1f 条/s , 主进程rss %s MB , worker rss %s MB pss %s MB' % (
+                name, num_workers, first_batch_s, samples_per_s, loader_memory['main_rss_mb'], loader_memory['workers_rss_mb'], loader_memory['workers_pss_mb']))
+
+    save_dir = os.path.dirname(opt.save_path)
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+    with open(opt.save_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(report, indent=2, ensure_ascii=False))
+    print('结果写入 %s' % (opt.save_path))
+    if opt.baseline is not None and compare(report, opt.baseline, opt.tolerance) and opt.fail_on_regression:
+        raise SystemExit(1)
+
+def compare(report, baseline_path, tolerance):
+    # comment 分支耗时、DataLoader吞吐变差，合成数据/主进程/worker的内存或import/--help耗时上涨超过tolerance，算回退
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.loads(f.read())
+    regressions = []
+
+    def check(name, old, new, higher_is_better=False):
+        if old is None or new is None or old == 0:
+            return
+        print('%-44s %10.1f -> %10.1f (%+.1f%%)' % (name, old, new, (new / old - 1) * 100))
+        if (new < old * (1 - tolerance)) if higher_is_better else (new > old * (1 + tolerance)):
+            regressions.append(name)
+
+    check('corpus_rss_mb', baseline.get('memory', {}).get('corpus_rss_mb'), report['memory']['corpus_rss_mb'])
+    old_startup , new_startup = baseline.get('startup', {}) , report.get('startup', {})
+    for group in ('imports_ms', 'help_ms'):
+        for name , value in new_startup.get(group, {}).items():
+            check('%s %s' % (name, group), old_startup.get(group, {}).get(name), value)
+    for name in ('jieba_build_ms', 'jieba_cached_ms'):
+        check(name, old_startup.get(name), new_startup.get(name))
+    old_branches = {(item['dataset'], item['branch']): item for item in baseline['branches']}
+    for item in report['branches']:
+        old = old_branches.get((item['dataset'], item['branch']))
+        if old is not None:
+            check('%s/%s us_per_item' % (item['dataset'], item['branch']), old['us_per_item'], item['us_per_item'])
+    old_loaders = {(item['dataset'], item['num_workers']): item for item in baseline['dataloader']}
+    for item in report['dataloader']:
+        old = old_loaders.get((item['dataset'], item['num_workers']))
+        if old is None:
+            continue
+        key = '%s/w%d' % (item['dataset'], item['num_workers'])
+        check('%s samples_per_s' % (key), old['samples_per_s'], item['samples_per_s'], higher_is_better=True)
+        for metric in ('main_rss_mb', 'workers_pss_mb'):
+            check('%s %s' % (key, metric), old.get(metric), item.get(metric))
+    for regression in regressions:
+        print('回退: %s' % (regression))
+    return regressions
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets',type=str,nargs='+',default=['match', 'pre'],choices=['match', 'pre'],help='match: MatchDataset_v2; pre: PreDataset_v2')
+    parser.add_argument('--vocab_path',type=str,default='./vocab.txt')
+    parser.add_argument('--tokenizer_path',type=str,default=None,help='设置后代替 --vocab_path')
+    parser.add_argument('--num_samples',type=int,default=5000,help='合成数据条数')
+    parser.add_argument('--no_attr_rate',type=float,default=0.3,help='没有key_attrs的样本比例')
+    parser.add_argument('--num_items',type=int,default=2000,help='每个分支计时的__getitem__次数')
+    parser.add_argument('--token_cache',action='store_true',help='MatchDataset_v2 使用TokenCache')
+    parser.add_argument('--num_workers',type=int,nargs='+',default=[0, 2, 4, 8])
+    parser.add_argument('--batch_size',type=int,default=256)
+    parser.add_argument('--num_batches',type=int,default=20)
+    parser.add_argument('--seed',type=int,default=25)
+    parser.add_argument('--startup_repeat',type=int,default=3,help='import耗时/--help耗时 每项测几次取中位数, 0 表示不测')
+    parser.add_argument('--save_path',type=str,default='./output/bench_data.json')
+    parser.add_argument('--baseline',type=str,default=None,help='之前的结果json, 设置后打印对比')
+    parser.add_argument('--tolerance',type=float,default=0.1,help='和baseline比 耗时/内存上涨 超过这个比例算回退')
+    parser.add_argument('--fail_on_regression',action='store_true',help='有回退时退出码为1, 给CI用')
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    main(opt)
@@ -0,0 +1,265 @@
+
+import os
+import json
+import time
+import platform
+import resource
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import torch.nn.functional as F
+
+from predictor import model_forward
+from helper import nbytes
+
+MODEL_VARIANTS = ('lxmert', 'lxmert_pretrain', 'vilt', 'vilt_pretrain', 'vilbert', 'vilbert_pretrain')
+FEAT_DIM = 2048
+
+
+def build_config(model_type, opt):
+    # comment 合成config, 层数和biattention_id从命令行给，用来对比改结构前后的吞吐
+    from transformers import LxmertConfig , ViltConfig
+    from vilbert import MyBertConfig
+    if model_type == 'lxmert':
+        return LxmertConfig(
+            vocab_size = opt.vocab_size,
+            hidden_size = opt.hidden_size,
+            num_attention_heads = opt.num_attention_heads,
+            intermediate_size = opt.intermediate_size,
+            l_layers = opt.l_layers,
+            x_layers = opt.x_layers,
+            r_layers = opt.r_layers,
+        )
+    if model_type == 'vilt':
+        return ViltConfig(
+            vocab_size = opt.vocab_size,
+            hidden_size = opt.hidden_size,
+            num_attention_heads = opt.num_attention_heads,
+            intermediate_size = opt.intermediate_size,
+            num_hidden_layers = opt.vilt_layers,
+        )
+    return MyBertConfig(
+        vocab_size_or_config_json_file = opt.vocab_size,
+        hidden_size = opt.hidden_size,
+        num_attention_heads = opt.num_attention_heads,
+        intermediate_size = opt.intermediate_size,
+        num_hidden_layers = opt.vilbert_layers,
+        v_num_hidden_layers = opt.vilbert_v_layers,
+        bi_hidden_size = opt.hidden_size,
+        t_biattention_id = opt.t_biattention_id,
+        v_biattention_id = opt.v_biattention_id,
+    )
+
+def build_model(variant, opt):
+    from lxmert import MyLxmertFinetune , MyLxmertForPreTraining
+    from vilt import MyViltFinetune , MyViltForPretrain
+    from vilbert import MyVilBertFinetune , MyVilBertPretrain
+    model_type , is_pretrain = variant.split('_')[0] , variant.endswith('_pretrain')
+    config = build_config(model_type, opt)
+    if model_type == 'lxmert':
+        return MyLxmertForPreTraining(config) if is_pretrain else MyLxmertFinetune(config, output_dim=13)
+    if model_type == 'vilt':
+        return MyViltForPretrain(config) if is_pretrain else MyViltFinetune(config, output_dim=13)
+    return MyVilBertPretrain(config) if is_pretrain else MyVilBertFinetune(config, output_dim=13)
+
+def synthetic_batch(batch_size, seq_len, vocab_size):
+    input_ids = torch.randint(1, vocab_size, (batch_size, seq_len))
+    # comment 后面四分之一随机padding, 和真实数据一样长短不一
+    attention_mask = torch.ones(batch_size, seq_len, dtype=torch.long)
+    attention_mask[:, seq_len - torch.randint(0, max(seq_len // 4, 1), (1,)).item():] = 0
+    mlm_labels = torch.full((batch_size, seq_len), -100, dtype=torch.long)
+    masked = torch.rand(batch_size, seq_len) < 0.15
+    mlm_labels[masked] = input_ids[masked]
+    matchs = torch.randint(0, 2, (batch_size, 1))
+    matchs[0] = 1
+    return {
+        'input_ids': input_ids,
+        'attention_mask': attention_mask,
+        'token_type_ids': torch.zeros(batch_size, seq_len, dtype=torch.long),
+        'visual_embeds': torch.randn(batch_size, 1, FEAT_DIM),
+        'visual_attention_mask': torch.ones(batch_size, 1),
+        'labels': torch.randint(0, 2, (batch_size, 13)).float(),
+        'mlm_labels': mlm_labels,
+        'matchs': matchs,
+    }
+
+def compute_loss(model, variant, batch):
+    if not variant.endswith('_pretrain'):
+        output = model_forward(model, variant, batch)
+        return F.binary_cross_entropy(output[:,0], batch['labels'][:,0]) + F.binary_cross_entropy(output[:,1:], batch['labels'][:,1:])
+    if variant == 'lxmert_pretrain':
+        output = model(
+            input_ids = batch['input_ids'],
+            attention_mask = batch['attention_mask'],
+            token_type_ids = batch['token_type_ids'],
+            visual_feats = batch['visual_embeds'],
+            visual_attention_mask = batch['visual_attention_mask'],
+            is_paired = batch['matchs'],
+            mlm_true_label = batch['mlm_labels'],
+        )
+    elif variant == 'vilt_pretrain':
+        output = model(
+            input_ids = batch['input_ids'],
+            attention_mask = batch['attention_mask'],
+            token_type_ids = batch['token_type_ids'],
+            feats = batch['visual_embeds'],
+            labels = batch['mlm_labels'],
+            matchs = batch['matchs'],
+        )
+    else:
+        output = model(
+            input_ids = batch['input_ids'],
+            token_type_ids = batch['token_type_ids'],
+            attention_mask = batch['attention_mask'],
+            feats = batch['visual_embeds'],
+            feats_attention_mask = batch['visual_attention_mask'],
+            labels = batch['mlm_labels'],
+            matchs = batch['matchs'],
+        )
+    return output['mlm_loss'] + output['match_loss']
+
+def peak_rss_mb():
+    # comment linux下ru_maxrss单位是KB, macOS是字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if platform.system() == 'Darwin' else peak / 1024
+
+def allocated_mb(model, variant, batch, optim):
+    # comment 用profiler统计一个完整训练步在cpu上申请的内存总量和申请次数
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        compute_loss(model, variant, batch).backward()
+        optim.step()
+        optim.zero_grad()
+    allocs = [event.cpu_memory_usage for event in prof.events() if event.cpu_memory_usage > 0 and not event.cpu_children]
+    return sum(allocs) / 1024 / 1024 , len(allocs)
+
+def bench_case(variant, batch_size, seq_len, opt):
+    # comment 每个case在单独的进程里跑, peak RSS才不会被前面的case污染
+    torch.manual_seed(opt.seed)
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+    model = build_model(variant, opt).train()
+    optim = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    batch = synthetic_batch(batch_size, seq_len, opt.vocab_size)
+    timings = {'forward': [], 'backward': [], 'optim': []}
+    for step in range(opt.warmup + opt.repeat):
+        t0 = time.perf_counter()
+        loss = compute_loss(model, variant, batch)
+        t1 = time.perf_counter()
+        loss.backward()
+        t2 = time.perf_counter()
+        optim.step()
+        optim.zero_grad()
+        t3 = time.perf_counter()
+        if step >= opt.warmup:
+            timings['forward'].append(t1 - t0)
+            timings['backward'].append(t2 - t1)
+            timings['optim'].append(t3 - t2)
+    alloc_mb , num_allocs = allocated_mb(model, variant, batch, optim) if opt.profile_memory else (None, None)
+    result = {
+        'variant': variant,
+        'batch_size': batch_size,
+        'seq_len': seq_len,
+        'params': sum(param.numel() for param in model.parameters()),
+        'param_mb': round(nbytes(model) / 1024 / 1024, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'alloc_mb_per_step': round(alloc_mb, 1) if alloc_mb is not None else None,
+        'allocs_per_step': num_allocs,
+    }
+    for name , values in timings.items():
+        result['%s_ms' % (name)] = round(sum(values) / len(values) * 1000, 3)
+    result['step_ms'] = round(result['forward_ms'] + result['backward_ms'] + result['optim_ms'], 3)
+    result['samples_per_s'] = round(batch_size / result['step_ms'] * 1000, 2)
+    return result
+
+def case_key(result):
+    return '%s/b%d/s%d' % (result['variant'], result['batch_size'], result['seq_len'])
+
+def compare(results, baseline_path, tolerance):
+    # comment 吞吐下降或者内存(peak rss / 每步申请量)上涨超过tolerance的case算回退
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {case_key(result): result for result in json.loads(f.read())['results']}
+    regressions = []
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None:
+            continue
+        print('%-28s samples/s %9.2f -> %9.2f (%+.1f%%) , peak rss %8.1f -> %8.1f MB' % (
+            case_key(result), old['samples_per_s'], result['samples_per_s'],
+            (result['samples_per_s'] / old['samples_per_s'] - 1) * 100, old['peak_rss_mb'], result['peak_rss_mb']))
+        if result['samples_per_s'] < old['samples_per_s'] * (1 - tolerance):
+            regressions.append('%s samples_per_s' % (case_key(result)))
+        for key in ('peak_rss_mb', 'alloc_mb_per_step'):
+            if old.get(key) is not None and result.get(key) is not None and result[key] > old[key] * (1 + tolerance):
+                regressions.append('%s %s' % (case_key(result), key))
+    for regression in regressions:
+        print('回退: %s' % (regression))
+    return regressions
+
+def main(opt):
+    cases = [(variant, batch_size, seq_len) for variant in opt.models for batch_size in opt.batch_sizes for seq_len in opt.seq_lens]
+    results = []
+    for variant , batch_size , seq_len in cases:
+        if opt.in_process:
+            result = bench_case(variant, batch_size, seq_len, opt)
+        else:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(bench_case, variant, batch_size, seq_len, opt).result()
+        results.append(result)
+        print('%-28s fwd %8.2f ms , bwd %8.2f ms , optim %7.2f ms , %9.2f samples/s , peak rss %8.1f MB' % (
+            case_key(result), result['forward_ms'], result['backward_ms'], result['optim_ms'], result['samples_per_s'], result['peak_rss_mb']))
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'num_threads': opt.num_threads if opt.num_threads > 0 else torch.get_num_threads(),
+            'opt': vars(opt),
+        },
+        'results': results,
+    }
+    save_dir = os.path.dirname(opt.save_path)
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+    with open(opt.save_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(report, indent=2, ensure_ascii=False))
+    print('结果写入 %s' % (opt.save_path))
+    if opt.baseline is not None and compare(results, opt.baseline, opt.tolerance) and opt.fail_on_regression:
+        raise SystemExit(1)
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models',type=str,nargs='+',default=list(MODEL_VARIANTS),choices=MODEL_VARIANTS,help='*_pretrain 为预训练模型')
+    parser.add_argument('--batch_sizes',type=int,nargs='+',default=[8, 32])
+    parser.add_argument('--seq_lens',type=int,nargs='+',default=[20, 37])
+    parser.add_argument('--warmup',type=int,default=2)
+    parser.add_argument('--repeat',type=int,default=5)
+    parser.add_argument('--num_threads',type=int,default=0,help='cpu线程数, 0 表示torch默认')
+    parser.add_argument('--seed',type=int,default=25)
+    parser.add_argument('--vocab_size',type=int,default=21128)
+    parser.add_argument('--hidden_size',type=int,default=768)
+    parser.add_argument('--num_attention_heads',type=int,default=12)
+    parser.add_argument('--intermediate_size',type=int,default=3072)
+    parser.add_argument('--l_layers',type=int,default=9,help='lxmert')
+    parser.add_argument('--x_layers',type=int,default=5,help='lxmert')
+    parser.add_argument('--r_layers',type=int,default=5,help='lxmert')
+    parser.add_argument('--vilt_layers',type=int,default=12,help='vilt')
+    parser.add_argument('--vilbert_layers',type=int,default=7,help='vilbert 文本层数')
+    parser.add_argument('--vilbert_v_layers',type=int,default=3,help='vilbert 图像层数')
+    parser.add_argument('--t_biattention_id',type=int,nargs='+',default=[5, 6],help='vilbert')
+    parser.add_argument('--v_biattention_id',type=int,nargs='+',default=[0, 1],help='vilbert')
+    parser.add_argument('--profile_memory',action='store_true',help='额外用profiler统计每步申请的内存, 会多跑一步')
+    parser.add_argument('--in_process',action='store_true',help='所有case在当前进程里跑(peak rss是累计值)')
+    parser.add_argument('--save_path',type=str,default='./output/bench_models.json')
+    parser.add_argument('--baseline',type=str,default=None,help='之前的结果json, 设置后打印对比')
+    parser.add_argument('--tolerance',type=float,default=0.1,help='和baseline比 吞吐下降/内存上涨 超过这个比例算回退')
+    parser.add_argument('--fail_on_regression',action='store_true',help='有回退时退出码为1, 给CI用')
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    main(opt)
@@ -0,0 +1,224 @@
+
+import os
+import re
+import json
+import time
+import argparse
+
+import torch
+
+from predictor import (
+    Predictor,
+    load_finetune_model,
+    load_label_list,
+    load_frozen_val_set,
+    score_outputs,
+    MODEL_TYPES,
+)
+from datasets import delete_word
+
+RULES_NAME = 'cascade_rules.json'
+CONFLICT = '冲突'
+
+
+class AttrRuleCascade(object):
+    # comment 模型前面的规则层: 按title里命中的属性值直接判定属性列，只有判定不了的属性和图文才交给模型
+    # comment 规则的key是 属性:命中的属性值组 (例如 袖长:短袖=五分袖)，同一属性命中多组不同含义的值时记为 属性:冲突
+    # comment 每条规则在冻结验证集上统计 label 的比例，precision >= confidence 且样本数 >= min_support 的才启用
+    def __init__(self, key_attr_values, label_list, rules=None):
+        self.label_list = label_list
+        self.label2id = {label: i for i, label in enumerate(label_list)}
+        self.patterns = {}
+        self.value2group = {}
+        for attr , values in key_attr_values.items():
+            for group in values:
+                for value in group.split('='):
+                    self.value2group[(attr, value.lower())] = group
+            # comment 长的值优先匹配，避免 松紧带 被当成 松紧
+            words = sorted((value.lower() for group in values for value in group.split('=')), key=len, reverse=True)
+            self.patterns[attr] = re.compile('|'.join(re.escape(word) for word in words))
+        self.rules = rules or {}
+
+    def match(self, text):
+        # comment 返回 {属性: 规则key}，title里没有该属性的值时不出现
+        text = text.lower()
+        keys = {}
+        for attr , pattern in self.patterns.items():
+            groups = set(self.value2group[(attr, word)] for word in pattern.findall(text))
+            if len(groups) == 1:
+                keys[attr] = '%s:%s' % (attr, groups.pop())
+            elif len(groups) > 1:
+                keys[attr] = '%s:%s' % (attr, CONFLICT)
+        return keys
+
+    def decide(self, text, attrs):
+        # comment 返回 {属性: (label, precision)}，只包含attrs里规则能判定的属性
+        decided = {}
+        for attr , key in self.match(text).items():
+            if attr in attrs and key in self.rules:
+                decided[attr] = (self.rules[key]['label'], self.rules[key]['precision'])
+        return decided
+
+    def calibrate(self, texts, labels, label_masks, confidence=0.99, min_support=50):
+        stats = {}
+        for text , label , label_mask in zip(texts, labels.tolist(), label_masks.tolist()):
+            for attr , key in self.match(text).items():
+                column = self.label2id[attr]
+                if label_mask[column] != 1:
+                    continue
+                stat = stats.setdefault(key, [0, 0])
+                stat[int(label[column] >= 0.5)] += 1
+        self.rules = {}
+        for key , (negative , positive) in stats.items():
+            support = negative + positive
+            label = int(positive >= negative)
+            precision = max(negative, positive) / support
+            if support >= min_support and precision >= confidence:
+                self.rules[key] = {'label': label, 'precision': round(precision, 6), 'support': support}
+        return stats
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.rules, indent=2, ensure_ascii=False))
+
+    @classmethod
+    def from_file(cls, path, key_attr_values=None, label_list=None):
+        if key_attr_values is None:
+            with open(os.path.join('./data', 'attr_to_attrvals.json'), 'r') as f:
+                key_attr_values = json.loads(f.read())
+        with open(path, 'r', encoding='utf-8') as f:
+            rules = json.loads(f.read())
+        return cls(key_attr_values, label_list or load_label_list(), rules=rules)
+
+
+class CascadePredictor(object):
+    # comment 先用规则判定，query全部被规则判定(不含图文)的样本不进模型，其余样本的模型输出再用规则结果覆盖
+    def __init__(self, predictor, cascade):
+        self.predictor = predictor
+        self.cascade = cascade
+        self.model_type = predictor.model_type
+        self.output_dim = predictor.output_dim
+        self.num_samples , self.num_skipped = 0 , 0
+        self.num_pairs , self.num_decided = 0 , 0
+
+    def predict(self, samples):
+        probs = torch.empty(len(samples), self.output_dim)
+        decisions , model_idxs = [] , []
+        for i , sample in enumerate(samples):
+            query = sample.get('query', self.cascade.label_list)
+            decided = self.cascade.decide(delete_word(sample['title']), set(query))
+            decisions.append(decided)
+            if len(decided) < len(query):
+                model_idxs.append(i)
+            self.num_pairs += len(query)
+            self.num_decided += len(decided)
+        if model_idxs:
+            probs[model_idxs] = self.predictor.predict([samples[i] for i in model_idxs])
+        for i , decided in enumerate(decisions):
+            for attr , (label , precision) in decided.items():
+                probs[i, self.cascade.label2id[attr]] = precision if label == 1 else 1 - precision
+        self.num_samples += len(samples)
+        self.num_skipped += len(samples) - len(model_idxs)
+        return probs
+
+    def summary(self):
+        return {
+            'samples': self.num_samples,
+            'skipped_samples': self.num_skipped,
+            'skip_rate': round(self.num_skipped / max(self.num_samples, 1), 4),
+            'pairs': self.num_pairs,
+            'decided_pairs': self.num_decided,
+            'decided_rate': round(self.num_decided / max(self.num_pairs, 1), 4),
+        }
+
+    def close(self):
+        if hasattr(self.predictor, 'close'):
+            self.predictor.close()
+
+
+def decode_texts(tokenizer, input_ids):
+    # comment 冻结验证集里只有token，解码回title(中文按字切分，去掉空格即可)
+    return [tokenizer.decode(ids, skip_special_tokens=True).replace(' ', '') for ids in input_ids.tolist()]
+
+def apply_rules(cascade, texts, probs, label_masks):
+    # comment 在验证集上模拟级联: 规则判定的列用规则结果，返回新的概率、每条样本是否还需要跑模型、规则判定的属性数
+    probs = probs.clone()
+    need_model = torch.zeros(len(texts), dtype=torch.bool)
+    num_decided = 0
+    for i , text in enumerate(texts):
+        query = set(label for label , mask in zip(cascade.label_list, label_masks[i].tolist()) if mask == 1)
+        decided = cascade.decide(text, query)
+        for attr , (label , precision) in decided.items():
+            probs[i, cascade.label2id[attr]] = precision if label == 1 else 1 - precision
+        need_model[i] = len(decided) < len(query)
+        num_decided += len(decided)
+    return probs , need_model , num_decided
+
+def split_frozen(frozen, calib_rate, seed=42):
+    # comment 冻结验证集按calib_rate随机切成两份: 一份选规则，另一份留出来评估，避免在选规则的数据上报分数
+    generator = torch.Generator().manual_seed(seed)
+    perm = torch.randperm(frozen['input_ids'].shape[0], generator=generator)
+    num_calib = int(len(perm) * calib_rate)
+    calib_idxs , eval_idxs = perm[:num_calib].sort().values , perm[num_calib:].sort().values
+    return {key: value[calib_idxs] for key, value in frozen.items()} , {key: value[eval_idxs] for key, value in frozen.items()}
+
+def main(opt):
+    from transformers import BertTokenizer
+    assert 0 < opt.calib_rate < 1, '--calib_rate 需要在(0, 1)之间'
+    tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path= opt.tokenizer_path)
+    frozen = load_frozen_val_set(opt.val_path, tokenizer, cache_path=opt.frozen_val_path, seed=opt.seed)
+    calib , frozen = split_frozen(frozen, opt.calib_rate, seed=opt.seed)
+    calib_texts = decode_texts(tokenizer, calib['input_ids'])
+    texts = decode_texts(tokenizer, frozen['input_ids'])
+    with open(os.path.join('./data', 'attr_to_attrvals.json'), 'r') as f:
+        key_attr_values = json.loads(f.read())
+    cascade = AttrRuleCascade(key_attr_values, load_label_list())
+    stats = cascade.calibrate(calib_texts, calib['labels'], calib['label_masks'], confidence=opt.confidence, min_support=opt.min_support)
+    os.makedirs(os.path.dirname(opt.save_path) or '.', exist_ok=True)
+    cascade.save(opt.save_path)
+    print('%d 条候选规则, 启用 %d 条, 写入 %s' % (len(stats), len(cascade.rules), opt.save_path))
+    for key , rule in sorted(cascade.rules.items(), key=lambda item: -item[1]['support']):
+        print('    %s -> %d (precision %.4f, support %d)' % (key, rule['label'], rule['precision'], rule['support']))
+
+    # comment 在留出的另一份上看规则能挡掉多少工作量，以及和模型一起用时的分数
+    _ , need_model , num_decided = apply_rules(cascade, texts, frozen['labels'], frozen['label_masks'])
+    num_pairs = int((frozen['label_masks'][:, 1:] == 1).sum().item())
+    report = {'calib_size': len(calib_texts), 'eval_size': len(texts), 'rules': len(cascade.rules), 'attr_pairs': num_pairs, 'decided_pairs': num_decided}
+    report['decided_rate'] = round(num_decided / max(num_pairs, 1), 4)
+    report['skip_rate'] = round(1 - need_model.float().mean().item(), 4)
+    if opt.model_path is not None:
+        device = 'cuda:%d' % (opt.gpu) if opt.gpu >= 0 and torch.cuda.is_available() else 'cpu'
+        model , model_type = load_finetune_model(opt.model_path, model_type=opt.model_type)
+        predictor = Predictor(model, model_type, tokenizer, device=device, batch_size=opt.batch_size)
+        since = time.time()
+        probs = predictor.predict_batches(frozen)
+        model_seconds = time.time() - since
+        cascade_probs , _ , _ = apply_rules(cascade, texts, probs, frozen['label_masks'])
+        report['model_score'] = [round(score, 6) for score in score_outputs(probs, frozen['labels'], frozen['label_masks'])]
+        report['cascade_score'] = [round(score, 6) for score in score_outputs(cascade_probs, frozen['labels'], frozen['label_masks'])]
+        # comment 跳过的样本不用跑模型，吞吐按剩下的比例估算
+        report['model_samples_per_s'] = round(len(texts) / model_seconds, 2)
+        report['cascade_samples_per_s'] = round(len(texts) / max(model_seconds * (1 - report['skip_rate']), 1e-6), 2)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tokenizer_path',type=str,required=True,help='tokenizer path')
+    parser.add_argument('--val_path',type=str,required=True,help='验证集(训练数据格式的json), 用来校准规则')
+    parser.add_argument('--frozen_val_path',type=str,default=None,help='冻结验证集的缓存(.pt), 不存在时生成')
+    parser.add_argument('--seed',type=int,default=42,help='冻结验证集和校准/评估划分的随机种子')
+    parser.add_argument('--calib_rate',type=float,default=0.5,help='冻结验证集中用来校准规则的比例, 其余用来评估 模型 和 规则+模型')
+    parser.add_argument('--save_path',type=str,default=os.path.join('./output', RULES_NAME),help='校准后的规则, run_predict.py --cascade_path 使用')
+    parser.add_argument('--confidence',type=float,default=0.99,help='规则在验证集上的precision达到多少才启用')
+    parser.add_argument('--min_support',type=int,default=50,help='规则在验证集上至少命中多少条才启用')
+    parser.add_argument('--model_path',type=str,default=None,help='设置后对比 模型 和 规则+模型 的分数')
+    parser.add_argument('--model_type',type=str,default='auto',choices=('auto',) + MODEL_TYPES,help='auto: 根据config.json判断')
+    parser.add_argument('--batch_size',type=int,default=256)
+    parser.add_argument('--gpu',type = int, default=-1,help='GPU, -1 表示使用cpu')
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    main(opt)
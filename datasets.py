@@ -1,12 +1,58 @@
 
+import os
+import sys
 import random
+import pickle
 import torch
 import numpy as np
 import re
-import jieba
 from copy import deepcopy
 
-jieba.load_userdict("jieba_userdict.txt")
+# comment 词典和缓存都放在datasets.py同目录，不依赖启动时的工作目录
+JIEBA_USERDICT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jieba_userdict.txt')
+JIEBA_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jieba_userdict.cache')
+jieba_tokenizer = None
+
+def jieba_cache_key(userdict_path):
+    # comment jieba版本、主词典和用户词典的大小/修改时间都没变时缓存才有效
+    import jieba
+    key = [jieba.__version__, sys.version_info[:2]]
+    for path in (os.path.join(os.path.dirname(jieba.__file__), jieba.DEFAULT_DICT_NAME), userdict_path):
+        stat = os.stat(path)
+        key += [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    return tuple(key)
+
+def load_jieba(userdict_path=JIEBA_USERDICT, cache_path=JIEBA_CACHE):
+    # comment 第一次分词时才加载jieba，import datasets 不再等词典
+    # comment 主词典+用户词典合并后的前缀词典(FREQ, total)用pickle缓存，之后直接读缓存，不用重新建词典和逐个add_word
+    # comment (jieba自带的缓存是marshal，只有主词典，几十万个词的dict用pickle读快几倍)
+    global jieba_tokenizer
+    if jieba_tokenizer is not None:
+        return jieba_tokenizer
+    import jieba
+    tokenizer = jieba.Tokenizer()
+    key = jieba_cache_key(userdict_path)
+    try:
+        with open(cache_path, 'rb') as f:
+            cache_key , freq , total = pickle.load(f)
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        cache_key = None
+    if cache_key == key:
+        tokenizer.FREQ , tokenizer.total = freq , total
+        tokenizer.initialized = True
+    else:
+        tokenizer.initialize()
+        tokenizer.load_userdict(userdict_path)
+        # comment DataLoader的多个worker可能同时重建，各自写临时文件再rename
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((key, tokenizer.FREQ, tokenizer.total), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError as error:
+            print('jieba词典缓存写入失败 %s: %r' % (cache_path, error))
+    jieba_tokenizer = tokenizer
+    return jieba_tokenizer
 
 # 获取同一属性的其他不同含义的属性值
 def get_sameattr_values(attr_to_attrvals):
@@ -43,6 +89,111 @@ def delete_word(text):
     text = re.sub(r'\d+年', '', text)
     return text
 
+def to_tensor(value, dtype=None):
+    # comment 共享内存里的数据在__getitem__中会被原地修改, 必须拷贝一份
+    if torch.is_tensor(value):
+        return value.to(dtype=dtype if dtype is not None else value.dtype, copy=True)
+    return torch.tensor(value, dtype=dtype)
+
+class IndexView(object):
+    # comment 对底层数据的索引视图, 不拷贝数据
+    def __init__(self, base, indices):
+        self.base = base
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        return self.base[self.indices[idx]]
+
+class TokenCache(object):
+    # comment 原始title的分词结果只算一次, 放在共享内存里; 增强后文本变了就回退到tokenizer
+    def __init__(self, tokenizer, texts, max_len):
+        unique_texts = list(dict.fromkeys(str(text) for text in texts))
+        self.text2row = {text: row for row, text in enumerate(unique_texts)}
+        inputs = tokenizer(unique_texts, padding="max_length", max_length=max_len, truncation=True)
+        self.input_ids = torch.tensor(inputs['input_ids'], dtype=torch.int32).share_memory_()
+        self.lengths = torch.tensor([sum(mask) for mask in inputs['attention_mask']], dtype=torch.int32).share_memory_()
+
+    def lookup(self, text, max_len):
+        row = self.text2row.get(text)
+        # comment 超过当前max_len的句子需要tokenizer重新截断(保留末尾的[SEP])
+        if row is None or max_len > self.input_ids.size(1) or self.lengths[row] > max_len:
+            return None
+        input_ids = self.input_ids[row, :max_len].long()
+        attention_mask = torch.zeros(max_len, dtype=torch.long)
+        attention_mask[:self.lengths[row]] = 1
+        return {
+            'input_ids': input_ids,
+            'token_type_ids': torch.zeros(max_len, dtype=torch.long),
+            'attention_mask': attention_mask,
+        }
+
+class SharedMatchCorpus(object):
+    # comment 整个语料只加载一次: 特征和标签转成紧凑的张量放进共享内存, DataLoader的worker fork后直接共享
+    # comment 训练/测试集(每一折)只是一组索引, 通过view()生成MatchDataset_v2/PreDataset_v2需要的参数
+    # comment 预训练数据没有label_masks, 传None时view()里不出现
+    def __init__(self, texts, img_features, labels, key_attrs, label_masks=None):
+        self.texts = np.array(texts)
+        self.text_lens = np.array([len(text) for text in texts], dtype=np.int64)
+        self.visual_embeds = torch.from_numpy(np.asarray(img_features, dtype=np.float32)).share_memory_()
+        self.labels = share_rows(labels)
+        self.label_masks = share_rows(label_masks) if label_masks is not None else None
+        self.key_attrs = list(key_attrs)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def max_text_len(self, indices=None):
+        if indices is None:
+            return int(self.text_lens.max())
+        return int(self.text_lens[indices].max())
+
+    def view(self, indices):
+        view = {
+            'texts': IndexView(self.texts, indices),
+            'labels': IndexView(self.labels, indices),
+            'visual_embeds': IndexView(self.visual_embeds, indices),
+            'key_attrs': IndexView(self.key_attrs, indices),
+        }
+        if self.label_masks is not None:
+            view['label_masks'] = IndexView(self.label_masks, indices)
+        return view
+
+def share_rows(values):
+    # comment 0/1标签转成uint8张量放进共享内存; 每条长度不一时(例如coarse数据只有图文标签)保留原来的list
+    try:
+        return torch.from_numpy(np.asarray(values, dtype=np.uint8)).share_memory_()
+    except ValueError:
+        return list(values)
+
+def split_indices(num_split, test_rate, num_total=None, split_path=None):
+    # comment 语料的前num_split条按test_rate划分训练/测试集, [num_split, num_total) 的样本(coarse数据)全部进训练集
+    # comment test_rate为0时全部数据训练, 另外随机抽30%作为测试集只用来看loss
+    # comment 给了split_path就直接读之前保存的划分(save_split), 保证不同模型/不同次实验用同一个验证集
+    num_total = num_split if num_total is None else num_total
+    if split_path is not None:
+        train_idxs , test_idxs = load_split(split_path)
+        assert max(train_idxs.max(), test_idxs.max()) < num_total, '%s 的索引超出语料大小 %d' % (split_path, num_total)
+        return train_idxs , test_idxs
+    from sklearn.model_selection import train_test_split
+    if test_rate == 0:
+        _, test_idxs = train_test_split(range(num_split), test_size=0.3)
+        train_idxs = range(num_split)
+    else:
+        train_idxs, test_idxs = train_test_split(range(num_split), test_size=test_rate)
+    train_idxs = np.concatenate((np.asarray(train_idxs, dtype=np.int64), np.arange(num_split, num_total, dtype=np.int64)))
+    return train_idxs , np.asarray(test_idxs, dtype=np.int64)
+
+def save_split(path, train_idxs, test_idxs):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    np.savez(path, train_idxs=np.asarray(train_idxs, dtype=np.int64), test_idxs=np.asarray(test_idxs, dtype=np.int64))
+
+def load_split(path):
+    split = np.load(path)
+    return split['train_idxs'] , split['test_idxs']
+
 class PreDataset_v2(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -85,7 +236,7 @@ class PreDataset_v2(torch.utils.data.Dataset):
         return len(self.texts)
 
     def __getitem__(self,idx):
-        visual_embeds = torch.tensor(self.visual_embeds[idx]).unsqueeze(0)
+        visual_embeds = to_tensor(self.visual_embeds[idx], dtype=torch.float32).unsqueeze(0)
         visual_attention_mask = torch.ones(visual_embeds.shape[:-1], dtype=torch.float)
         key_attrs = deepcopy(self.key_attrs[idx])
         if len(key_attrs) <  1:
@@ -93,28 +244,28 @@ class PreDataset_v2(torch.utils.data.Dataset):
                 new_idx = random.choice(range(len(self.labels)))
                 while new_idx == idx:
                     new_idx = random.choice(range(len(self.labels)))
-                new_text_set = set(list(jieba.cut(self.texts[new_idx])))
-                old_text_set = set(list(jieba.cut(self.texts[idx])))
+                new_text_set = set(list(load_jieba().cut(self.texts[new_idx])))
+                old_text_set = set(list(load_jieba().cut(self.texts[idx])))
                 sentence_image_labels = torch.zeros(visual_embeds.shape[:-1], dtype=torch.long)
                 sentence_image_labels[0] = 1 if len(new_text_set.intersection(old_text_set)) == len(new_text_set) else 0
                 text = deepcopy(self.texts[new_idx])
             else:       
                 text = deepcopy(self.texts[idx])
-                sentence_image_labels = torch.full(visual_embeds.shape[:-1], self.labels[idx][0],
+                sentence_image_labels = torch.full(visual_embeds.shape[:-1], int(self.labels[idx][0]),
                                                    dtype=torch.long)
         else:
         
             if random.random() < self.p2: 
                 text = deepcopy(self.texts[idx])
-                sentence_image_labels = torch.full(visual_embeds.shape[:-1], self.labels[idx][0],
+                sentence_image_labels = torch.full(visual_embeds.shape[:-1], int(self.labels[idx][0]),
                                                    dtype=torch.long)
             else:
                 if random.random() < self.p3: 
                     new_idx = random.choice(range(len(self.labels)))
                     while new_idx == idx :
                         new_idx = random.choice(range(len(self.labels))) 
-                    new_text_set = set(list(jieba.cut(self.texts[new_idx])))
-                    old_text_set = set(list(jieba.cut(self.texts[idx])))
+                    new_text_set = set(list(load_jieba().cut(self.texts[new_idx])))
+                    old_text_set = set(list(load_jieba().cut(self.texts[idx])))
                     sentence_image_labels = torch.zeros(visual_embeds.shape[:-1], dtype=torch.long)
                     sentence_image_labels[0] = 1 if len(new_text_set.intersection(old_text_set)) == len(new_text_set) else 0 
                     text = deepcopy(self.texts[new_idx])
@@ -134,7 +285,7 @@ class PreDataset_v2(torch.utils.data.Dataset):
                         sentence_image_labels = torch.zeros(visual_embeds.shape[:-1], dtype=torch.long)   
                     else:    
                         old_text = deepcopy(self.texts[idx])
-                        old_text_set = set(list(jieba.cut(old_text,cut_all=False)))
+                        old_text_set = set(list(load_jieba().cut(old_text,cut_all=False)))
                         hit_set = old_text_set.intersection(self.color_set) 
                         if hit_set is not  None:
                             select_set = self.color_set - hit_set      
@@ -154,11 +305,11 @@ class PreDataset_v2(torch.utils.data.Dataset):
                         else:
                             
                             text = deepcopy(self.texts[idx])
-                            sentence_image_labels = torch.full(visual_embeds.shape[:-1], self.labels[idx][0],
+                            sentence_image_labels = torch.full(visual_embeds.shape[:-1], int(self.labels[idx][0]),
                                                     dtype=torch.long)    
         not_shuffle = '浅' in text or '深' in text or '拼' in text or '撞' in text
         if not not_shuffle and random.random() < self.p5:
-            text_arr = list(jieba.cut(text,cut_all=False))    
+            text_arr = list(load_jieba().cut(text,cut_all=False))    
             random.shuffle(text_arr)
             text = ''.join(text_arr)   
         inputs = self.tokenizer(text, padding="max_length", max_length=self.max_len, truncation=True)
@@ -192,6 +343,7 @@ class MatchDataset_v2(torch.utils.data.Dataset):
         p7 = 0.7,          
         shuffle_rate = 0.1, 
         color_set = None,   
+        token_cache = None, 
     ):
         self.tokenizer = tokenizer
         self.texts = texts
@@ -211,6 +363,7 @@ class MatchDataset_v2(torch.utils.data.Dataset):
                     same_mean_attrvals.append(value.split('='))
         self.same_mean_attrvals = same_mean_attrvals
         self.color_set = color_set
+        self.token_cache = token_cache
 
         # comment 文本增强
         self.p1 , self.p2 , self.p3 , self.p4 , self.p5 , self.p6 , self.p8  = p1 , p2 , p3 , p4 , p5 , p6 , p8
@@ -221,7 +374,7 @@ class MatchDataset_v2(torch.utils.data.Dataset):
         return len(self.texts)
 
     def __getitem__(self, idx):
-        visual_embeds = torch.tensor(self.visual_embeds[idx], dtype=torch.float32).unsqueeze(0) # shape[1,2048]
+        visual_embeds = to_tensor(self.visual_embeds[idx], dtype=torch.float32).unsqueeze(0) # shape[1,2048]
         visual_attention_mask = torch.ones(visual_embeds.shape[:-1], dtype=torch.float)
         # comment feats增强
         if random.random()<self.p7: 
@@ -235,16 +388,16 @@ class MatchDataset_v2(torch.utils.data.Dataset):
         # comment 文本增强 
         # TODO 考虑是否要进行 '删字'
         text = deepcopy(self.texts[idx])
-        labels = torch.tensor(self.labels[idx], dtype=torch.float)
-        label_masks = torch.tensor(self.label_masks[idx])
+        labels = to_tensor(self.labels[idx], dtype=torch.float)
+        label_masks = to_tensor(self.label_masks[idx])
         key_attrs = deepcopy(self.key_attrs[idx])
         if len(key_attrs) < 1:  
             if random.random() < self.p8:
                 new_idx = random.choice(range(len(self.labels)))
                 while new_idx == idx:
                     new_idx = random.choice(range(len(self.labels)))
-                new_text_set = set(list(jieba.cut(self.texts[new_idx])))
-                old_text_set = set(list(jieba.cut(self.texts[idx])))
+                new_text_set = set(list(load_jieba().cut(self.texts[new_idx])))
+                old_text_set = set(list(load_jieba().cut(self.texts[idx])))
                 labels = torch.zeros(13) 
                 labels[0] = 1 if len(new_text_set.intersection(old_text_set)) == len(new_text_set) else 0   
                 text = deepcopy(self.texts[new_idx])
@@ -268,12 +421,12 @@ class MatchDataset_v2(torch.utils.data.Dataset):
                                 labels[self.label2id[attr]] = 1
                             if is_same_mean_attrval(value,new_keyattrs[attr],self.same_mean_attrvals):
                                 labels[self.label2id[attr]] = 1
-                    label_masks = torch.tensor(self.label_masks[new_idx])
+                    label_masks = to_tensor(self.label_masks[new_idx])
                     # comment 判断old_text的文本是否全部出现在new_text中
                     # comment 如果flag为1表示新文本的所有内容出现在旧文本中，这时候label[0] =1
                     # comment 如果flag为0表示新文本中有部分内容没有出现在旧文本中，这时候label[0]=-
-                    new_text_set = set(list(jieba.cut(new_text,cut_all=False)))
-                    old_text_set = set(list(jieba.cut(old_text,cut_all=False)))
+                    new_text_set = set(list(load_jieba().cut(new_text,cut_all=False)))
+                    old_text_set = set(list(load_jieba().cut(old_text,cut_all=False)))
                     labels[0] = 1 if len(new_text_set.intersection(old_text_set)) == len(new_text_set) else 0
                     text = new_text
                 else:
@@ -300,7 +453,7 @@ class MatchDataset_v2(torch.utils.data.Dataset):
                         if random.random() < self.p5:
                             # comment 更换颜色
                             old_text = deepcopy(self.texts[idx])
-                            old_text_set = set(list(jieba.cut(old_text , cut_all=False)))
+                            old_text_set = set(list(load_jieba().cut(old_text , cut_all=False)))
                             hit_set = old_text_set.intersection(self.color_set) 
                             if hit_set is not None:
                                 select_set = self.color_set - hit_set  
@@ -315,7 +468,7 @@ class MatchDataset_v2(torch.utils.data.Dataset):
                                         is_overlap = len(hit_word_set.intersection(select_word_set) - {'色'}) >= 1
                                     select_set = select_set - {select_color}  
                                     old_text = old_text.replace(hit,select_color)
-                                labels = torch.tensor(self.labels[idx], dtype=torch.float)
+                                labels = to_tensor(self.labels[idx], dtype=torch.float)
                                 labels[0]=0     
                                 text = old_text
                             else:
@@ -324,11 +477,13 @@ class MatchDataset_v2(torch.utils.data.Dataset):
 
         not_shuffle = '浅' in text or '深' in text or '拼' in text or '撞' in text 
         if not not_shuffle and random.random() < self.p6:
-            text_arr = list(jieba.cut(text,cut_all=False))     
+            text_arr = list(load_jieba().cut(text,cut_all=False))     
             random.shuffle(text_arr)
             text = ''.join(text_arr)
-        inputs = self.tokenizer(text, padding="max_length", max_length=self.max_len, truncation=True)
-        item = {key : torch.tensor(val) for key , val in inputs.items()}
+        item = self.token_cache.lookup(str(text), self.max_len) if self.token_cache is not None else None
+        if item is None:
+            inputs = self.tokenizer(text, padding="max_length", max_length=self.max_len, truncation=True)
+            item = {key : torch.tensor(val) for key , val in inputs.items()}
         item.update({
             "labels": labels,
             "visual_embeds": visual_embeds,
@@ -347,4 +502,17 @@ class MatchDataset_v2(torch.utils.data.Dataset):
 
 
         
-     
\ No newline at end of file
+     
+def freeze_dataset(dataset, seed=42):
+    # comment 固定随机种子把带随机增强的dataset展开一遍，得到一份每次都一样的验证集，不影响外部的随机状态
+    states = random.getstate() , np.random.get_state() , torch.get_rng_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    try:
+        items = [dataset[i] for i in range(len(dataset))]
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+        torch.set_rng_state(states[2])
+    return {key : torch.stack([item[key] for item in items]) for key in items[0]}
@@ -0,0 +1,402 @@
+
+import os
+import json
+import time
+import hashlib
+import random
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from helper import build_optimizer , get_update_steps , build_profiler , ModelSaver , get_accum_size
+from datasets import delete_word , freeze_dataset , MatchDataset_v2 , SharedMatchCorpus , split_indices , save_split , to_tensor
+from model_avg import load_state_dict , find_weights , WEIGHTS_NAMES
+from predictor import (
+    Predictor,
+    EnsemblePredictor,
+    load_finetune_model,
+    load_label_list,
+    load_attr_weights,
+    build_ensemble_weights,
+    score_outputs,
+)
+
+STORE_META = 'meta.json'
+
+
+class TeacherStore(object):
+    # comment 蒸馏语料: 每条(增强后的)样本的token、标签、原始样本下标和教师概率，全部np.memmap落盘
+    #   图像特征不重复存，训练时按src_idx到原始数据里取
+    #   memmap是没有header的裸数组，后缀用.bin，shape和dtype记在meta.json里
+    FIELDS = {
+        'input_ids'      : ('int32'  , 'seq'),
+        'attention_mask' : ('int8'   , 'seq'),
+        'token_type_ids' : ('int8'   , 'seq'),
+        'labels'         : ('uint8'  , 'out'),
+        'label_masks'    : ('uint8'  , 'out'),
+        'teacher_probs'  : ('float32', 'out'),
+        'src_idx'        : ('int64'  , None),
+    }
+
+    def __init__(self, root, meta, mode='r'):
+        self.root = root
+        self.meta = meta
+        self.arrays = {}
+        for name, (dtype, width) in self.FIELDS.items():
+            shape = (meta['num'],) if width is None else (meta['num'], meta['seq_len'] if width == 'seq' else meta['output_dim'])
+            self.arrays[name] = np.memmap(self.path(root, name), dtype=dtype, mode=mode, shape=shape)
+
+    def __len__(self):
+        return self.meta['num']
+
+    @staticmethod
+    def path(root, name):
+        return os.path.join(root, name + '.bin')
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    @classmethod
+    def create(cls, root, num, seq_len, output_dim=13, **info):
+        os.makedirs(root, exist_ok=True)
+        meta = dict(info, num=num, seq_len=seq_len, output_dim=output_dim, complete=False)
+        store = cls(root, meta, mode='w+')
+        store.write_meta()
+        return store
+
+    @classmethod
+    def open(cls, root):
+        with open(os.path.join(root, STORE_META), 'r', encoding='utf-8') as f:
+            meta = json.loads(f.read())
+        assert meta['complete'], '%s 没有生成完整, 需要重新生成' % (root)
+        return cls(root, meta, mode='r')
+
+    @classmethod
+    def open_if_match(cls, root, **expected):
+        # comment meta里记录的教师、展开遍数、种子、条数、序列长度、输出维度、数据文件和训练集划分都和当前一致才复用，否则返回None重新生成
+        meta_path = os.path.join(root, STORE_META)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.loads(f.read())
+        if not meta.get('complete'):
+            print('%s 没有生成完整, 重新生成' % (root))
+            return None
+        diff = [key for key, value in expected.items() if meta.get(key) != value]
+        if diff:
+            print('%s 的 %s 和当前不一致, 重新生成' % (root, ','.join(diff)))
+            return None
+        if not all(os.path.exists(cls.path(root, name)) for name in cls.FIELDS):
+            print('%s 缺少数据文件, 重新生成' % (root))
+            return None
+        return cls(root, meta, mode='r')
+
+    def write(self, start, values):
+        for name, value in values.items():
+            self.arrays[name][start:start + len(value)] = value
+
+    def write_meta(self):
+        with open(os.path.join(self.root, STORE_META), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.meta, indent=2, ensure_ascii=False))
+
+    def finish(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.meta['complete'] = True
+        self.write_meta()
+
+
+class DistillDataset(torch.utils.data.Dataset):
+    def __init__(self, store, img_features):
+        self.store = store
+        self.img_features = img_features
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, idx):
+        visual_embeds = to_tensor(self.img_features[self.store['src_idx'][idx]], dtype=torch.float32).unsqueeze(0)
+        return {
+            'input_ids'             : torch.from_numpy(self.store['input_ids'][idx].astype(np.int64)),
+            'attention_mask'        : torch.from_numpy(self.store['attention_mask'][idx].astype(np.int64)),
+            'token_type_ids'        : torch.from_numpy(self.store['token_type_ids'][idx].astype(np.int64)),
+            'visual_embeds'         : visual_embeds,
+            'visual_attention_mask' : torch.ones(visual_embeds.shape[:-1], dtype=torch.float),
+            'labels'                : torch.from_numpy(self.store['labels'][idx].astype(np.float32)),
+            'label_masks'           : torch.from_numpy(self.store['label_masks'][idx].astype(np.int64)),
+            'teacher_probs'         : torch.from_numpy(self.store['teacher_probs'][idx].copy()),
+        }
+
+
+def seed_everything(seed):
+    from transformers import set_seed
+    set_seed(seed)
+    random.seed(seed)
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+
+def load_corpus(opt):
+    if opt.mode == 'train':
+        coarse_train_path = os.path.join(opt.data_root, 'coarse_to_fine_data.json')
+        fine_train_path = os.path.join(opt.data_root,'fine_data.json')
+    else:
+        coarse_train_path = os.path.join(opt.data_root,'fine_data_sample.json')
+        fine_train_path = os.path.join(opt.data_root,'fine_data_sample.json')
+    with open(fine_train_path, 'r') as f:
+        fine_data = json.loads(f.read())
+    with open(coarse_train_path, 'r', encoding='utf-8') as f:
+        coarse_to_fine_data = json.loads(f.read())
+    # comment 和finetune_lxmert.py一样: fine数据按test_rate切出验证集，训练集 = 剩余fine + coarse_to_fine
+    # comment 用 --split_path 读finetune保存的split.npz时，学生和教师用的是同一个验证集
+    keys = ('texts', 'img_features', 'labels', 'label_masks', 'key_attrs')
+    merged = {key: fine_data[key] + coarse_to_fine_data[key] for key in keys}
+    merged['texts'] = list(map(delete_word, merged['texts']))
+    corpus = SharedMatchCorpus(**merged)
+    train_idxs , test_idxs = split_indices(len(fine_data['texts']), opt.test_rate, num_total = len(corpus), split_path = opt.split_path)
+    save_split(os.path.join(opt.output_root, 'split.npz'), train_idxs, test_idxs)
+    # comment 教师概率缓存里的src_idx是训练集内的下标，数据文件或划分变了就对不上图像特征，记下来给open_if_match比较
+    data_info = {
+        'data_files': [[os.path.normpath(path), os.path.getsize(path)] for path in (fine_train_path, coarse_train_path)],
+        'train_idxs_sha1': hashlib.sha1(np.asarray(train_idxs, dtype=np.int64).tobytes()).hexdigest(),
+    }
+    return corpus.view(train_idxs) , corpus.view(test_idxs) , data_info
+
+def build_match_dataset(tokenizer, split, key_attr_values, label2id, color_set, **kwargs):
+    return MatchDataset_v2(
+        tokenizer = tokenizer ,
+        key_attr_values = key_attr_values ,
+        label2id = label2id ,
+        color_set = color_set ,
+        **split ,
+        **kwargs
+    )
+
+def build_teacher(opt, tokenizer, device):
+    predictors = [Predictor(*load_finetune_model(path), tokenizer, device=device, batch_size=opt.batch_size) for path in opt.teacher_paths]
+    if len(predictors) == 1:
+        return predictors[0]
+    model_weights = opt.teacher_weights if opt.teacher_weights is not None else [1.0] * len(predictors)
+    weights = build_ensemble_weights(load_label_list(), model_weights, load_attr_weights(opt.attr_weights))
+    return EnsemblePredictor(predictors, tokenizer, weights, batch_size=opt.batch_size, num_workers=len(predictors))
+
+def build_teacher_store(opt, teacher, train_dataset, data_info, output_dim=13):
+    # comment 训练时的增强是随机的，这里固定种子把训练集展开num_views遍(文本增强和训练一致，不打乱feature)，
+    #   每一遍的样本和教师概率一起落盘，之后每个epoch直接读，不用再跑教师模型
+    num = len(train_dataset) * opt.num_views
+    store = TeacherStore.create(opt.store_root, num, train_dataset.max_len, output_dim=output_dim, teacher_paths=list(opt.teacher_paths), num_views=opt.num_views, seed=opt.seed, **data_info)
+    since , pos = time.time() , 0
+    for view in range(opt.num_views):
+        random.seed(opt.seed + view)
+        np.random.seed(opt.seed + view)
+        torch.manual_seed(opt.seed + view)
+        for start in range(0, len(train_dataset), opt.batch_size):
+            idxs = list(range(start, min(start + opt.batch_size, len(train_dataset))))
+            items = [train_dataset[i] for i in idxs]
+            batch = {key: torch.stack([item[key] for item in items]) for key in items[0]}
+            teacher_probs = teacher.forward(batch)
+            store.write(pos, {
+                'input_ids'      : batch['input_ids'].numpy(),
+                'attention_mask' : batch['attention_mask'].numpy(),
+                'token_type_ids' : batch['token_type_ids'].numpy(),
+                'labels'         : batch['labels'].numpy(),
+                'label_masks'    : batch['label_masks'].numpy(),
+                'teacher_probs'  : teacher_probs.numpy(),
+                'src_idx'        : np.asarray(idxs, dtype=np.int64),
+            })
+            pos += len(idxs)
+        print('教师概率 view %d/%d 完成, 累计 %d 条, 用时 %.2f min' % (view + 1, opt.num_views, pos, (time.time() - since) / 60))
+    store.finish()
+    return TeacherStore.open(opt.store_root)
+
+def build_student(opt):
+    from transformers import LxmertConfig
+    from lxmert import MyLxmertFinetune
+    config = LxmertConfig.from_json_file(os.path.join(opt.student_config_path, 'config.json'))
+    config.l_layers , config.x_layers , config.r_layers = opt.student_l_layers , opt.student_x_layers , opt.student_r_layers
+    config.hidden_size , config.num_attention_heads = opt.student_hidden_size , opt.student_heads
+    config.intermediate_size = opt.student_hidden_size * 4
+    student = MyLxmertFinetune(config, output_dim=13)
+    if opt.student_init_path is not None:
+        # comment 名字和形状都一致的参数直接拷贝(例如hidden_size不变时拷贝前几层)，其余随机初始化
+        state_dict = load_state_dict(find_weights(opt.student_init_path))
+        own_state = student.state_dict()
+        matched = {key: value for key, value in state_dict.items() if key in own_state and own_state[key].shape == value.shape}
+        student.load_state_dict(matched, strict=False)
+        print('学生模型从 %s 初始化了 %d/%d 个参数' % (opt.student_init_path, len(matched), len(own_state)))
+    return student
+
+def distill_loss(output, labels, teacher_probs, alpha=0.7, temperature=1.0, eps=1e-6):
+    # comment 硬标签和finetune一样: 图文 + 属性两项BCE; 软标签在logit上除以温度后做BCE
+    hard_loss = F.binary_cross_entropy(output[:,0], labels[:,0]) + F.binary_cross_entropy(output[:,1:], labels[:,1:])
+    student_logits = torch.logit(output, eps=eps) / temperature
+    soft_targets = torch.sigmoid(torch.logit(teacher_probs, eps=eps) / temperature)
+    soft_loss = F.binary_cross_entropy_with_logits(student_logits, soft_targets) * temperature ** 2
+    return alpha * soft_loss + (1 - alpha) * hard_loss , hard_loss , soft_loss
+
+def count_parameters(model):
+    return sum(param.numel() for param in model.parameters())
+
+def timed_predict(predictor, frozen):
+    since = time.time()
+    probs = predictor.predict_batches(frozen)
+    return probs , (time.time() - since) * 1000 / frozen['input_ids'].shape[0]
+
+def save_model(model, tokenizer, opt, saver):
+    saver.save(model, tokenizer, opt.output_root, weights_name=WEIGHTS_NAMES[opt.save_format])
+
+def train(opt):
+    from transformers import BertTokenizer
+    seed_everything(opt.seed)
+    device = 'cuda:%d' % (opt.gpu) if opt.gpu >= 0 and torch.cuda.is_available() else 'cpu'
+    tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path= opt.tokenizer_path)
+    label2id = {label: i for i, label in enumerate(load_label_list())}
+    with open(os.path.join('./data','attr_to_attrvals.json'), 'r') as f:
+        key_attr_values = json.loads(f.read())
+    with open('./color.txt','r') as f:
+        color_set = set(line[:-1] for line in f.readlines())
+
+    train_split , test_split , data_info = load_corpus(opt)
+    # comment 验证集和finetune一样的增强参数，固定种子展开一次，教师和学生在同一份数据上比较
+    frozen_val = freeze_dataset(build_match_dataset(tokenizer, test_split, key_attr_values, label2id, color_set, p6=-1, p7=-1), seed=opt.seed)
+    teacher = build_teacher(opt, tokenizer, device)
+    teacher_probs , teacher_ms = timed_predict(teacher, frozen_val)
+    teacher_score = score_outputs(teacher_probs, frozen_val['labels'], frozen_val['label_masks'])
+    print('教师模型 score %.4f (it %.4f attr %.4f) , %.3f ms/条' % (teacher_score + (teacher_ms,)))
+
+    train_dataset = build_match_dataset(tokenizer, train_split, key_attr_values, label2id, color_set, p7=-1)
+    store = None if opt.rebuild_store else TeacherStore.open_if_match(
+        opt.store_root,
+        teacher_paths = list(opt.teacher_paths),
+        num_views = opt.num_views,
+        seed = opt.seed,
+        num = len(train_dataset) * opt.num_views,
+        seq_len = train_dataset.max_len,
+        output_dim = teacher_probs.shape[1],
+        **data_info,
+    )
+    if store is None:
+        store = build_teacher_store(opt, teacher, train_dataset, data_info, output_dim=teacher_probs.shape[1])
+    teacher_predictors = teacher.predictors if isinstance(teacher, EnsemblePredictor) else [teacher]
+    teacher_params = sum(count_parameters(predictor.model) for predictor in teacher_predictors)
+    if isinstance(teacher, EnsemblePredictor):
+        teacher.close()
+    del teacher , teacher_predictors
+    torch.cuda.empty_cache()
+
+    train_dataloader = DataLoader(DistillDataset(store, train_split['visual_embeds']), shuffle=True, batch_size=opt.batch_size, num_workers=opt.num_workers)
+    student = build_student(opt).to(device)
+    student_predictor = Predictor(student, 'lxmert', tokenizer, device=device, batch_size=opt.batch_size)
+    total_update_step = opt.epochs * get_update_steps(len(train_dataloader), opt.grad_accum_steps)
+    optim , scheduler = build_optimizer(opt , student , total_update_step)
+    best_score , record_epoch_arr = float('-inf') , []
+    saver = ModelSaver()
+    profiler = build_profiler(opt, os.path.join(opt.output_root, 'profile'))
+    profiler.start()
+    for epoch in range(opt.epochs):
+        since = time.time()
+        student.train()
+        optim.zero_grad()
+        for step , batch in enumerate(train_dataloader):
+            output = student(
+                input_ids = batch['input_ids'].to(device),
+                visual_feats = batch['visual_embeds'].to(device),
+                attention_mask = batch['attention_mask'].to(device),
+                visual_attention_mask = batch['visual_attention_mask'].to(device),
+                token_type_ids = batch['token_type_ids'].to(device),
+            )
+            loss , hard_loss , soft_loss = distill_loss(output, batch['labels'].to(device), batch['teacher_probs'].to(device), alpha=opt.alpha, temperature=opt.temperature)
+            (loss / get_accum_size(step, len(train_dataloader), opt.grad_accum_steps)).backward()
+            if (step + 1) % opt.grad_accum_steps == 0 or step + 1 == len(train_dataloader):
+                optim.step()
+                scheduler.step()
+                optim.zero_grad()
+            profiler.step()
+
+        student.eval()
+        student_probs = student_predictor.predict_batches(frozen_val)
+        total_scores , img_text_scores , attr_scores = score_outputs(student_probs, frozen_val['labels'], frozen_val['label_masks'])
+        agreement = ((student_probs >= 0.5) == (teacher_probs >= 0.5)).float().mean().item()
+        is_save_model = 0
+        if total_scores > best_score:
+            best_score , is_save_model = total_scores , 1
+            save_model(student, tokenizer, opt, saver)
+        using_time = (time.time() - since) / 60
+        print('E%d(t %.2f min) score %.4f (it %.4f attr %.4f) teacher %.4f agree %.4f loss %.6f (hard %.6f soft %.6f) SaveMode %d.'\
+            %(epoch , using_time , total_scores , img_text_scores , attr_scores , teacher_score[0] , agreement , loss.item() , hard_loss.item() , soft_loss.item() , is_save_model))
+        record_epoch_arr.append([total_scores , img_text_scores , attr_scores , agreement])
+
+    profiler.stop()
+    saver.close()
+    print('#'*25,' 蒸馏完毕' , '#'*25)
+    # comment 用最优的学生模型和教师在同一份验证集上比较分数和推理开销
+    student , _ = load_finetune_model(opt.output_root, model_type='lxmert')
+    student_predictor = Predictor(student, 'lxmert', tokenizer, device=device, batch_size=opt.batch_size)
+    student_probs , student_ms = timed_predict(student_predictor, frozen_val)
+    student_score = score_outputs(student_probs, frozen_val['labels'], frozen_val['label_masks'])
+    report = {
+        'teacher_paths': opt.teacher_paths,
+        'teacher_score': [round(score, 6) for score in teacher_score],
+        'student_score': [round(score, 6) for score in student_score],
+        'score_recovered': round(student_score[0] / teacher_score[0], 4),
+        'teacher_params': teacher_params,
+        'student_params': count_parameters(student),
+        'teacher_ms_per_sample': round(teacher_ms, 4),
+        'student_ms_per_sample': round(student_ms, 4),
+        'speedup': round(teacher_ms / student_ms, 2),
+    }
+    with open(os.path.join(opt.output_root, 'distill_report.json'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(report, indent=2, ensure_ascii=False))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    np.save(os.path.join(opt.output_root, 'static-distill.npy'), record_epoch_arr)
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed',type = int, default=25, help='random seed')
+    parser.add_argument('--mode',type=str,default='train',help='train:正式训练; test:代码测试阶段')
+    parser.add_argument('--tokenizer_path',type=str,default = './lxmert_model/pretrain/' ,help='tokenizer path')
+    parser.add_argument('--data_root',type = str , default='./data/',help='数据根路径')
+    parser.add_argument('--output_root',type = str , default='./lxmert_model/distill/',help = '学生模型输出路径' )
+    parser.add_argument('--save_format',type=str,default='safetensors',choices=['safetensors','bin'],help='模型权重格式, safetensors: model.safetensors(mmap加载, 启动快); bin: pytorch_model.bin')
+    parser.add_argument('--teacher_paths',type=str,nargs='+',required=True,help='教师模型目录, 多个时按融合概率作为软标签')
+    parser.add_argument('--teacher_weights',type=float,nargs='+',default=None,help='教师融合时各模型的权重, 默认等权')
+    parser.add_argument('--attr_weights',type=str,default=None,help='教师融合时各模型每个属性的权重, 格式同run_predict.py')
+    parser.add_argument('--store_root',type=str,default='./lxmert_model/distill/teacher_store/',help='教师概率memmap的存储路径, 已存在时直接复用')
+    parser.add_argument('--rebuild_store',action='store_true',help='重新生成教师概率')
+    parser.add_argument('--num_views',type=int,default=4,help='训练集按不同种子增强展开几遍')
+    parser.add_argument('--student_config_path',type=str,default='./lxmert_model/pretrain/',help='学生模型的config模板(vocab等)')
+    parser.add_argument('--student_init_path',type=str,default=None,help='用该模型中名字和形状一致的参数初始化学生')
+    parser.add_argument('--student_l_layers',type=int,default=2)
+    parser.add_argument('--student_x_layers',type=int,default=2)
+    parser.add_argument('--student_r_layers',type=int,default=1)
+    parser.add_argument('--student_hidden_size',type=int,default=384)
+    parser.add_argument('--student_heads',type=int,default=6)
+    parser.add_argument('--alpha',type=float,default=0.7,help='软标签loss的权重, 硬标签为 1 - alpha')
+    parser.add_argument('--temperature',type=float,default=2.0)
+    parser.add_argument('--num_workers',type =int,default=16)
+    parser.add_argument('--test_rate',type = float,default=0.2 , help='验证集的比例')
+    parser.add_argument('--split_path',type=str,default=None,help='复用finetune保存的训练/测试集划分(split.npz), 不设置时按test_rate重新划分')
+    parser.add_argument('--epochs',type=int,default=30)
+    parser.add_argument('--lr',type=float,default=2e-4)
+    parser.add_argument('--small_lr',type=float,default=2e-4)
+    parser.add_argument('--batch_size',type = int,default=512)
+    parser.add_argument('--weight_decay', type=float, default=1e-4, help='weight_decay')
+    parser.add_argument('--gpu',type = int, default=0,help='GPU, -1 表示使用cpu')
+    parser.add_argument('--warmup_ratio', type=float, default=0.1, help='warmup_ratio')
+    parser.add_argument('--grad_accum_steps',type = int, default=1, help='梯度累积步数, 等效batch = batch_size * grad_accum_steps')
+    parser.add_argument('--profile',action='store_true',help='用torch.profiler记录一段训练step, tensorboard trace和top-N算子表写到output_root/profile')
+    parser.add_argument('--profile_wait',type=int,default=5,help='profile: 跳过前多少个训练step')
+    parser.add_argument('--profile_steps',type=int,default=5,help='profile: 记录多少个训练step')
+    parser.add_argument('--profile_top',type=int,default=30,help='profile: 算子表的行数')
+    parser.add_argument('--profile_with_stack',action='store_true',help='profile: 记录python调用栈, 可以看到算子属于哪个模块')
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    train(opt)
@@ -0,0 +1,120 @@
+
+import os
+import time
+import shutil
+import argparse
+
+import numpy as np
+import torch
+
+from predictor import (
+    Predictor,
+    OnnxPredictor,
+    load_finetune_model,
+    split_model_path,
+    iter_samples,
+    iter_chunks,
+    ForwardWrapper,
+    MODEL_TYPES,
+    ONNX_NAME,
+    ONNX_INPUT_NAMES,
+)
+from model_avg import WEIGHTS_NAME , SAFE_WEIGHTS_NAME
+from datasets import delete_word
+
+
+def load_check_texts(test_path, num):
+    if test_path is None:
+        # comment 没有测试集时用几条长短不一的假title，只要覆盖到不同的batch和seq长度即可
+        return ['%s女装' % ('高领长袖修身' * (i % 5 + 1)) for i in range(num)]
+    samples = next(iter_chunks(iter_samples(test_path), num))
+    return [delete_word(sample['title']) for sample in samples]
+
+def export_onnx(model, model_type, batch, onnx_path, opset_version=14):
+    input_names = ONNX_INPUT_NAMES[model_type]
+    dynamic_axes = {'probs': {0: 'batch'}}
+    for name in input_names:
+        dynamic_axes[name] = {0: 'batch', 1: 'seq'} if name in ('input_ids', 'attention_mask', 'token_type_ids') else {0: 'batch'}
+    with torch.no_grad():
+        torch.onnx.export(
+            ForwardWrapper(model, model_type).eval(),
+            tuple(batch[name] for name in input_names),
+            onnx_path,
+            input_names=list(input_names),
+            output_names=['probs'],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+
+def check_parity(torch_predictor, onnx_predictor, texts, batch_sizes, atol=1e-4):
+    # comment 用不同的batch大小和文本长度对比pytorch和onnxruntime的输出
+    max_diff = 0.0
+    for batch_size in batch_sizes:
+        for start in range(0, len(texts), batch_size):
+            batch_texts = texts[start:start + batch_size]
+            features = np.random.randn(len(batch_texts), 2048).astype(np.float32)
+            batch = torch_predictor.collate(batch_texts, features)
+            diff = (torch_predictor.forward(batch) - onnx_predictor.forward(batch)).abs().max().item()
+            max_diff = max(max_diff, diff)
+    print('onnx 和 pytorch 输出最大误差 %.3e (atol %.1e)' % (max_diff, atol))
+    assert max_diff <= atol, 'onnx 输出和 pytorch 不一致'
+    return max_diff
+
+def benchmark(predictor, texts, repeat=5):
+    batch = predictor.collate(texts, np.random.randn(len(texts), 2048).astype(np.float32))
+    predictor.forward(batch)
+    since = time.time()
+    for _ in range(repeat):
+        predictor.forward(batch)
+    return (time.time() - since) / repeat * 1000
+
+def main(opt):
+    from transformers import BertTokenizer
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+    model_dir , _ = split_model_path(opt.model_path)
+    tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path= opt.tokenizer_path or model_dir)
+    model , model_type = load_finetune_model(opt.model_path, model_type=opt.model_type)
+    torch_predictor = Predictor(model, model_type, tokenizer, device='cpu', max_len=opt.max_len)
+
+    os.makedirs(opt.output_root, exist_ok=True)
+    onnx_path = os.path.join(opt.output_root, ONNX_NAME)
+    texts = load_check_texts(opt.test_path, opt.num_check)
+    since = time.time()
+    export_onnx(model, model_type, torch_predictor.collate(texts[:2], np.zeros((2, 2048), dtype=np.float32)), onnx_path, opset_version=opt.opset)
+    # comment config和词表一起拷过去，run_predict.py --backend onnx 可以直接用这个目录
+    for file_name in os.listdir(model_dir):
+        src = os.path.join(model_dir, file_name)
+        if file_name not in (WEIGHTS_NAME, SAFE_WEIGHTS_NAME) and os.path.isfile(src):
+            shutil.copy(src, os.path.join(opt.output_root, file_name))
+    print('%s 模型导出到 %s , 用时 %.2f s' % (model_type, onnx_path, time.time() - since))
+
+    if opt.check:
+        onnx_predictor = OnnxPredictor(onnx_path, model_type, tokenizer, max_len=opt.max_len, num_threads=opt.num_threads)
+        check_parity(torch_predictor, onnx_predictor, texts, batch_sizes=(1, 7, 32), atol=opt.atol)
+        bench_texts = [texts[i % len(texts)] for i in range(opt.bench_batch_size)]
+        torch_ms , onnx_ms = benchmark(torch_predictor, bench_texts) , benchmark(onnx_predictor, bench_texts)
+        print('batch %d : pytorch %.2f ms , onnxruntime %.2f ms , 加速 %.2fx' % (opt.bench_batch_size, torch_ms, onnx_ms, torch_ms / onnx_ms))
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path',type=str,required=True,help='finetune模型目录或权重文件(pytorch_model.bin/model.safetensors)路径')
+    parser.add_argument('--model_type',type=str,default='auto',choices=('auto',) + MODEL_TYPES,help='auto: 根据config.json判断')
+    parser.add_argument('--tokenizer_path',type=str,default=None,help='默认和model_path同目录')
+    parser.add_argument('--output_root',type=str,required=True,help='导出目录, 写入model.onnx和config/词表')
+    parser.add_argument('--opset',type=int,default=14)
+    parser.add_argument('--max_len',type=int,default=35)
+    parser.add_argument('--num_threads',type=int,default=0,help='cpu线程数, 0 表示默认')
+    parser.add_argument('--check',action='store_true',help='导出后用onnxruntime对比pytorch输出并测速')
+    parser.add_argument('--test_path',type=str,default=None,help='对比用的样本, 不设置则用假title')
+    parser.add_argument('--num_check',type=int,default=64)
+    parser.add_argument('--atol',type=float,default=1e-4)
+    parser.add_argument('--bench_batch_size',type=int,default=64)
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    main(opt)
@@ -4,23 +4,20 @@ import json
 import torch
 import torch.nn as nn
 from copy import deepcopy
-from helper import  build_optimizer 
-from lxmert import  MyLxmertFinetune
+from helper import  build_optimizer , enable_gradient_checkpointing , get_update_steps , build_weight_averager , build_step_timer , build_profiler , build_memory_reporter , ModelSaver , shadow_weights , get_accum_size
+from model_avg import average_checkpoints , write_score , WEIGHTS_NAMES
 from torch.utils.data import DataLoader
-from sklearn.model_selection import KFold
-from datasets import MatchDataset_v2 , delete_word
+from datasets import MatchDataset_v2 , delete_word , SharedMatchCorpus , TokenCache , save_split
 import argparse
-from transformers import (
-    BertTokenizer,
-    set_seed,
-)
 import os
 import gc
 import random 
+from multiprocessing.connection import wait
 
 
 device = 'cuda'
 def seed_everything(seed):
+    from transformers import set_seed
     set_seed(seed)
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
@@ -31,8 +28,10 @@ def seed_everything(seed):
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
 
-def train(opt):
-    seed_everything(opt.seed)
+def load_data(opt):
+    from lxmert import MyLxmertFinetune
+    from transformers import BertTokenizer
+    memory = build_memory_reporter(opt)
     tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path= opt.tokenizer_path)
 
     color_set = set()
@@ -67,96 +66,134 @@ def train(opt):
         coarse_to_fine_data = json.loads(f.read())
     coarse_to_fine_texts, coarse_to_fine_img_features, coarse_to_fine_labels, coarse_to_fine_label_masks, coarse_to_fine_key_attrs = \
         coarse_to_fine_data['texts'], coarse_to_fine_data['img_features'], coarse_to_fine_data['labels'], coarse_to_fine_data['label_masks'], coarse_to_fine_data['key_attrs']
+    memory.phase('read_json', fine_data = fine_data, coarse_to_fine_data = coarse_to_fine_data)
 
   
     fine_texts = list(map(delete_word,fine_texts))
     coarse_to_fine_texts = list(map(delete_word,coarse_to_fine_texts))
 
-    data_texts          = np.array(fine_texts + coarse_to_fine_texts)
-    data_img_features   = np.array(fine_img_features + coarse_to_fine_img_features)
-    data_labels         = np.array(fine_labels + coarse_to_fine_labels)
-    data_label_masks    = np.array(fine_label_masks + coarse_to_fine_label_masks)
-    data_key_attrs      = np.array(fine_key_attrs + coarse_to_fine_key_attrs)
+    # comment 语料只加载一次放进共享内存，每一折只是索引视图，worker之间共享同一份特征
+    corpus = SharedMatchCorpus(
+        texts           = fine_texts + coarse_to_fine_texts,
+        img_features    = fine_img_features + coarse_to_fine_img_features,
+        labels          = fine_labels + coarse_to_fine_labels,
+        label_masks     = fine_label_masks + coarse_to_fine_label_masks,
+        key_attrs       = fine_key_attrs + coarse_to_fine_key_attrs,
+    )
+    del fine_data , coarse_to_fine_data , fine_img_features , coarse_to_fine_img_features
+    gc.collect()
+    memory.phase('corpus', texts = corpus.texts, visual_embeds = corpus.visual_embeds, labels = corpus.labels,
+        label_masks = corpus.label_masks, key_attrs = corpus.key_attrs)
+    token_cache = TokenCache(tokenizer, corpus.texts, max_len = corpus.max_text_len() + 2)
+    print('加载数据完成 %.2f min。 总量 %d.'%((time.time()-since)/ 60,len(corpus)))
 
-    folder = KFold(n_splits=opt.kfold,shuffle=False)   # 只对fine_data 进行分折
-    splits = folder.split([i for i in range(len(data_texts))])
-    
+    # comment 各折共用同一份初始权重(包括随机初始化的cls层)，便于最后做参数融合
     mylxmert_orgin = MyLxmertFinetune.from_pretrained(opt.pretrain_model_path  , output_dim = 13)
+    memory.phase('model', model = mylxmert_orgin)
+    memory.save(opt.output_root, 'memory-load.json')
+    return {
+        'tokenizer'         : tokenizer,
+        'corpus'            : corpus,
+        'token_cache'       : token_cache,
+        'label2id'          : label2id,
+        'key_attr_values'   : key_attr_values,
+        'color_set'         : color_set,
+        'init_model'        : mylxmert_orgin,
+    }
 
+def train_fold(opt, fold_idx, train_idxs, test_idxs, data):
+    # comment 每一折用自己的种子，顺序跑和多进程并行跑(--concurrency)的结果一致
+    seed_everything(opt.seed + fold_idx)
+    device = opt.device
+    memory = build_memory_reporter(opt)
+    tokenizer , corpus , token_cache = data['tokenizer'] , data['corpus'] , data['token_cache']
+    label2id , key_attr_values , color_set = data['label2id'] , data['key_attr_values'] , data['color_set']
 
-    for fold_idx , (train_idxs , test_idxs) in enumerate(splits):
-        torch.cuda.empty_cache()
-        train_texts         , test_texts            = data_texts[train_idxs]        , data_texts[test_idxs]
-        train_img_features  , test_img_features     = data_img_features[train_idxs] , data_img_features[test_idxs]
-        train_labels        , test_labels           = data_labels[train_idxs]       , data_labels[test_idxs]
-        train_label_masks   , test_label_masks      = data_label_masks[train_idxs]  , data_label_masks[test_idxs]
-        train_key_attrs     , test_key_attrs        = data_key_attrs[train_idxs]    , data_key_attrs[test_idxs]
-
-        train_dataset = MatchDataset_v2(
-            tokenizer = tokenizer , 
-            texts = train_texts , 
-            labels = train_labels , 
-            visual_embeds = train_img_features , 
-            label_masks = train_label_masks , 
-            key_attrs = train_key_attrs , 
-            key_attr_values = key_attr_values , 
-            label2id = label2id,
-            color_set = color_set,
-            max_len = max([len(text) for text in train_texts]),
-        )
-        test_dataset = MatchDataset_v2(
-            tokenizer = tokenizer , 
-            texts = test_texts , 
-            labels = test_labels , 
-            visual_embeds = test_img_features , 
-            label_masks = test_label_masks , 
-            key_attrs = test_key_attrs , 
-            key_attr_values = key_attr_values , 
-            label2id = label2id,
-            p6  = -1,     
-            p7  = -1,
-            color_set = color_set,
-            max_len = max([len(text) for text in test_texts]),
-        )
-        print('训练集总量 %d 测试集总量 %d'%(len(train_dataset),len(test_dataset)))
-        train_dataloader = DataLoader(train_dataset, shuffle=True, batch_size=opt.batch_size, num_workers=opt.num_workers)
-        test_dataloader = DataLoader(test_dataset, batch_size=opt.batch_size, num_workers=opt.num_workers)
-        mylxmert = deepcopy(mylxmert_orgin)
-        mylxmert.to(device)
+    torch.cuda.empty_cache()
+    train_dataset = MatchDataset_v2(
+        tokenizer = tokenizer , 
+        key_attr_values = key_attr_values , 
+        label2id = label2id,
+        color_set = color_set,
+        max_len = corpus.max_text_len(train_idxs),
+        token_cache = token_cache,
+        **corpus.view(train_idxs),
+    )
+    test_dataset = MatchDataset_v2(
+        tokenizer = tokenizer , 
+        key_attr_values = key_attr_values , 
+        label2id = label2id,
+        p6  = -1,     
+        p7  = -1,
+        color_set = color_set,
+        max_len = corpus.max_text_len(test_idxs),
+        token_cache = token_cache,
+        **corpus.view(test_idxs),
+    )
+    print('训练集总量 %d 测试集总量 %d'%(len(train_dataset),len(test_dataset)))
+    # comment worker在各个epoch之间常驻，不再每个epoch重新fork
+    train_dataloader = DataLoader(train_dataset, shuffle=True, batch_size=opt.batch_size, num_workers=opt.num_workers, persistent_workers=opt.num_workers > 0)
+    test_dataloader = DataLoader(test_dataset, batch_size=opt.batch_size, num_workers=opt.num_workers, persistent_workers=opt.num_workers > 0)
+    mylxmert = deepcopy(data['init_model'])
+    mylxmert.to(device)
+    if opt.gradient_checkpointing:
+        enable_gradient_checkpointing(mylxmert)
 
-        criterion =  nn.BCELoss()
-        total_update_step = opt.epochs * len(train_dataloader)
-        optim , scheduler = build_optimizer(opt , mylxmert ,total_update_step )
-        record_epoch_arr = []
-        best_score , min_loss = float('-inf') , float('inf')
-        for epoch in range(opt.epochs):
-            since = time.time() 
-            mylxmert.train()
-            for _ , batch in enumerate(train_dataloader):
-                input_ids               = batch['input_ids'].to(device)                 # shape [batch_size,seq_len]
-                attention_mask          = batch['attention_mask'].to(device)
-                token_type_ids          = batch['token_type_ids'].to(device)            # shape [batch_size,seq_len]
-                visual_embeds           = batch['visual_embeds'].to(device)             # shape [batch_size, feat_num, feat_dim]
-                visual_attention_mask   = batch['visual_attention_mask'].to(device)     # shape [batch_size, feat_num]
-                labels                  = batch['labels'].to(device)                    # shape [batch_size, 13]
-                output = mylxmert(
-                    input_ids = input_ids,
-                    visual_feats = visual_embeds,
-                    attention_mask = attention_mask,
-                    visual_attention_mask = visual_attention_mask,
-                    token_type_ids = token_type_ids,
-                )   
-                optim.zero_grad()
-                imgtxt_loss = criterion(output[:,0],labels[:,0])
-                attr_loss = criterion(output[:,1:],labels[:,1:])
-                loss = imgtxt_loss + attr_loss
-                loss.backward()
+    criterion =  nn.BCELoss()
+    total_update_step = opt.epochs * get_update_steps(len(train_dataloader), opt.grad_accum_steps)
+    optim , scheduler = build_optimizer(opt , mylxmert ,total_update_step )
+    weight_avg = build_weight_averager(opt , mylxmert , total_update_step)
+    record_epoch_arr = []
+    best_score , min_loss = float('-inf') , float('inf')
+    saver = ModelSaver()
+    timer = build_step_timer(opt)
+    profiler = build_profiler(opt, os.path.join(opt.output_root, 'profile', 'fold%d'%(fold_idx)))
+    profiler.start()
+    memory.phase('fold%d'%(fold_idx), model = mylxmert)
+    memory.watch_workers()
+    for epoch in range(opt.epochs):
+        since = time.time() 
+        mylxmert.train()
+        optim.zero_grad()
+        timer.start()
+        for step , batch in enumerate(train_dataloader):
+            timer.lap('data')
+            input_ids               = batch['input_ids'].to(device)                 # shape [batch_size,seq_len]
+            attention_mask          = batch['attention_mask'].to(device)
+            token_type_ids          = batch['token_type_ids'].to(device)            # shape [batch_size,seq_len]
+            visual_embeds           = batch['visual_embeds'].to(device)             # shape [batch_size, feat_num, feat_dim]
+            visual_attention_mask   = batch['visual_attention_mask'].to(device)     # shape [batch_size, feat_num]
+            labels                  = batch['labels'].to(device)                    # shape [batch_size, 13]
+            timer.lap('h2d')
+            output = mylxmert(
+                input_ids = input_ids,
+                visual_feats = visual_embeds,
+                attention_mask = attention_mask,
+                visual_attention_mask = visual_attention_mask,
+                token_type_ids = token_type_ids,
+            )   
+            imgtxt_loss = criterion(output[:,0],labels[:,0])
+            attr_loss = criterion(output[:,1:],labels[:,1:])
+            loss = imgtxt_loss + attr_loss
+            timer.lap('forward')
+            (loss / get_accum_size(step, len(train_dataloader), opt.grad_accum_steps)).backward()
+            timer.lap('backward')
+            if (step + 1) % opt.grad_accum_steps == 0 or step + 1 == len(train_dataloader):
                 optim.step()
                 scheduler.step()
-    
+                optim.zero_grad()
+                if weight_avg is not None:
+                    weight_avg.update(scheduler.last_epoch)
+            timer.lap('optim')
+            timer.end_step()
+            profiler.step()
+
+        # comment 评估和保存都使用影子权重
+        with shadow_weights(weight_avg):
             N_img_text , M_img_text = 0, 0
             N_attr , M_attr = 0 , 0
             eval_losses , eval_img_text_losses , eval_attr_losses = [] , [] , []
+            timer.start()
             with torch.no_grad():
                 mylxmert.eval()
                 for batch in test_dataloader:
@@ -176,19 +213,19 @@ def train(opt):
                     )   
                     img_txt_logit , attr_logit = output[:,0] , output[:,1:]
                     true_img_text , true_attr = labels[:,0] , labels[:,1:]
-       
+   
                     img_text_loss = criterion(img_txt_logit ,true_img_text )
                     attr_loss = criterion(attr_logit ,true_attr )
                     test_loss = img_text_loss + attr_loss
                     eval_losses.append(test_loss)
                     eval_img_text_losses.append(img_text_loss)
                     eval_attr_losses.append(attr_loss)
-                   
+               
                     pred_img_text = torch.zeros_like(output[:,0])
                     pred_img_text[output[:,0] >= 0.5] =1
                     N_img_text += torch.sum(pred_img_text == true_img_text).cpu().numpy().item()
                     M_img_text += torch.sum(torch.ones_like(true_img_text)).cpu().numpy().item()
-                
+            
                     pred_attr =  torch.zeros_like(output[:,1:])
                     pred_attr[output[:,1:] >= 0.5] = 1
                     pred_attr = pred_attr[label_masks[:, 1:] == 1]
@@ -203,25 +240,84 @@ def train(opt):
                 img_text_scores = 0.5 * N_img_text / M_img_text
                 attr_scores = 0.5 * N_attr / M_attr
                 total_scores = img_text_scores + attr_scores
+            timer.lap('eval')
             is_save_model = 0
             if total_scores > best_score :  
                 best_score , is_save_model = total_scores , 1
-                save_model(mylxmert,tokenizer , opt ,fold_idx = fold_idx)
-            using_time = (time.time() - since) / 60
-            print('E%d(t %.2f min) score %.4f (it %.4f attr %.4f) t_l %.6f (it %.6f attr %.6f)  SaveMode %d.'\
-                %(epoch , using_time , total_scores , img_text_scores , attr_scores ,eval_loss , eval_img_text_loss ,eval_attr_loss   , is_save_model))
-            record_epoch_arr.append([ total_scores , img_text_scores , attr_scores ,eval_loss , eval_img_text_loss ,eval_attr_loss])
-        gc.collect()
-        torch.cuda.empty_cache()
+                save_model(mylxmert,tokenizer , opt ,fold_idx = fold_idx , saver = saver , score = best_score)
+        using_time = (time.time() - since) / 60
+        print('F%d E%d(t %.2f min) score %.4f (it %.4f attr %.4f) t_l %.6f (it %.6f attr %.6f)  SaveMode %d.'\
+            %(fold_idx , epoch , using_time , total_scores , img_text_scores , attr_scores ,eval_loss , eval_img_text_loss ,eval_attr_loss   , is_save_model))
+        record_epoch_arr.append([ total_scores , img_text_scores , attr_scores ,eval_loss , eval_img_text_loss ,eval_attr_loss])
+    profiler.stop()
+    # comment 等后台把这一折的模型写完，后面做checkpoint平均时才能读到
+    saver.close()
+    timer.save(opt.output_root, 'step_time-fold%d.json'%(fold_idx))
+    memory.save(opt.output_root, 'memory-fold%d.json'%(fold_idx))
+    # comment 折结束后关掉常驻的worker
+    del train_dataloader , test_dataloader , train_dataset , test_dataset
+    gc.collect()
+    torch.cuda.empty_cache()
+
+def run_fold_worker(opt, fold_idx, train_idxs, test_idxs, data, cpu_cores):
+    # comment 子进程: 绑定cpu核并限制线程数，多折并行时互不抢核
+    if cpu_cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_cores)
+    torch.set_num_threads(opt.threads_per_fold)
+    train_fold(opt, fold_idx, train_idxs, test_idxs, data)
+
+def schedule_folds(opt, folds, data):
+    # comment 同时最多跑 concurrency 个fold，每个fold一个进程，语料张量通过共享内存传给子进程
+    ctx = torch.multiprocessing.get_context('spawn')
+    available_cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    if opt.threads_per_fold <= 0:
+        opt.threads_per_fold = max(1, len(available_cores) // opt.concurrency)
+    pending , running , failed = list(folds) , {} , []
+    free_slots = list(range(opt.concurrency))
+    while pending or running:
+        while pending and free_slots:
+            slot = free_slots.pop(0)
+            fold_idx , train_idxs , test_idxs = pending.pop(0)
+            cpu_cores = available_cores[slot * opt.threads_per_fold : (slot + 1) * opt.threads_per_fold]
+            process = ctx.Process(target=run_fold_worker, args=(opt, fold_idx, train_idxs, test_idxs, data, cpu_cores))
+            process.start()
+            running[slot] = (fold_idx , process)
+            print('启动 fold %d  pid %d  cpu %s'%(fold_idx, process.pid, cpu_cores))
+        finished = wait([process.sentinel for _ , process in running.values()])
+        for slot , (fold_idx , process) in list(running.items()):
+            if process.sentinel in finished:
+                process.join()
+                if process.exitcode != 0:
+                    failed.append(fold_idx)
+                print('fold %d 结束 exitcode %d'%(fold_idx, process.exitcode))
+                del running[slot]
+                free_slots.append(slot)
+    if failed:
+        raise RuntimeError('fold %s 训练失败' % (failed))
+
+def train(opt):
+    from sklearn.model_selection import KFold
+    seed_everything(opt.seed)
+    data = load_data(opt)
+    folder = KFold(n_splits=opt.kfold,shuffle=False)   # 只对fine_data 进行分折
+    splits = folder.split(np.arange(len(data['corpus'])))
+    fold_ids = set(range(opt.kfold)) if opt.folds is None else set(opt.folds)
+    folds = [(fold_idx , train_idxs , test_idxs) for fold_idx , (train_idxs , test_idxs) in enumerate(splits) if fold_idx in fold_ids]
+    # comment 每一折的索引写到output_root, 方便复现和给别的模型复用(--split_path)
+    for fold_idx , train_idxs , test_idxs in folds:
+        save_split(os.path.join(opt.output_root, 'split-fold%d.npz'%(fold_idx)), train_idxs, test_idxs)
+    if opt.concurrency > 1:
+        schedule_folds(opt, folds, data)
+        return
+    for fold_idx , train_idxs , test_idxs in folds:
+        train_fold(opt, fold_idx, train_idxs, test_idxs, data)
 
-def save_model(model,tokenizer,opt,fold_idx):
+def save_model(model,tokenizer,opt,fold_idx,saver,score=None):
     dir_path = os.path.join(opt.output_root,'kfold-%d/'%(fold_idx))  
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-    model_to_save = model.module if hasattr(model, 'module') else model
-    torch.save(model_to_save.state_dict(), os.path.join(dir_path, 'pytorch_model.bin'))
-    model_to_save.config.to_json_file( os.path.join(dir_path, 'config.json'))
-    tokenizer.save_vocabulary(dir_path)
+    saver.save(model, tokenizer, dir_path, weights_name=WEIGHTS_NAMES[opt.save_format])
+    if score is not None:
+        # comment 分数排在模型后面写，average_checkpoints读到的分数和权重对应
+        saver.submit(write_score, dir_path, score)
 
 
 def parse_opt():
@@ -232,6 +328,7 @@ def parse_opt():
     parser.add_argument('--pretrain_model_path',type=str,default = './lxmert_model/pretrain/' ,help='pretrain model path') 
     parser.add_argument('--data_root',type = str , default='./data/',help='数据根路径')
     parser.add_argument('--output_root',type = str , default='./lxmert_model/kfold/',help = '输出根路径' )
+    parser.add_argument('--save_format',type=str,default='safetensors',choices=['safetensors','bin'],help='模型权重格式, safetensors: model.safetensors(mmap加载, 启动快); bin: pytorch_model.bin')
     parser.add_argument('--num_workers',type =int,default=16)
     parser.add_argument('--epochs',type=int,default=50)
     parser.add_argument('--lr',type=float,default=12e-5)
@@ -240,28 +337,35 @@ def parse_opt():
     parser.add_argument('--weight_decay', type=float, default=1e-4, help='weight_decay')
     parser.add_argument('--gpu',type = int, default=1,help='GPU')
     parser.add_argument('--warmup_ratio', type=float, default=0.1, help='warmup_ratio')
+    parser.add_argument('--grad_accum_steps',type = int, default=1, help='梯度累积步数, 等效batch = batch_size * grad_accum_steps')
+    parser.add_argument('--gradient_checkpointing',action='store_true', help='encoder各层开启activation checkpointing, 省显存')
+    parser.add_argument('--weight_avg',type=str,default='none',choices=['none','ema','swa'],help='影子权重: ema 指数滑动平均, swa 等权平均; 评估和保存都用影子权重')
+    parser.add_argument('--ema_decay',type=float,default=0.999,help='ema衰减率')
+    parser.add_argument('--swa_start',type=float,default=0.5,help='swa从总更新步数的多少比例开始平均')
     parser.add_argument('--kfold',type = int , default=8 , help= '分多少折' )
+    parser.add_argument('--device',type=str,default=device,help='cuda 或 cpu')
+    parser.add_argument('--folds',type=int,nargs='*',default=None,help='只跑指定的fold, 默认全部')
+    parser.add_argument('--concurrency',type=int,default=1,help='同时训练的fold数, >1 时每个fold一个进程')
+    parser.add_argument('--threads_per_fold',type=int,default=0,help='每个fold进程的torch线程数, 0 表示按concurrency均分cpu核')
+    parser.add_argument('--avg_weighting',type=str,default='uniform',choices=['uniform','score'],help='参数融合方式: uniform 等权; score 按各折最好成绩加权')
+    parser.add_argument('--step_timing',action='store_true',help='按step记录 等数据/拷贝/前向/反向/优化器/评估 的耗时, 训练结束把分位数写到output_root')
+    parser.add_argument('--trace_steps',type=int,nargs='+',default=None,help='这些step的计时另外导出成chrome trace')
+    parser.add_argument('--profile',action='store_true',help='用torch.profiler记录一段训练step, tensorboard trace和top-N算子表写到output_root/profile')
+    parser.add_argument('--profile_wait',type=int,default=5,help='profile: 跳过前多少个训练step')
+    parser.add_argument('--profile_steps',type=int,default=5,help='profile: 记录多少个训练step')
+    parser.add_argument('--profile_top',type=int,default=30,help='profile: 算子表的行数')
+    parser.add_argument('--profile_with_stack',action='store_true',help='profile: 记录python调用栈, 可以看到算子属于哪个模块')
+    parser.add_argument('--memory_report',action='store_true',help='每个加载阶段后打印rss和各数据结构的大小, 训练时定时记录DataLoader worker的rss/pss, 结束后写到output_root')
+    parser.add_argument('--memory_interval',type=float,default=30.0,help='memory_report: worker内存的采样间隔(秒)')
     opt = parser.parse_args()
     return opt 
 
 def model_param_avg(opt):
-    state_dict_list = []
-    import collections
-    for k in range(opt.kfold):
-        state_dict_list.append(torch.load(os.path.join(opt.output_root,'kfold-%d'%(k),'pytorch_model.bin'),map_location = torch.device('cpu')))
-    merge_state_dict = collections.OrderedDict()
-    for key in state_dict_list[0].keys():
-        merge_state_dict[key] = sum([state_dict_list[k][key] for k in range(opt.kfold)]) / opt.kfold
-    dir_path = os.path.join(opt.output_root)
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-    torch.save(merge_state_dict, os.path.join(dir_path,'pytorch_model.bin'))
-    print('融合模型存储路径 : ',dir_path)
-    global_model = MyLxmertFinetune.from_pretrained(opt.pretrain_model_path,output_dim = 13) 
-    tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path= opt.tokenizer_path)
-    global_model.load_state_dict(merge_state_dict)
-    global_model.config.to_json_file( os.path.join(dir_path, 'config.json'))
-    tokenizer.save_vocabulary(dir_path)
+    # comment 逐折流式加载并累加，内存不随折数增长
+    model_dirs = [os.path.join(opt.output_root,'kfold-%d'%(k)) for k in range(opt.kfold)]
+    weights = average_checkpoints(model_dirs, opt.output_root, weighting=opt.avg_weighting)
+    print('融合权重 : ',weights)
+    print('融合模型存储路径 : ',opt.output_root)
     print('融合完毕')
     
 
@@ -272,5 +376,7 @@ if __name__ == '__main__':
     print(opt)  
     os.environ['CUDA_VISIBLE_DEVICES'] = str(opt.gpu)
     train(opt)
-    model_param_avg(opt)
+    # comment 只跑部分fold时，等所有fold都跑完再单独用model_avg.py融合
+    if opt.folds is None:
+        model_param_avg(opt)
 
@@ -1,25 +1,22 @@
 
 
 import time
+import gc
 import numpy as np
 import json
 import torch
 import torch.nn as nn
-from sklearn.model_selection import train_test_split
-from helper import  build_optimizer_forvilt
-from vilt import MyViltFinetune
+from helper import  build_optimizer_forvilt , enable_gradient_checkpointing , get_update_steps , build_weight_averager , build_step_timer , build_profiler , build_memory_reporter , build_checkpoint , ResumableRandomSampler , ModelSaver , shadow_weights , get_accum_size
+from model_avg import WEIGHTS_NAMES
 from torch.utils.data import DataLoader
 from datasets import * 
 import argparse
-from transformers import (
-    BertTokenizer,
-    set_seed,
-)
 import os
 device = "cuda"
 import  random
 
 def seed_everything(seed):
+    from transformers import set_seed
     set_seed(seed)
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
@@ -31,7 +28,10 @@ def seed_everything(seed):
     torch.backends.cudnn.deterministic = True
     
 def train(opt):
+    from vilt import MyViltFinetune
+    from transformers import BertTokenizer
     seed_everything(opt.seed)
+    memory = build_memory_reporter(opt)
     
     tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path= opt.tokenizer_path)
 
@@ -69,167 +69,192 @@ def train(opt):
         coarse_to_fine_data = json.loads(f.read())
     coarse_to_fine_texts, coarse_to_fine_img_features, coarse_to_fine_labels, coarse_to_fine_label_masks, coarse_to_fine_key_attrs = \
         coarse_to_fine_data['texts'], coarse_to_fine_data['img_features'], coarse_to_fine_data['labels'], coarse_to_fine_data['label_masks'], coarse_to_fine_data['key_attrs']
+    memory.phase('read_json', fine_data = fine_data, coarse_to_fine_data = coarse_to_fine_data)
         
     fine_texts = list(map(delete_word,fine_texts))
     coarse_to_fine_texts = list(map(delete_word,coarse_to_fine_texts))
 
-    fine_data_texts = np.array(fine_texts)
-    fine_data_img_features = np.array(fine_img_features)
-    fine_data_labels = np.array(fine_labels)
-    fine_data_label_masks = np.array(fine_label_masks)
-    fine_data_key_attrs = np.array(fine_key_attrs)
+    # comment fine和coarse_to_fine放进同一份语料, 特征只存一份; 训练/测试集只是语料上的索引视图, 不再fancy-index拷贝
+    corpus = SharedMatchCorpus(
+        texts           = fine_texts + coarse_to_fine_texts,
+        img_features    = fine_img_features + coarse_to_fine_img_features,
+        labels          = fine_labels + coarse_to_fine_labels,
+        label_masks     = fine_label_masks + coarse_to_fine_label_masks,
+        key_attrs       = fine_key_attrs + coarse_to_fine_key_attrs,
+    )
+    num_fine = len(fine_texts)
+    del fine_data , coarse_to_fine_data , fine_img_features , coarse_to_fine_img_features
+    gc.collect()
+    memory.phase('corpus', texts = corpus.texts, visual_embeds = corpus.visual_embeds, labels = corpus.labels,
+        label_masks = corpus.label_masks, key_attrs = corpus.key_attrs)
 
     assert 0 < opt.test_rate < 1
-    train_idxs, test_idxs = train_test_split(range(len(fine_data_texts)), test_size=opt.test_rate)
-
-    train_fine_texts = fine_data_texts[train_idxs]
-    train_fine_img_features = fine_data_img_features[train_idxs]
-    train_fine_labels = fine_data_labels[train_idxs]
-    train_fine_label_masks = fine_data_label_masks[train_idxs]
-    train_fine_key_attrs = fine_data_key_attrs[train_idxs]
-
-    train_texts         = np.concatenate((train_fine_texts, np.array(coarse_to_fine_texts)))
-    train_img_features  = np.concatenate((train_fine_img_features, np.array(coarse_to_fine_img_features)))
-    train_labels        = np.concatenate((train_fine_labels, np.array(coarse_to_fine_labels)))
-    train_label_masks   = np.concatenate((train_fine_label_masks, np.array(coarse_to_fine_label_masks)))
-    train_key_attrs     = np.concatenate((train_fine_key_attrs, np.array(coarse_to_fine_key_attrs)))
-
-    test_texts = fine_data_texts[test_idxs]
-    test_img_features = fine_data_img_features[test_idxs]
-    test_labels = fine_data_labels[test_idxs]
-    test_label_masks = fine_data_label_masks[test_idxs]
-    test_key_attrs = fine_data_key_attrs[test_idxs]
-
+    # comment 只对fine数据划分, coarse_to_fine全部进训练集; 划分写到output_root, --split_path 复用
+    train_idxs , test_idxs = split_indices(num_fine, opt.test_rate, num_total = len(corpus), split_path = opt.split_path)
+    save_split(os.path.join(opt.output_root, 'split.npz'), train_idxs, test_idxs)
     train_dataset = MatchDataset_v2(
         tokenizer = tokenizer , 
-        texts  = train_texts, 
-        labels = train_labels, 
-        visual_embeds = train_img_features,
-        label_masks = train_label_masks,
-        key_attrs  = train_key_attrs,
         key_attr_values = key_attr_values,
         label2id = label2id,
         color_set = color_set,
+        **corpus.view(train_idxs),
     )
     test_dataset = MatchDataset_v2(
         tokenizer = tokenizer , 
-        texts = test_texts , 
-        labels = test_labels , 
-        visual_embeds = test_img_features , 
-        label_masks = test_label_masks , 
-        key_attrs = test_key_attrs , 
         key_attr_values = key_attr_values , 
         label2id = label2id,
         p6 = -1 ,          
         p7 = -1,           
         color_set = color_set,
+        **corpus.view(test_idxs),
     )
-    train_dataloader = DataLoader(train_dataset, shuffle=True, batch_size=opt.batch_size, num_workers=opt.num_workers)
+    train_sampler = ResumableRandomSampler(train_dataset, seed=opt.seed)
+    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=opt.batch_size, num_workers=opt.num_workers)
     test_dataloader = DataLoader(test_dataset, batch_size=opt.batch_size, num_workers=opt.num_workers)
-    print('加载数据完成 %.2f min。 总共训练集 %d. 总测试集合 %d.'%((time.time()-since)/ 60,len(train_texts),len(test_texts)))
+    print('加载数据完成 %.2f min。 总共训练集 %d. 总测试集合 %d.'%((time.time()-since)/ 60,len(train_idxs),len(test_idxs)))
 
     myvilt = MyViltFinetune.from_pretrained(opt.pretrain_model_path  , output_dim = 13)
     myvilt.to(device)
+    memory.phase('model', model = myvilt)
+    if opt.gradient_checkpointing:
+        enable_gradient_checkpointing(myvilt)
     print('加载模型 %s'%(opt.pretrain_model_path))
     criterion =  nn.BCELoss()
-    total_update_step = opt.epochs * len(train_dataloader)
+    total_update_step = opt.epochs * get_update_steps(len(train_dataloader), opt.grad_accum_steps)
     optim , scheduler = build_optimizer_forvilt(opt , myvilt ,total_update_step )
+    weight_avg = build_weight_averager(opt , myvilt , total_update_step)
     record_epoch_arr = []
     best_score , min_loss = float('-inf') , float('inf')
-    for epoch in range(opt.epochs):
+    # comment --resume 时从最近的完整checkpoint继续: 跳过已经训练完的epoch和当前epoch里已经训练过的step
+    checkpoint = build_checkpoint(opt, os.path.join(opt.output_root, 'checkpoint'))
+    # comment save_model和checkpoint共用一个后台写盘线程，checkpoint.close()时一起写完
+    saver = ModelSaver(writer=checkpoint.writer)
+    start_epoch , start_step = 0 , 0
+    if opt.resume:
+        start_epoch , start_step , state = checkpoint.restore(myvilt, optim, scheduler, weight_avg)
+        if state is not None:
+            record_epoch_arr , best_score , min_loss = state['record_epoch_arr'] , state['best_score'] , state['min_loss']
+    timer = build_step_timer(opt)
+    profiler = build_profiler(opt, os.path.join(opt.output_root, 'profile'))
+    profiler.start()
+    memory.watch_workers()
+    for epoch in range(start_epoch, opt.epochs):
+        skip_steps = start_step if epoch == start_epoch else 0
+        train_sampler.set_epoch(epoch, skip_steps * opt.batch_size)
         since = time.time() 
         myvilt.train()
-        for _ , batch in enumerate(train_dataloader):
+        optim.zero_grad()
+        timer.start()
+        for step , batch in enumerate(train_dataloader, skip_steps):
+            timer.lap('data')
             input_ids               = batch['input_ids'].to(device)                 # shape [batch_size,seq_len]
             attention_mask          = batch['attention_mask'].to(device)
             token_type_ids          = batch['token_type_ids'].to(device)            # shape [batch_size,seq_len]
             visual_embeds           = batch['visual_embeds'].to(device)             # shape [batch_size, feat_num, feat_dim]
             # visual_attention_mask   = batch['visual_attention_mask'].to(device)     # shape [batch_size, feat_num]
             labels                  = batch['labels'].to(device)                    # shape [batch_size, 13]
+            timer.lap('h2d')
             output = myvilt(
                 input_ids = input_ids ,
                 attention_mask = attention_mask ,
                 token_type_ids = token_type_ids, 
                 feats = visual_embeds , 
             )   
-            optim.zero_grad()
             imgtxt_loss = criterion(output[:,0],labels[:,0])
             attr_loss = criterion(output[:,1:],labels[:,1:])
             loss = imgtxt_loss + attr_loss
-            loss.backward()
-            optim.step()
-            scheduler.step()
+            timer.lap('forward')
+            (loss / get_accum_size(step, len(train_dataloader), opt.grad_accum_steps)).backward()
+            timer.lap('backward')
+            if (step + 1) % opt.grad_accum_steps == 0 or step + 1 == len(train_dataloader):
+                optim.step()
+                scheduler.step()
+                optim.zero_grad()
+                if weight_avg is not None:
+                    weight_avg.update(scheduler.last_epoch)
+                if checkpoint.due():
+                    checkpoint.save(epoch, step + 1, myvilt, optim, scheduler, weight_avg, record_epoch_arr = record_epoch_arr, best_score = best_score, min_loss = min_loss)
+            timer.lap('optim')
+            timer.end_step()
+            profiler.step()
 
             del input_ids , attention_mask , token_type_ids , visual_embeds , labels
             del output , imgtxt_loss , attr_loss , loss 
             
 
         
-        N_img_text , M_img_text = 0, 0
-        N_attr , M_attr = 0 , 0
-        eval_losses , eval_img_text_losses , eval_attr_losses = [] , [] , []
-        with torch.no_grad():
-            myvilt.eval()
-            for batch in test_dataloader:
-                input_ids               = batch['input_ids'].to(device)                 # shape [batch_size,seq_len]
-                attention_mask          = batch['attention_mask'].to(device)
-                token_type_ids          = batch['token_type_ids'].to(device)            # shape [batch_size,seq_len]
-                visual_embeds           = batch['visual_embeds'].to(device)             # shape [batch_size, feat_num, feat_dim]
-                # visual_attention_mask   = batch['visual_attention_mask'].to(device)     # shape [batch_size, feat_num]
-                labels                  = batch['labels'].to(device)                    # shape [batch_size, 13]    
-                label_masks             = batch['label_masks'].to(device)
-                output = myvilt(
-                    input_ids = input_ids ,
-                    attention_mask = attention_mask ,
-                    token_type_ids = token_type_ids, 
-                    feats = visual_embeds , 
-                )   
+        # comment 评估和保存都使用影子权重
+        with shadow_weights(weight_avg):
+            N_img_text , M_img_text = 0, 0
+            N_attr , M_attr = 0 , 0
+            eval_losses , eval_img_text_losses , eval_attr_losses = [] , [] , []
+            timer.start()
+            with torch.no_grad():
+                myvilt.eval()
+                for batch in test_dataloader:
+                    input_ids               = batch['input_ids'].to(device)                 # shape [batch_size,seq_len]
+                    attention_mask          = batch['attention_mask'].to(device)
+                    token_type_ids          = batch['token_type_ids'].to(device)            # shape [batch_size,seq_len]
+                    visual_embeds           = batch['visual_embeds'].to(device)             # shape [batch_size, feat_num, feat_dim]
+                    # visual_attention_mask   = batch['visual_attention_mask'].to(device)     # shape [batch_size, feat_num]
+                    labels                  = batch['labels'].to(device)                    # shape [batch_size, 13]    
+                    label_masks             = batch['label_masks'].to(device)
+                    output = myvilt(
+                        input_ids = input_ids ,
+                        attention_mask = attention_mask ,
+                        token_type_ids = token_type_ids, 
+                        feats = visual_embeds , 
+                    )   
                 
-                img_txt_logit , attr_logit = output[:,0] , output[:,1:]
-                true_img_text , true_attr = labels[:,0] , labels[:,1:]
+                    img_txt_logit , attr_logit = output[:,0] , output[:,1:]
+                    true_img_text , true_attr = labels[:,0] , labels[:,1:]
                 
-                img_text_loss = criterion(img_txt_logit ,true_img_text )
-                attr_loss = criterion(attr_logit ,true_attr )
-                test_loss = img_text_loss + attr_loss
-                eval_losses.append(test_loss)
-                eval_img_text_losses.append(img_text_loss)
-                eval_attr_losses.append(attr_loss)
+                    img_text_loss = criterion(img_txt_logit ,true_img_text )
+                    attr_loss = criterion(attr_logit ,true_attr )
+                    test_loss = img_text_loss + attr_loss
+                    eval_losses.append(test_loss)
+                    eval_img_text_losses.append(img_text_loss)
+                    eval_attr_losses.append(attr_loss)
 
                 
-                pred_img_text = torch.zeros_like(output[:,0])
-                pred_img_text[output[:,0] >= 0.5] =1
-                N_img_text += torch.sum(pred_img_text == true_img_text).cpu().numpy().item()
-                M_img_text += torch.sum(torch.ones_like(true_img_text)).cpu().numpy().item()
+                    pred_img_text = torch.zeros_like(output[:,0])
+                    pred_img_text[output[:,0] >= 0.5] =1
+                    N_img_text += torch.sum(pred_img_text == true_img_text).cpu().numpy().item()
+                    M_img_text += torch.sum(torch.ones_like(true_img_text)).cpu().numpy().item()
                 
-                pred_attr =  torch.zeros_like(output[:,1:])
-                pred_attr[output[:,1:] >= 0.5] = 1
-                pred_attr = pred_attr[label_masks[:, 1:] == 1]
-                true_attr = true_attr[label_masks[:, 1:] == 1]
-                N_attr += torch.sum(pred_attr == true_attr).cpu().numpy().item()
-                M_attr += torch.sum(torch.ones_like(true_attr)).cpu().numpy().item()
+                    pred_attr =  torch.zeros_like(output[:,1:])
+                    pred_attr[output[:,1:] >= 0.5] = 1
+                    pred_attr = pred_attr[label_masks[:, 1:] == 1]
+                    true_attr = true_attr[label_masks[:, 1:] == 1]
+                    N_attr += torch.sum(pred_attr == true_attr).cpu().numpy().item()
+                    M_attr += torch.sum(torch.ones_like(true_attr)).cpu().numpy().item()
 
-                del input_ids, attention_mask , token_type_ids , visual_embeds  , labels , label_masks
-                del output , img_txt_logit , attr_logit , true_img_text , true_attr , img_text_loss , attr_loss , test_loss
+                    del input_ids, attention_mask , token_type_ids , visual_embeds  , labels , label_masks
+                    del output , img_txt_logit , attr_logit , true_img_text , true_attr , img_text_loss , attr_loss , test_loss
 
-            eval_loss = (sum(eval_losses) / len(eval_losses)).detach().cpu().numpy().item()
-            eval_img_text_loss = (sum(eval_img_text_losses) / len(eval_img_text_losses)).detach().cpu().numpy().item()
-            eval_attr_loss = (sum(eval_attr_losses) / len(eval_attr_losses)).detach().cpu().numpy().item()
-            img_text_scores = 0.5 * N_img_text / M_img_text
-            attr_scores = 0.5 * N_attr / M_attr
-            total_scores = img_text_scores + attr_scores
-        is_save_model = 0
-        if total_scores > best_score :   
-            best_score , is_save_model = total_scores , 1
-            save_model(myvilt,tokenizer , opt ,model_type = 'score')
-        if eval_loss < min_loss:    
-            min_loss , is_save_model = eval_loss , 1 
-            save_model(myvilt , tokenizer , opt ,model_type = 'loss')
+                eval_loss = (sum(eval_losses) / len(eval_losses)).detach().cpu().numpy().item()
+                eval_img_text_loss = (sum(eval_img_text_losses) / len(eval_img_text_losses)).detach().cpu().numpy().item()
+                eval_attr_loss = (sum(eval_attr_losses) / len(eval_attr_losses)).detach().cpu().numpy().item()
+                img_text_scores = 0.5 * N_img_text / M_img_text
+                attr_scores = 0.5 * N_attr / M_attr
+                total_scores = img_text_scores + attr_scores
+            timer.lap('eval')
+            is_save_model = 0
+            if total_scores > best_score :   
+                best_score , is_save_model = total_scores , 1
+                save_model(myvilt,tokenizer , opt ,model_type = 'score' , saver = saver)
+            if eval_loss < min_loss:    
+                min_loss , is_save_model = eval_loss , 1 
+                save_model(myvilt , tokenizer , opt ,model_type = 'loss' , saver = saver)
         using_time = (time.time()-since)/60
         print('E%d(t %.2f min) score %.4f (it %.4f attr %.4f) t_l %.6f (it %.6f attr %.6f)  SaveMode %d.'\
             %(epoch , using_time , total_scores , img_text_scores , attr_scores ,eval_loss , eval_img_text_loss ,eval_attr_loss   , is_save_model))
 
         record_epoch_arr.append([ total_scores , img_text_scores , attr_scores ,eval_loss , eval_img_text_loss ,eval_attr_loss])
-    
+        checkpoint.save(epoch + 1, 0, myvilt, optim, scheduler, weight_avg, record_epoch_arr = record_epoch_arr, best_score = best_score, min_loss = min_loss)
+
+    profiler.stop()
+    checkpoint.close()
     print('#'*25,' 训练完毕' , '#'*25)
     strings = time.strftime('%Y,%m,%d,%H,%M,%S')
     t = strings.split(',')
@@ -239,6 +264,8 @@ def train(opt):
         os.mkdir(dir_path)
     full_path = os.path.join(dir_path,'static-%02d%02d.npy'%(number[3],number[4]))
     np.save(full_path,record_epoch_arr)
+    timer.save(dir_path, 'step_time-%02d%02d.json'%(number[3],number[4]))
+    memory.save(dir_path, 'memory-%02d%02d.json'%(number[3],number[4]))
     print('#'*25,' 写入统计数据成功， 文件名' , full_path)
     write_opt(opt)
     del myvilt , optim , scheduler
@@ -247,23 +274,23 @@ def train(opt):
 def predict_result(opt):
     print('#'*25 , ' 开始预测 ', '#'*25 )
     torch.cuda.empty_cache()
-     
+    
     strings = time.strftime('%Y,%m,%d,%H,%M,%S')
     t = strings.split(',')
     number = [int(i) for i in t]
-    dir_path = os.path.join(opt.output_root)
-    if not os.path.exists(dir_path):
-        os.mkdir(dir_path)
-    predict_model_path = os.path.join(dir_path , 'score/')
-    predict_save_path = os.path.join(dir_path , 'score','predict-%02d%02d.txt'%(number[3],number[4]))
+    # comment save_model把模型写在output_root下
+    predict_model_path = os.path.join(opt.output_root)
+    predict_save_path = os.path.join(predict_model_path ,'predict-%02d%02d.txt'%(number[3],number[4]))
     predict_command = 'python3 run_predict.py \
                         --gpu %d \
                         --tokenizer_path %s \
                         --model_path %s \
+                        --test_path %s \
                         --save_path %s ' %(
                             opt.gpu,
                             predict_model_path,
-                            os.path.join(predict_model_path , 'pytorch_model.bin'),
+                            predict_model_path,
+                            opt.test_path,
                             predict_save_path
                         )
     os.system(predict_command)
@@ -284,17 +311,14 @@ def write_opt(opt):
     with open(os.path.join(dir_path,'opt_parm.txt'),'w+',encoding='utf-8') as file:
         file.write(content)
     
-def save_model(model,tokenizer,opt,model_type):
+def save_model(model,tokenizer,opt,model_type,saver):
     strings = time.strftime('%Y,%m,%d,%H,%M,%S')
     t = strings.split(',')
     number = [int(i) for i in t]
     dir_path = os.path.join(opt.output_root)
 
-    os.makedirs(dir_path,exist_ok=True)
-    model_to_save = model.module if hasattr(model, 'module') else model
-    torch.save(model_to_save.state_dict(), os.path.join(dir_path, 'pytorch_model.bin'))
-    model_to_save.config.to_json_file( os.path.join(dir_path, 'config.json'))
-    tokenizer.save_vocabulary(dir_path)
+    # comment 参数拷到cpu后由后台线程原子写入，config.json和词表没变时跳过
+    saver.save(model, tokenizer, dir_path, weights_name=WEIGHTS_NAMES[opt.save_format])
 
 def parse_opt():
     parser = argparse.ArgumentParser()
@@ -304,8 +328,10 @@ def parse_opt():
     parser.add_argument('--pretrain_model_path',type=str,default = './vilt_model/pretrain/' ,help='pretrain model path') 
     parser.add_argument('--data_root',type = str , default='./data/',help='数据根路径')
     parser.add_argument('--output_root',type = str , default='./vilt_model/finetune/',help = '输出根路径' )
+    parser.add_argument('--save_format',type=str,default='safetensors',choices=['safetensors','bin'],help='模型权重格式, safetensors: model.safetensors(mmap加载, 启动快); bin: pytorch_model.bin')
     parser.add_argument('--num_workers',type =int,default=16)
     parser.add_argument('--test_rate',type = float,default=0.2 , help='测试集的比例')
+    parser.add_argument('--split_path',type=str,default=None,help='复用之前保存的训练/测试集划分(output_root/split.npz), 不设置时按test_rate重新划分')
     parser.add_argument('--epochs',type=int,default=50)
     parser.add_argument('--lr',type=float,default=5e-05 )
     parser.add_argument('--small_lr',type=float,default=1e-5)  
@@ -313,6 +339,23 @@ def parse_opt():
     parser.add_argument('--weight_decay', type=float, default=1e-4, help='weight_decay')   
     parser.add_argument('--gpu',type = int, default=1,help='GPU')
     parser.add_argument('--warmup_ratio', type=float, default=0.1, help='warmup_ratio')
+    parser.add_argument('--test_path',type=str,default=None,help='训练结束后用run_predict.py预测的测试集(jsonl), 不设置则不预测')
+    parser.add_argument('--grad_accum_steps',type = int, default=1, help='梯度累积步数, 等效batch = batch_size * grad_accum_steps')
+    parser.add_argument('--gradient_checkpointing',action='store_true', help='encoder各层开启activation checkpointing, 省显存')
+    parser.add_argument('--weight_avg',type=str,default='none',choices=['none','ema','swa'],help='影子权重: ema 指数滑动平均, swa 等权平均; 评估和保存都用影子权重')
+    parser.add_argument('--ema_decay',type=float,default=0.999,help='ema衰减率')
+    parser.add_argument('--swa_start',type=float,default=0.5,help='swa从总更新步数的多少比例开始平均')
+    parser.add_argument('--step_timing',action='store_true',help='按step记录 等数据/拷贝/前向/反向/优化器/评估 的耗时, 训练结束把分位数写到output_root')
+    parser.add_argument('--trace_steps',type=int,nargs='+',default=None,help='这些step的计时另外导出成chrome trace')
+    parser.add_argument('--profile',action='store_true',help='用torch.profiler记录一段训练step, tensorboard trace和top-N算子表写到output_root/profile')
+    parser.add_argument('--profile_wait',type=int,default=5,help='profile: 跳过前多少个训练step')
+    parser.add_argument('--profile_steps',type=int,default=5,help='profile: 记录多少个训练step')
+    parser.add_argument('--profile_top',type=int,default=30,help='profile: 算子表的行数')
+    parser.add_argument('--profile_with_stack',action='store_true',help='profile: 记录python调用栈, 可以看到算子属于哪个模块')
+    parser.add_argument('--memory_report',action='store_true',help='每个加载阶段后打印rss和各数据结构的大小, 训练时定时记录DataLoader worker的rss/pss, 结束后写到output_root')
+    parser.add_argument('--memory_interval',type=float,default=30.0,help='memory_report: worker内存的采样间隔(秒)')
+    parser.add_argument('--resume',action='store_true',help='从output_root/checkpoint/last.pt恢复模型/优化器/scheduler/随机数状态和训练进度继续训练, 没有时从头训练')
+    parser.add_argument('--checkpoint_steps',type=int,default=500,help='每多少次参数更新写一次完整checkpoint(后台线程写), 0 表示只在每个epoch结束时写')
     opt = parser.parse_args()
     return opt    
 
@@ -321,6 +364,8 @@ if __name__ == '__main__':
     print(opt)  
     os.environ['CUDA_VISIBLE_DEVICES'] = str(opt.gpu)
     train(opt)
+    if opt.test_path is not None:
+        predict_result(opt)
 
 
 
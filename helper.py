@@ -1,8 +1,20 @@
 
 
 from torch.optim.lr_scheduler import LambdaLR
+from contextlib import contextmanager , nullcontext
 import torch
 import math
+import os
+import sys
+import json
+import time
+import queue
+import random
+import shutil
+import tempfile
+import threading
+import numpy as np
+from model_avg import WEIGHTS_NAME , WEIGHTS_NAMES , save_state_dict
 
 
 
@@ -100,6 +112,660 @@ def build_optimizer_for_allmodels(args , train_steps, pretrain_module, finetune_
 
 
 
+def enable_gradient_checkpointing(model):
+    # comment 对encoder的每一层做activation checkpointing
+    # comment MyLxmertEncoder / MyBertEncoder / ViltEncoder 都带有 gradient_checkpointing 开关
+    model = model.module if hasattr(model, 'module') else model
+    if getattr(model, 'supports_gradient_checkpointing', False):
+        model.gradient_checkpointing_enable()
+    for module in model.modules():
+        if hasattr(module, 'gradient_checkpointing'):
+            module.gradient_checkpointing = True
+    return model
+
+def get_update_steps(num_batches, grad_accum_steps):
+    # comment 梯度累积时，每个epoch真正的参数更新次数
+    return math.ceil(num_batches / max(1, grad_accum_steps))
+
+def get_accum_size(step, num_batches, grad_accum_steps):
+    # comment step所在累积组的micro-batch数; epoch末尾不满grad_accum_steps的组按实际个数平均loss
+    grad_accum_steps = max(1, grad_accum_steps)
+    return min(grad_accum_steps, num_batches - step + step % grad_accum_steps)
+
+
+class ModelEMA(object):
+    # comment 训练过程中维护一份影子权重, 每次参数更新后用foreach原地更新
+    # comment ema: shadow = decay * shadow + (1-decay) * param
+    # comment swa: 从start_step开始对参数做等权平均
+    def __init__(self, model, mode='ema', decay=0.999, start_step=0):
+        assert mode in ('ema', 'swa')
+        model = model.module if hasattr(model, 'module') else model
+        self.mode = mode
+        self.decay = decay
+        self.start_step = start_step
+        self.num_updates = 0
+        self.params = [p for p in model.parameters() if p.requires_grad]
+        self.shadow = [p.detach().clone() for p in self.params]
+
+    @torch.no_grad()
+    def update(self, step):
+        if step < self.start_step:
+            return
+        if self.mode == 'ema':
+            # comment 训练初期衰减率小一些, 避免影子权重被随机初始化拖住
+            decay = min(self.decay, (1 + self.num_updates) / (10 + self.num_updates))
+        else:
+            decay = self.num_updates / (self.num_updates + 1)
+        self.num_updates += 1
+        torch._foreach_mul_(self.shadow, decay)
+        torch._foreach_add_(self.shadow, [p.detach() for p in self.params], alpha=1 - decay)
+
+    @torch.no_grad()
+    def swap(self):
+        # comment 交换模型参数和影子权重的存储, 不额外拷贝
+        for param, shadow in zip(self.params, self.shadow):
+            param.data, shadow.data = shadow.data, param.data
+
+    @contextmanager
+    def average_parameters(self):
+        self.swap()
+        try:
+            yield
+        finally:
+            self.swap()
+
+    def state_dict(self):
+        return {
+            'mode': self.mode,
+            'decay': self.decay,
+            'start_step': self.start_step,
+            'num_updates': self.num_updates,
+            'shadow': self.shadow,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.num_updates = state_dict['num_updates']
+        for shadow, saved in zip(self.shadow, state_dict['shadow']):
+            shadow.copy_(saved)
+
+def shadow_weights(weight_avg):
+    # comment 评估和保存时换上影子权重，出异常也会换回来; 没有averager或者还没更新过时不换
+    if weight_avg is None or weight_avg.num_updates == 0:
+        return nullcontext()
+    return weight_avg.average_parameters()
+
+def build_weight_averager(opt, model, train_steps):
+    if opt.weight_avg == 'none':
+        return None
+    start_step = int(train_steps * opt.swa_start) if opt.weight_avg == 'swa' else 0
+    return ModelEMA(model, mode=opt.weight_avg, decay=opt.ema_decay, start_step=start_step)
+
+
+class StepTimer(object):
+    # comment 每个step分阶段计时: data 等DataLoader, h2d 拷到device, forward, backward, optim 优化器和scheduler, eval 整个评估
+    # comment lap(phase) 记录从上一次lap到现在的耗时; cuda上先synchronize, 否则异步执行的时间会算到下一个阶段
+    PHASES = ('data', 'h2d', 'forward', 'backward', 'optim', 'eval')
+
+    def __init__(self, enabled=False, trace_steps=None):
+        self.enabled = enabled
+        self.sync = torch.cuda.is_available()
+        self.trace_steps = set(trace_steps or [])
+        self.records = {phase: [] for phase in self.PHASES}
+        self.trace_events = []
+        self.step = 0
+        self.last = None
+        self.origin = time.perf_counter()
+
+    def now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self):
+        if self.enabled:
+            self.last = self.now()
+
+    def lap(self, phase):
+        if not self.enabled:
+            return
+        now = self.now()
+        if self.last is not None:
+            self.records[phase].append(now - self.last)
+            if self.step in self.trace_steps or (phase == 'eval' and self.trace_steps):
+                self.trace_events.append({
+                    'name': phase, 'cat': 'eval' if phase == 'eval' else 'step %d' % (self.step), 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                    'ts': (self.last - self.origin) * 1e6, 'dur': (now - self.last) * 1e6,
+                })
+        self.last = now
+
+    def end_step(self):
+        if self.enabled:
+            self.step += 1
+
+    def summary(self):
+        total = sum(sum(values) for values in self.records.values())
+        summary = {}
+        for phase , values in self.records.items():
+            if not values:
+                continue
+            values = sorted(values)
+            percentile = lambda q: values[min(int(q * len(values)), len(values) - 1)] * 1000
+            summary[phase] = {
+                'count': len(values),
+                'total_s': round(sum(values), 3),
+                'share': round(sum(values) / max(total, 1e-12), 4),
+                'mean_ms': round(sum(values) / len(values) * 1000, 3),
+                'p50_ms': round(percentile(0.5), 3),
+                'p90_ms': round(percentile(0.9), 3),
+                'p99_ms': round(percentile(0.99), 3),
+                'max_ms': round(values[-1] * 1000, 3),
+            }
+        return summary
+
+    def save(self, dir_path, file_name):
+        # comment 分位数写到file_name, 选中的step另外写一份chrome trace(chrome://tracing 或 perfetto 打开)
+        if not self.enabled:
+            return
+        os.makedirs(dir_path, exist_ok=True)
+        summary = self.summary()
+        with open(os.path.join(dir_path, file_name), 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'steps': self.step, 'phases': summary}, indent=2))
+        if self.trace_events:
+            with open(os.path.join(dir_path, file_name.replace('.json', '.trace.json')), 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}))
+        for phase , stats in summary.items():
+            print('%-8s %5.1f%%  mean %8.2f ms  p50 %8.2f  p90 %8.2f  p99 %8.2f' % (phase, stats['share'] * 100, stats['mean_ms'], stats['p50_ms'], stats['p90_ms'], stats['p99_ms']))
+
+def build_step_timer(opt):
+    return StepTimer(enabled=getattr(opt, 'step_timing', False), trace_steps=getattr(opt, 'trace_steps', None))
+
+
+class NullProfiler(object):
+    # comment 没有 --profile 时的占位，训练循环里的调用都是空操作
+    def start(self):
+        pass
+
+    def step(self):
+        pass
+
+    def stop(self):
+        pass
+
+def build_profiler(opt, trace_dir):
+    # comment 跳过前 profile_wait 个训练step，预热1个step后记录 profile_steps 个step
+    # comment trace按tensorboard的格式写到trace_dir(tensorboard --logdir 直接打开)，另外写一份top-N算子耗时/内存表
+    if not getattr(opt, 'profile', False):
+        return NullProfiler()
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+    tensorboard_handler = torch.profiler.tensorboard_trace_handler(trace_dir)
+
+    def on_trace_ready(prof):
+        tensorboard_handler(prof)
+        table_path = os.path.join(trace_dir, 'top_ops-step%d.txt' % (prof.step_num))
+        with open(table_path, 'w', encoding='utf-8') as f:
+            f.write('# 按算子\n')
+            f.write(prof.key_averages().table(sort_by=sort_by, row_limit=opt.profile_top))
+            f.write('\n\n# 按算子+输入形状\n')
+            f.write(prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=opt.profile_top))
+            f.write('\n\n# 按内存\n')
+            f.write(prof.key_averages().table(sort_by='self_cpu_memory_usage', row_limit=opt.profile_top))
+        print('profiler 结果写入 %s' % (table_path))
+
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=opt.profile_wait, warmup=1, active=opt.profile_steps, repeat=1),
+        on_trace_ready=on_trace_ready,
+        record_shapes=True,
+        profile_memory=True,
+        with_stack=opt.profile_with_stack,
+    )
+
+
+def process_memory_mb(pid='self'):
+    # comment 从/proc读进程内存(只支持linux): rss 常驻内存; pss 按共享进程数均摊后的内存
+    # comment fork出来的DataLoader worker和主进程共享写时复制的页，rss会重复计算，各进程pss相加才是真实占用
+    memory = {'rss_mb': None, 'pss_mb': None}
+    try:
+        with open('/proc/%s/status' % (pid), 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    memory['rss_mb'] = round(int(line.split()[1]) / 1024, 1)
+        with open('/proc/%s/smaps_rollup' % (pid), 'r') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    memory['pss_mb'] = round(int(line.split()[1]) / 1024, 1)
+    except (OSError, ValueError):
+        pass
+    return memory
+
+def child_pids(pid=None):
+    # comment DataLoader的worker是主进程的子进程; 内核没有开 /proc/<pid>/task/<pid>/children 时扫描 /proc/*/stat 找ppid
+    pid = os.getpid() if pid is None else pid
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid), 'r') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    children = []
+    for name in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % (name), 'r') as f:
+                # comment comm可能带空格和括号，ppid取最后一个')'之后的第2个字段
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children.append(int(name))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+def nbytes(obj, sample=64):
+    # comment 估算一个结构占用的字节数: ndarray/tensor 按数据区; object数组、list、dict 按抽样的前sample个元素的平均大小外推
+    # comment np.array(list of dict) / np.array(list of str 长度不一) 会得到object数组，数据区只有指针，元素本身另算
+    if isinstance(obj, torch.nn.Module):
+        return sum(tensor.element_size() * tensor.numel() for tensor in list(obj.parameters()) + list(obj.buffers()))
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.numel()
+    if hasattr(obj, 'nbytes') and hasattr(obj, 'dtype'):
+        size = int(obj.nbytes)
+        if obj.dtype.hasobject and obj.size > 0:
+            items = obj.ravel()[:sample].tolist()
+            size += int(sum(nbytes(item, sample) for item in items) / len(items) * obj.size)
+        return size
+    if isinstance(obj, (list, tuple)):
+        size = sys.getsizeof(obj)
+        if obj:
+            items = obj[:sample]
+            size += int(sum(nbytes(item, sample) for item in items) / len(items) * len(obj))
+        return size
+    if isinstance(obj, dict):
+        size = sys.getsizeof(obj)
+        if obj:
+            items = list(obj.items())[:sample]
+            size += int(sum(nbytes(key, sample) + nbytes(value, sample) for key, value in items) / len(items) * len(obj))
+        return size
+    return sys.getsizeof(obj)
+
+
+class MemoryReporter(object):
+    # comment 内存占用报告: phase(name, **结构) 在每个加载阶段之后记录主进程rss/pss和各结构的字节数
+    # comment watch_workers() 起一个后台线程，每 interval 秒记录一次主进程和所有子进程(DataLoader worker)的rss/pss
+    def __init__(self, enabled=False, interval=30.0):
+        self.enabled = enabled
+        self.interval = interval
+        self.phases = []
+        self.samples = []
+        self.origin = time.time()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def phase(self, name, **structures):
+        if not self.enabled:
+            return
+        memory = process_memory_mb()
+        last_rss = self.phases[-1]['rss_mb'] if self.phases else None
+        record = {
+            'phase': name,
+            'time_s': round(time.time() - self.origin, 1),
+            'rss_mb': memory['rss_mb'],
+            'pss_mb': memory['pss_mb'],
+            'delta_rss_mb': round(memory['rss_mb'] - last_rss, 1) if memory['rss_mb'] is not None and last_rss is not None else None,
+            'structures': {key: round(nbytes(value) / 1024 / 1024, 1) for key, value in structures.items()},
+        }
+        self.phases.append(record)
+        print('[memory] %-12s rss %8s MB (%s) pss %8s MB' % (name, record['rss_mb'], record['delta_rss_mb'], record['pss_mb']))
+        for key , size in sorted(record['structures'].items(), key=lambda item: -item[1]):
+            print('[memory]     %-28s %10.1f MB' % (key, size))
+
+    def sample(self):
+        main = process_memory_mb()
+        workers = [dict(pid=pid, **process_memory_mb(pid)) for pid in child_pids()]
+        pss = [memory['pss_mb'] for memory in [main] + workers]
+        return {
+            'time_s': round(time.time() - self.origin, 1),
+            'main_rss_mb': main['rss_mb'],
+            'main_pss_mb': main['pss_mb'],
+            'workers': workers,
+            'total_pss_mb': round(sum(pss), 1) if None not in pss else None,
+        }
+
+    def watch_workers(self):
+        if not self.enabled or self.thread is not None:
+            return
+        self.stop_event.clear()
+
+        def run():
+            while not self.stop_event.wait(self.interval):
+                self.samples.append(self.sample())
+
+        self.thread = threading.Thread(target=run, name='memory-reporter', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def summary(self):
+        summary = {'peak_main_rss_mb': max([record['rss_mb'] or 0 for record in self.phases] + [sample['main_rss_mb'] or 0 for sample in self.samples] or [0])}
+        if self.samples:
+            summary['peak_total_pss_mb'] = max(sample['total_pss_mb'] or 0 for sample in self.samples)
+            summary['peak_workers'] = max(len(sample['workers']) for sample in self.samples)
+            summary['peak_worker_rss_mb'] = max([worker['rss_mb'] or 0 for sample in self.samples for worker in sample['workers']] or [0])
+        return summary
+
+    def save(self, dir_path, file_name):
+        if not self.enabled:
+            return
+        self.stop()
+        os.makedirs(dir_path, exist_ok=True)
+        summary = self.summary()
+        with open(os.path.join(dir_path, file_name), 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'summary': summary, 'phases': self.phases, 'samples': self.samples}, indent=2))
+        print('[memory] %s' % (json.dumps(summary)))
+
+def build_memory_reporter(opt):
+    return MemoryReporter(enabled=getattr(opt, 'memory_report', False), interval=getattr(opt, 'memory_interval', 30.0))
+
+
+def snapshot_to_cpu(obj):
+    # comment 递归把张量拷贝一份到cpu; 后台线程写盘期间训练继续原地修改参数，也不会影响已经交出去的这一份
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot_to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value) for value in obj)
+    return obj
+
+def atomic_save(obj, path):
+    # comment 先写临时文件再rename，进程中途被杀也不会留下写了一半的文件; .safetensors 后缀按safetensors格式写
+    root , ext = os.path.splitext(path)
+    tmp_path = root + '.tmp' + ext
+    if ext == '.safetensors':
+        save_state_dict(obj, tmp_path)
+    else:
+        torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+def save_weights(state_dict, path):
+    # comment 写完后删掉同目录下另一种格式的旧权重，加载时优先safetensors，不能留下过期的那份
+    atomic_save(state_dict, path)
+    for weights_name in WEIGHTS_NAMES.values():
+        stale_path = os.path.join(os.path.dirname(path), weights_name)
+        if stale_path != path and os.path.exists(stale_path):
+            os.remove(stale_path)
+
+
+class AsyncWriter(object):
+    # comment 后台写盘线程: submit(fn, *args) 放进队列后立即返回，训练循环不等磁盘
+    # comment 队列长度有上限，写得比训练慢时submit才会阻塞，避免内存里堆积过多快照
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='async-writer', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                fn , args = task
+                fn(*args)
+            except Exception as error:
+                self.error = error
+                print('后台写盘失败: %r' % (error))
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError('后台写盘失败') from self.error
+
+    def submit(self, fn, *args):
+        self.check()
+        self.queue.put((fn, args))
+
+    def wait(self):
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+
+def atomic_write_text(text, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def read_text(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def save_vocabulary_if_changed(tokenizer, dir_path):
+    # comment 先写到临时目录，和已有的词表逐个比较，内容相同的不覆盖，不同的rename过去
+    tmp_dir = tempfile.mkdtemp(prefix='.vocab-', dir=dir_path)
+    try:
+        for tmp_path in tokenizer.save_vocabulary(tmp_dir):
+            path = os.path.join(dir_path, os.path.basename(tmp_path))
+            with open(tmp_path, 'rb') as f:
+                content = f.read()
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    if f.read() == content:
+                        continue
+            os.replace(tmp_path, path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class ModelSaver(object):
+    # comment save_model的后台版本: 参数拷到cpu后交给AsyncWriter写权重(pytorch_model.bin 或 model.safetensors)，训练循环马上继续
+    # comment config.json 内容没变就不重写; 词表在同一个目录只写一次，已有且内容相同时也不覆盖
+    # comment 写盘按submit的顺序执行，读取保存的模型前先 wait()/close()
+    def __init__(self, writer=None):
+        self.writer = writer if writer is not None else AsyncWriter()
+        self.texts = {}
+        self.vocab_dirs = set()
+
+    def write_text(self, text, path):
+        if path not in self.texts:
+            self.texts[path] = read_text(path)
+        if self.texts[path] == text:
+            return
+        self.texts[path] = text
+        self.writer.submit(atomic_write_text, text, path)
+
+    def save(self, model, tokenizer, dir_path, weights_name=WEIGHTS_NAME):
+        os.makedirs(dir_path, exist_ok=True)
+        model = model.module if hasattr(model, 'module') else model
+        self.writer.submit(save_weights, snapshot_to_cpu(model.state_dict()), os.path.join(dir_path, weights_name))
+        self.write_text(model.config.to_json_string(), os.path.join(dir_path, 'config.json'))
+        if tokenizer is not None and dir_path not in self.vocab_dirs:
+            self.vocab_dirs.add(dir_path)
+            self.writer.submit(save_vocabulary_if_changed, tokenizer, dir_path)
+
+    def submit(self, fn, *args):
+        self.writer.submit(fn, *args)
+
+    def wait(self):
+        self.writer.wait()
+
+    def close(self):
+        self.writer.close()
+
+
+def get_rng_state():
+    # comment numpy的状态转成list保存，torch.load(weights_only)也能读
+    np_state = np.random.get_state()
+    return {
+        'python': random.getstate(),
+        'numpy': (np_state[0], np_state[1].tolist()) + tuple(np_state[2:]),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np.asarray(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class ResumableRandomSampler(torch.utils.data.Sampler):
+    # comment 代替DataLoader的shuffle=True: 每个epoch的顺序只由 seed + epoch 决定
+    # comment 续训时 set_epoch(epoch, start) 跳过这个epoch已经训练过的start个样本，不用把数据重新读一遍
+    def __init__(self, data_source, seed=0):
+        self.num_samples = len(data_source)
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch , self.start = epoch , start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.num_samples, generator=generator).tolist()
+        return iter(order[self.start:])
+
+    def __len__(self):
+        # comment 返回整个epoch的长度，len(train_dataloader) 和 scheduler的总步数不受续训影响
+        return self.num_samples
+
+
+class TrainCheckpoint(object):
+    # comment 断点续训: 模型、优化器、scheduler、影子权重、随机数状态、epoch和epoch内的step(sampler位置)、训练记录
+    # comment 每 every_steps 次参数更新和每个epoch结束各写一次 dir_path/last.pt，快照拷到cpu后交给后台线程写
+    def __init__(self, dir_path, every_steps=0, writer=None):
+        self.dir_path = dir_path
+        self.path = os.path.join(dir_path, 'last.pt')
+        self.every_steps = every_steps
+        self.writer = writer if writer is not None else AsyncWriter()
+        self.num_updates = 0
+
+    def due(self):
+        # comment 每次参数更新后调用，只在梯度累积的边界上保存，不会存下累积了一半的梯度
+        self.num_updates += 1
+        return self.every_steps > 0 and self.num_updates % self.every_steps == 0
+
+    def save(self, epoch, step, model, optim, scheduler=None, weight_avg=None, **state):
+        model = model.module if hasattr(model, 'module') else model
+        checkpoint = snapshot_to_cpu({
+            'epoch': epoch,
+            'step': step,
+            'model': model.state_dict(),
+            'optim': optim.state_dict(),
+            'scheduler': scheduler.state_dict() if scheduler is not None else None,
+            'weight_avg': weight_avg.state_dict() if weight_avg is not None else None,
+            'rng': get_rng_state(),
+            'state': state,
+        })
+        os.makedirs(self.dir_path, exist_ok=True)
+        self.writer.submit(atomic_save, checkpoint, self.path)
+
+    def restore(self, model, optim, scheduler=None, weight_avg=None):
+        # comment 返回 (epoch, step, state)，没有checkpoint时返回 (0, 0, None) 从头训练
+        self.writer.wait()
+        if not os.path.exists(self.path):
+            print('没有找到 %s, 从头开始训练' % (self.path))
+            return 0 , 0 , None
+        checkpoint = torch.load(self.path, map_location='cpu')
+        model = model.module if hasattr(model, 'module') else model
+        model.load_state_dict(checkpoint['model'])
+        optim.load_state_dict(checkpoint['optim'])
+        if scheduler is not None and checkpoint['scheduler'] is not None:
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        if weight_avg is not None and checkpoint['weight_avg'] is not None:
+            weight_avg.load_state_dict(checkpoint['weight_avg'])
+        set_rng_state(checkpoint['rng'])
+        print('从 %s 恢复: epoch %d step %d' % (self.path, checkpoint['epoch'], checkpoint['step']))
+        return checkpoint['epoch'] , checkpoint['step'] , checkpoint['state']
+
+    def close(self):
+        self.writer.close()
+
+def build_checkpoint(opt, dir_path):
+    return TrainCheckpoint(dir_path, every_steps=getattr(opt, 'checkpoint_steps', 0))
+
+
+def prune_linear(layer, index, dim=0):
+    # comment 按index保留nn.Linear的输出(dim=0)或输入(dim=1)维度，返回新的Linear
+    index = index.to(layer.weight.device)
+    weight = layer.weight.index_select(dim, index).detach().clone()
+    bias = None
+    if layer.bias is not None:
+        bias = layer.bias.index_select(0, index).detach().clone() if dim == 0 else layer.bias.detach().clone()
+    new_layer = torch.nn.Linear(weight.size(1), weight.size(0), bias=bias is not None).to(layer.weight.device, dtype=layer.weight.dtype)
+    new_layer.weight.data.copy_(weight)
+    if bias is not None:
+        new_layer.bias.data.copy_(bias)
+    return new_layer
+
+def find_attention_units(model):
+    # comment 可以按头剪枝的attention单元: {模块路径: (attention模块, q/k/v的属性名, 输出层所在模块, 输出层的属性名)}
+    # comment LxmertSelfAttentionLayer / vilbert的BertAttention,BertImageAttention: self + output.dense
+    # comment LxmertCrossAttentionLayer: att + output.dense (x_layers里两个方向共用)
+    # comment vilbert的BertConnectionLayer: biattention的两组q/k/v + biOutput的dense1/dense2/q_dense1/q_dense2
+    units = {}
+    for name, module in model.named_modules():
+        if hasattr(module, 'biattention') and hasattr(module, 'biOutput'):
+            units[name] = (module.biattention, ('query1', 'key1', 'value1', 'query2', 'key2', 'value2'), module.biOutput, ('dense1', 'dense2', 'q_dense1', 'q_dense2'))
+        elif hasattr(module, 'output') and hasattr(module.output, 'dense'):
+            attention = getattr(module, 'self', None) if hasattr(module, 'self') else getattr(module, 'att', None)
+            if attention is not None and hasattr(attention, 'query') and hasattr(attention, 'num_attention_heads'):
+                units[name] = (attention, ('query', 'key', 'value'), module.output, ('dense',))
+    return units
+
+def prune_attention_heads(model, heads_to_prune):
+    # comment heads_to_prune: {模块路径: [要去掉的头]}，物理删除q/k/v的输出维度和输出层的输入维度
+    units = find_attention_units(model)
+    for name, heads in heads_to_prune.items():
+        attention , qkv_names , output , output_names = units[name]
+        heads = set(int(head) for head in heads)
+        keep = [head for head in range(attention.num_attention_heads) if head not in heads]
+        assert len(keep) > 0, '%s 至少保留一个头' % (name)
+        if len(keep) == attention.num_attention_heads:
+            continue
+        size = attention.attention_head_size
+        index = torch.cat([torch.arange(head * size, (head + 1) * size) for head in keep])
+        for qkv_name in qkv_names:
+            setattr(attention, qkv_name, prune_linear(getattr(attention, qkv_name), index, dim=0))
+        for output_name in output_names:
+            setattr(output, output_name, prune_linear(getattr(output, output_name), index, dim=1))
+        attention.num_attention_heads = len(keep)
+        # comment hf的LxmertAttention用head_size，vilbert用all_head_size
+        for attr in ('all_head_size', 'head_size'):
+            if hasattr(attention, attr):
+                setattr(attention, attr, len(keep) * size)
+    return model
+
+def resize_attention_heads(model, num_heads):
+    # comment 按config里记录的每个单元剩余头数把模型调整成剪枝后的形状，之后再load_state_dict
+    if not num_heads:
+        return model
+    units = find_attention_units(model)
+    return prune_attention_heads(model, {
+        name: range(num, units[name][0].num_attention_heads) for name, num in num_heads.items()
+    })
+
+
 class MyWarmupCosineSchedule(LambdaLR):
     def __init__(self, optimizer, warmup_steps, t_total, cycles=.5, last_epoch=-1):
         self.warmup_steps = warmup_steps
@@ -2,6 +2,8 @@
 import torch
 import torch.nn as nn
 import numpy as np
+from torch.utils.checkpoint import checkpoint
+from helper import resize_attention_heads
 from transformers.models.lxmert.modeling_lxmert import (
     LxmertPreTrainedModel,
     LxmertPooler ,
@@ -41,6 +43,8 @@ class MyLxmertEncoder(nn.Module):
         self.l_layers  = nn.ModuleList([LxmertLayer(config) for _ in range(self.num_l_layers)])
         self.x_layers   = nn.ModuleList([LxmertXLayer(config) for _ in range(self.num_x_layers)])
         self.r_layers   = nn.ModuleList([LxmertLayer(config) for _ in range(self.num_r_layers)])
+        # comment 打开后训练时每层只保留输入，反向传播时重算，用计算换显存
+        self.gradient_checkpointing = False
     def forward(
         self ,
         input_ids , 
@@ -50,27 +54,55 @@ class MyLxmertEncoder(nn.Module):
         
         visual_feats , 
         visual_attention_mask ,
+        output_x_hidden_states = False ,
     ): 
 
        
+        lang_feats , visual_feats = self.single_stream(input_ids, token_type_ids, extended_attention_mask, visual_feats, visual_attention_mask)
+        use_checkpoint = self.gradient_checkpointing and self.training
+        x_lang_feats = []
+        for layer_module in self.x_layers:
+            if use_checkpoint:
+                x_outputs = checkpoint(
+                    layer_module,
+                    lang_feats,
+                    extended_attention_mask,
+                    visual_feats,
+                    visual_attention_mask,
+                )
+            else:
+                x_outputs = layer_module(
+                    lang_feats,
+                    extended_attention_mask,
+                    visual_feats,
+                    visual_attention_mask,
+                )
+            lang_feats, visual_feats = x_outputs[:2]
+            if output_x_hidden_states:
+                x_lang_feats.append(lang_feats)
+        if output_x_hidden_states:
+            return visual_feats , lang_feats , tuple(x_lang_feats)
+        return visual_feats , lang_feats  
+
+    def single_stream(self, input_ids, token_type_ids, extended_attention_mask, visual_feats, visual_attention_mask):
+        # comment 文本l_layers和图像r_layers，x_layers之前的部分
         txt_embeddings = self.txt_embedding(input_ids,token_type_ids)
         
+        use_checkpoint = self.gradient_checkpointing and self.training
         lang_feats = txt_embeddings
         for layer_module in self.l_layers:
-            l_output = layer_module(lang_feats,extended_attention_mask)
+            if use_checkpoint:
+                l_output = checkpoint(layer_module,lang_feats,extended_attention_mask)
+            else:
+                l_output = layer_module(lang_feats,extended_attention_mask)
             lang_feats = l_output[0]
         for layer_module in self.r_layers:
-            v_outputs = layer_module(visual_feats, visual_attention_mask)
+            if use_checkpoint:
+                v_outputs = checkpoint(layer_module,visual_feats, visual_attention_mask)
+            else:
+                v_outputs = layer_module(visual_feats, visual_attention_mask)
             visual_feats = v_outputs[0]
-        for layer_module in self.x_layers:
-            x_outputs = layer_module(
-                lang_feats,
-                extended_attention_mask,
-                visual_feats,
-                visual_attention_mask,
-            )
-            lang_feats, visual_feats = x_outputs[:2]
-        return visual_feats , lang_feats  
+        return lang_feats , visual_feats
 
 
 
@@ -93,22 +125,20 @@ class MyLxmert(LxmertPreTrainedModel):
 
         visual_feats ,  
         visual_attention_mask ,
+        output_x_hidden_states = False ,
     ):
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
-        extended_attention_mask = extended_attention_mask.to(dtype=self.dtype)
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
-        extended_visual_attention_mask = visual_attention_mask.unsqueeze(1).unsqueeze(2)
-        extended_visual_attention_mask = extended_visual_attention_mask.to(dtype=self.dtype)
-        extended_visual_attention_mask = (1.0 - extended_visual_attention_mask) * -10000.0
+        extended_attention_mask , extended_visual_attention_mask = self.extend_masks(attention_mask, visual_attention_mask)
         visual_feats = self.visn_fc(visual_feats)
-        visual_feats , lang_feats   = self.encoder(
+        encoder_outputs = self.encoder(
             input_ids = input_ids, 
             token_type_ids = token_type_ids, 
             attention_mask = attention_mask, 
             extended_attention_mask = extended_attention_mask,
             visual_feats = visual_feats , 
             visual_attention_mask  = extended_visual_attention_mask,
+            output_x_hidden_states = output_x_hidden_states,
         )
+        visual_feats , lang_feats = encoder_outputs[:2]
         
         pooled_output = self.pooler(lang_feats)
         
@@ -116,8 +146,22 @@ class MyLxmert(LxmertPreTrainedModel):
             pooled_output= pooled_output,
             language_output=lang_feats, 
             vision_output=visual_feats, 
+            # comment 每个x_layer输出的文本特征，early exit的中间分类器用
+            language_hidden_states=encoder_outputs[2] if output_x_hidden_states else None,
         )
 
+    def extend_masks(self, attention_mask, visual_attention_mask):
+        # comment self.dtype 每次都要遍历参数，只取一次
+        dtype = self.visn_fc.visn_layer_norm.weight.dtype
+        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        extended_attention_mask = extended_attention_mask.to(dtype=dtype)
+        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        # comment 视觉mask按调用方传的值每次算，[B,1]上一个逐元素运算，不缓存
+        extended_visual_attention_mask = visual_attention_mask.unsqueeze(1).unsqueeze(2)
+        extended_visual_attention_mask = extended_visual_attention_mask.to(dtype=dtype)
+        extended_visual_attention_mask = (1.0 - extended_visual_attention_mask) * -10000.0
+        return extended_attention_mask , extended_visual_attention_mask
+
 
 class MyLxmertForPreTraining(LxmertPreTrainedModel):
     def __init__(self,config):
@@ -182,6 +226,15 @@ class MyLxmertFinetune(LxmertPreTrainedModel):
         self.mylxmert = MyLxmert(config)       
         self.cls = nn.Linear(config.hidden_size, output_dim)
         self.sigmoid = nn.Sigmoid()
+        # comment early exit: 除最后一层外每个x_layer后面接一个中间分类器，和最终分类器一起训练
+        self.exit_heads = None
+        if getattr(config, 'early_exit', False):
+            self.exit_heads = nn.ModuleList([
+                nn.Sequential(LxmertPooler(config), nn.Linear(config.hidden_size, output_dim), nn.Sigmoid())
+                for _ in range(config.x_layers - 1)
+            ])
+        # comment prune.py剪过头的模型，config里记录了每个attention单元剩余的头数
+        resize_attention_heads(self, getattr(config, 'pruned_attention_heads', None))
     def forward(
         self,
         input_ids , 
@@ -201,6 +254,65 @@ class MyLxmertFinetune(LxmertPreTrainedModel):
         output = self.sigmoid(self.cls(pooled_output))
         return output
 
+    def forward_exits(
+        self,
+        input_ids , 
+        attention_mask , 
+        token_type_ids , 
+        visual_feats ,  
+        visual_attention_mask ,
+    ):
+        # comment 训练用: 返回每个中间分类器和最终分类器的输出，最后一个是最终分类器
+        output = self.mylxmert(
+            input_ids=input_ids,
+            visual_feats=visual_feats,
+            token_type_ids=token_type_ids,
+            attention_mask=attention_mask,
+            visual_attention_mask=visual_attention_mask,
+            output_x_hidden_states=True,
+        )
+        exit_outputs = [exit_head(lang_feats) for exit_head , lang_feats in zip(self.exit_heads, output.language_hidden_states)]
+        return exit_outputs + [self.sigmoid(self.cls(output.pooled_output))]
+
+    def early_exit_forward(
+        self,
+        input_ids , 
+        attention_mask , 
+        token_type_ids , 
+        visual_feats ,  
+        visual_attention_mask ,
+        exit_margin = 0.45 ,
+    ):
+        # comment 推理用: 某条样本13个输出都满足 |p-0.5| >= exit_margin 就在当前层退出
+        # comment 每层之后把还没退出的行压缩到一起，后面的层只算剩下的样本
+        # comment 返回 输出 [batch_size, output_dim] 和每条样本实际跑的x_layers层数 [batch_size]
+        mylxmert = self.mylxmert
+        encoder = mylxmert.encoder
+        extended_attention_mask , extended_visual_attention_mask = mylxmert.extend_masks(attention_mask, visual_attention_mask)
+        lang_feats , visual_feats = encoder.single_stream(input_ids, token_type_ids, extended_attention_mask, mylxmert.visn_fc(visual_feats), extended_visual_attention_mask)
+        batch_size , num_x_layers = input_ids.shape[0] , len(encoder.x_layers)
+        output = lang_feats.new_zeros(batch_size, self.output_dim)
+        exit_layers = input_ids.new_full((batch_size,), num_x_layers)
+        active = torch.arange(batch_size, device=input_ids.device)
+        for i , layer_module in enumerate(encoder.x_layers):
+            lang_feats , visual_feats = layer_module(lang_feats, extended_attention_mask, visual_feats, extended_visual_attention_mask)[:2]
+            if i == num_x_layers - 1:
+                output[active] = self.sigmoid(self.cls(mylxmert.pooler(lang_feats)))
+                break
+            prob = self.exit_heads[i](lang_feats)
+            done = ((prob - 0.5).abs() >= exit_margin).all(dim=1)
+            if not done.any():
+                continue
+            output[active[done]] = prob[done]
+            exit_layers[active[done]] = i + 1
+            keep = ~done
+            if not keep.any():
+                break
+            active = active[keep]
+            lang_feats , visual_feats = lang_feats[keep] , visual_feats[keep]
+            extended_attention_mask , extended_visual_attention_mask = extended_attention_mask[keep] , extended_visual_attention_mask[keep]
+        return output , exit_layers
+
 
 
         
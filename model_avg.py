@@ -0,0 +1,120 @@
+
+import os
+import json
+import shutil
+import argparse
+import collections
+
+import torch
+
+WEIGHTS_NAME = 'pytorch_model.bin'
+SAFE_WEIGHTS_NAME = 'model.safetensors'
+# comment --save_format 对应的权重文件名
+WEIGHTS_NAMES = {'bin': WEIGHTS_NAME, 'safetensors': SAFE_WEIGHTS_NAME}
+SCORE_NAME = 'best_score.json'
+
+
+def find_weights(model_dir):
+    # comment 目录下两种格式都有时优先safetensors，和transformers的from_pretrained一致
+    safe_path = os.path.join(model_dir, SAFE_WEIGHTS_NAME)
+    return safe_path if os.path.exists(safe_path) else os.path.join(model_dir, WEIGHTS_NAME)
+
+def load_state_dict(path):
+    # comment safetensors 不需要unpickle，文件mmap后按张量读取; .bin 在torch>=2.1上也用mmap加载
+    if path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(path, device='cpu')
+    # comment torch>=2.1 支持mmap加载，张量按需从文件读取，不会整份拷进内存
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location='cpu')
+
+def save_state_dict(state_dict, path):
+    # comment 按后缀选择格式; safetensors不允许张量共享存储(例如共享的embedding)，重复的拷贝一份
+    if not path.endswith('.safetensors'):
+        torch.save(state_dict, path)
+        return
+    from safetensors.torch import save_file
+    tensors , storages = collections.OrderedDict() , set()
+    for key, value in state_dict.items():
+        value = value.contiguous()
+        if value.untyped_storage().data_ptr() in storages:
+            value = value.clone()
+        storages.add(value.untyped_storage().data_ptr())
+        tensors[key] = value
+    save_file(tensors, path, metadata={'format': 'pt'})
+
+def read_score(model_dir):
+    with open(os.path.join(model_dir, SCORE_NAME), 'r', encoding='utf-8') as f:
+        return json.loads(f.read())['score']
+
+def write_score(model_dir, score):
+    with open(os.path.join(model_dir, SCORE_NAME), 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'score': score}))
+
+def average_state_dicts(model_dirs, weights=None):
+    # comment 逐个加载checkpoint，用float32原地累加，峰值内存约为 1份累加结果 + 1份当前checkpoint
+    if weights is None:
+        weights = [1.0] * len(model_dirs)
+    assert len(weights) == len(model_dirs) and sum(weights) > 0
+    total = float(sum(weights))
+    merge_state_dict , dtypes = None , {}
+    for model_dir , weight in zip(model_dirs, weights):
+        state_dict = load_state_dict(find_weights(model_dir))
+        ratio = weight / total
+        if merge_state_dict is None:
+            merge_state_dict = collections.OrderedDict()
+            for key, value in state_dict.items():
+                dtypes[key] = value.dtype
+                if value.is_floating_point():
+                    merge_state_dict[key] = value.to(torch.float32).mul(ratio)
+                else:
+                    # comment 非浮点的buffer(例如position_ids)直接取第一份
+                    merge_state_dict[key] = value.clone()
+        else:
+            assert state_dict.keys() == merge_state_dict.keys(), '%s 的参数和其他checkpoint不一致' % (model_dir)
+            for key, value in state_dict.items():
+                if value.is_floating_point():
+                    merge_state_dict[key].add_(value.to(torch.float32), alpha=ratio)
+        del state_dict
+    for key, dtype in dtypes.items():
+        if merge_state_dict[key].dtype != dtype:
+            merge_state_dict[key] = merge_state_dict[key].to(dtype)
+    return merge_state_dict
+
+def average_checkpoints(model_dirs, output_root, weighting='uniform'):
+    # comment 只处理state_dict，lxmert/vilt/vilbert 三种模型都适用
+    if weighting == 'score':
+        weights = [read_score(model_dir) for model_dir in model_dirs]
+    else:
+        weights = [1.0] * len(model_dirs)
+    merge_state_dict = average_state_dicts(model_dirs, weights)
+    os.makedirs(output_root, exist_ok=True)
+    # comment 融合结果和第一折用同一种格式保存
+    save_state_dict(merge_state_dict, os.path.join(output_root, os.path.basename(find_weights(model_dirs[0]))))
+    # comment config和词表各折都一样，从第一折拷贝，不需要再实例化模型
+    for file_name in os.listdir(model_dirs[0]):
+        if file_name in (WEIGHTS_NAME, SAFE_WEIGHTS_NAME, SCORE_NAME):
+            continue
+        src = os.path.join(model_dirs[0], file_name)
+        if os.path.isfile(src):
+            shutil.copy(src, os.path.join(output_root, file_name))
+    with open(os.path.join(output_root, 'avg_weights.json'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(dict(zip(model_dirs, weights)), indent=2, ensure_ascii=False))
+    return weights
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dirs',type=str,nargs='+',required=True,help='待融合的模型目录, 每个目录下有pytorch_model.bin或model.safetensors')
+    parser.add_argument('--output_root',type=str,required=True,help='融合模型的输出路径')
+    parser.add_argument('--weighting',type=str,default='uniform',choices=['uniform','score'],help='uniform: 等权平均; score: 按各折best_score.json加权')
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    weights = average_checkpoints(opt.model_dirs, opt.output_root, weighting=opt.weighting)
+    print('融合权重 : ', weights)
+    print('融合模型存储路径 : ', opt.output_root)
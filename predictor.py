@@ -0,0 +1,406 @@
+
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from datasets import delete_word , freeze_dataset , MatchDataset_v2
+from model_avg import find_weights , load_state_dict
+
+MODEL_TYPES = ('lxmert', 'vilt', 'vilbert')
+QUANT_WEIGHTS_NAME = 'pytorch_model_int8.bin'
+ONNX_NAME = 'model.onnx'
+MODEL_INPUT_NAMES = ('input_ids', 'attention_mask', 'token_type_ids', 'visual_embeds', 'visual_attention_mask')
+# comment 导出onnx时各模型的输入顺序，vilt没有visual_attention_mask
+ONNX_INPUT_NAMES = {
+    'lxmert': ('input_ids', 'attention_mask', 'token_type_ids', 'visual_embeds', 'visual_attention_mask'),
+    'vilt': ('input_ids', 'attention_mask', 'token_type_ids', 'visual_embeds'),
+    'vilbert': ('input_ids', 'attention_mask', 'token_type_ids', 'visual_embeds', 'visual_attention_mask'),
+}
+
+
+def load_label_list(path=os.path.join('./data', 'sort_label_list.txt')):
+    with open(path, 'r') as f:
+        return [label for label in f.read().strip().split()]
+
+def detect_model_type(model_dir):
+    # comment 根据config.json判断是哪一种模型
+    with open(os.path.join(model_dir, 'config.json'), 'r', encoding='utf-8') as f:
+        config = json.loads(f.read())
+    if 'v_biattention_id' in config:
+        return 'vilbert'
+    if config.get('model_type') in ('lxmert', 'vilt'):
+        return config['model_type']
+    raise ValueError('无法从 %s/config.json 判断模型类型' % (model_dir))
+
+def split_model_path(model_path, weights_name=None):
+    # comment model_path 可以是模型目录，也可以直接是目录下的权重文件
+    # comment 目录且不指定weights_name时自动选择 model.safetensors / pytorch_model.bin
+    if os.path.isdir(model_path):
+        return model_path , os.path.join(model_path, weights_name) if weights_name else find_weights(model_path)
+    return os.path.dirname(model_path) , model_path
+
+def build_finetune_model(model_dir, model_type, output_dim=13):
+    from transformers import LxmertConfig , ViltConfig
+    from lxmert import MyLxmertFinetune
+    from vilt import MyViltFinetune
+    from vilbert import MyVilBertFinetune , MyBertConfig
+    config_path = os.path.join(model_dir, 'config.json')
+    if model_type == 'lxmert':
+        return MyLxmertFinetune(LxmertConfig.from_json_file(config_path), output_dim=output_dim)
+    if model_type == 'vilt':
+        return MyViltFinetune(ViltConfig.from_json_file(config_path), output_dim=output_dim)
+    if model_type == 'vilbert':
+        return MyVilBertFinetune(MyBertConfig.from_json_file(config_path), output_dim=output_dim)
+    raise ValueError('不支持的模型类型 %s' % (model_type))
+
+def quantize_model(model):
+    # comment 动态int8量化: 所有nn.Linear(包括visn_fc)的权重转int8，激活在运行时量化，只支持cpu
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_finetune_model(model_path, model_type='auto', output_dim=13, quantized=False):
+    model_dir , weights_path = split_model_path(model_path, weights_name=QUANT_WEIGHTS_NAME if quantized else None)
+    if model_type == 'auto':
+        model_type = detect_model_type(model_dir)
+    model = build_finetune_model(model_dir, model_type, output_dim=output_dim)
+    if quantized:
+        model = quantize_model(model)
+    # comment int8权重里有打包的量化参数，只能用torch.load; 其余走mmap加载(safetensors不用unpickle)
+    state_dict = torch.load(weights_path, map_location='cpu') if quantized else load_state_dict(weights_path)
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model , model_type
+
+def model_forward(model, model_type, batch):
+    # comment 三种模型的forward参数名不一样，这里统一一下
+    if model_type == 'lxmert':
+        return model(
+            input_ids = batch['input_ids'],
+            attention_mask = batch['attention_mask'],
+            token_type_ids = batch['token_type_ids'],
+            visual_feats = batch['visual_embeds'],
+            visual_attention_mask = batch['visual_attention_mask'],
+        )
+    if model_type == 'vilt':
+        return model(
+            input_ids = batch['input_ids'],
+            attention_mask = batch['attention_mask'],
+            token_type_ids = batch['token_type_ids'],
+            feats = batch['visual_embeds'],
+        )
+    return model(
+        input_ids = batch['input_ids'],
+        token_type_ids = batch['token_type_ids'],
+        attention_mask = batch['attention_mask'],
+        feats = batch['visual_embeds'],
+        feats_attention_mask = batch['visual_attention_mask'],
+    )
+
+def load_match_dataset(data_path, tokenizer, max_len=35, **kwargs):
+    # comment 从训练数据格式的json构造MatchDataset_v2，kwargs为增强参数
+    label2id = {label: i for i, label in enumerate(load_label_list())}
+    with open(os.path.join('./data', 'attr_to_attrvals.json'), 'r') as f:
+        key_attr_values = json.loads(f.read())
+    with open('./color.txt', 'r') as f:
+        color_set = set(line[:-1] for line in f.readlines())
+    with open(data_path, 'r', encoding='utf-8') as f:
+        data = json.loads(f.read())
+    return MatchDataset_v2(
+        tokenizer = tokenizer ,
+        texts = [delete_word(text) for text in data['texts']] ,
+        labels = data['labels'] ,
+        visual_embeds = data['img_features'] ,
+        label_masks = data['label_masks'] ,
+        key_attrs = data['key_attrs'] ,
+        key_attr_values = key_attr_values ,
+        label2id = label2id ,
+        max_len = max_len ,
+        color_set = color_set ,
+        **kwargs
+    )
+
+def load_frozen_val_set(data_path, tokenizer, cache_path=None, seed=42, max_len=35):
+    # comment 验证集的负样本是随机生成的，固定种子展开一次并缓存，不同模型/不同后端的分数才可以直接比较
+    if cache_path is not None and os.path.exists(cache_path):
+        return torch.load(cache_path)
+    dataset = load_match_dataset(data_path, tokenizer, max_len=max_len, p6=-1, p7=-1)
+    frozen = freeze_dataset(dataset, seed=seed)
+    if cache_path is not None:
+        torch.save(frozen, cache_path)
+    return frozen
+
+def score_outputs(output, labels, label_masks, threshold=0.5):
+    # comment 和finetune脚本评估的算法一致: 0.5 * 图文准确率 + 0.5 * 有效属性准确率
+    pred = (output >= threshold).float()
+    img_text_score = (pred[:, 0] == labels[:, 0]).float().mean().item()
+    attr_masks = label_masks[:, 1:] == 1
+    attr_score = (pred[:, 1:][attr_masks] == labels[:, 1:][attr_masks]).float().mean().item()
+    return 0.5 * img_text_score + 0.5 * attr_score , img_text_score , attr_score
+
+class ForwardWrapper(torch.nn.Module):
+    # comment onnx导出/trace/compile都按位置传参，这里把位置参数还原成各模型forward需要的关键字参数
+    def __init__(self, model, model_type):
+        super().__init__()
+        self.model = model
+        self.model_type = model_type
+        self.input_names = ONNX_INPUT_NAMES[model_type]
+
+    def forward(self, *inputs):
+        return model_forward(self.model, self.model_type, dict(zip(self.input_names, inputs)))
+
+def time_forward(predictor, data, batch_size, repeat=10):
+    # comment 取data的前batch_size条，预热一次后测平均每个batch的前向耗时(ms)
+    batch = {key: data[key][:batch_size] for key in MODEL_INPUT_NAMES if key in data}
+    predictor.forward(batch)
+    since = time.time()
+    for _ in range(repeat):
+        predictor.forward(batch)
+    return (time.time() - since) / repeat * 1000
+
+def iter_samples(path):
+    # comment .json 为训练数据的格式 {'texts': [...], 'img_features': [...]}，其余按jsonl逐行流式读取
+    if path.endswith('.json'):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.loads(f.read())
+        img_names = data.get('img_names', [str(i) for i in range(len(data['texts']))])
+        for img_name , text , feature in zip(img_names, data['texts'], data['img_features']):
+            yield {'img_name': img_name, 'title': text, 'feature': feature}
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def iter_chunks(samples, chunk_size):
+    chunk = []
+    for sample in samples:
+        chunk.append(sample)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def length_sorted_batches(texts, batch_size):
+    # comment 按文本长度排序后再切batch，同一个batch内padding最少
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    for start in range(0, len(order), batch_size):
+        yield order[start:start + batch_size]
+
+def format_result(sample, prob, label2id, threshold=0.5, save_prob=False):
+    query = sample.get('query', list(label2id))
+    result = {
+        'img_name': sample.get('img_name'),
+        'match': {attr: int(prob[label2id[attr]] >= threshold) for attr in query},
+    }
+    if save_prob:
+        result['prob'] = {attr: round(float(prob[label2id[attr]]), 6) for attr in query}
+    return result
+
+
+class Predictor(object):
+    # comment 模型只加载一次，按长度排序分batch，在inference_mode下批量预测
+    def __init__(self, model, model_type, tokenizer, device='cpu', batch_size=256, max_len=35, output_dim=13):
+        self.model = model.to(device)
+        self.model_type = model_type
+        self.tokenizer = tokenizer
+        self.device = device
+        self.batch_size = batch_size
+        self.max_len = max_len + 2
+        self.output_dim = output_dim
+
+    def collate(self, texts, features):
+        inputs = self.tokenizer(texts, padding='longest', max_length=self.max_len, truncation=True, return_tensors='pt')
+        visual_embeds = torch.from_numpy(np.asarray(features, dtype=np.float32)).unsqueeze(1)   # shape [batch_size, 1, 2048]
+        return {
+            'input_ids': inputs['input_ids'],
+            'attention_mask': inputs['attention_mask'],
+            'token_type_ids': inputs['token_type_ids'],
+            'visual_embeds': visual_embeds,
+            'visual_attention_mask': torch.ones(visual_embeds.shape[:-1], dtype=torch.float),
+        }
+
+    def forward(self, batch):
+        with torch.inference_mode():
+            batch = {key: batch[key].to(self.device) for key in MODEL_INPUT_NAMES if key in batch}
+            return model_forward(self.model, self.model_type, batch).float().cpu()
+
+    def predict_batches(self, data):
+        # comment data 为已经tokenize好的整份数据(例如冻结的验证集)，按batch_size切片预测
+        num = data['input_ids'].shape[0]
+        probs = torch.empty(num, self.output_dim)
+        for start in range(0, num, self.batch_size):
+            batch = {key: data[key][start:start + self.batch_size] for key in MODEL_INPUT_NAMES}
+            probs[start:start + self.batch_size] = self.forward(batch)
+        return probs
+
+    def predict(self, samples):
+        texts = [delete_word(sample['title']) for sample in samples]
+        probs = torch.empty(len(samples), self.output_dim)
+        for idxs in length_sorted_batches(texts, self.batch_size):
+            batch = self.collate([texts[i] for i in idxs], [samples[i]['feature'] for i in idxs])
+            probs[idxs] = self.forward(batch)
+        return probs
+
+def load_attr_weights(path):
+    if path is None:
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.loads(f.read())
+
+def build_ensemble_weights(label_list, model_weights, attr_weights=None):
+    # comment 权重矩阵 [num_models, num_labels] = 模型权重 * 属性权重，每个属性在各模型上归一化
+    weights = torch.tensor(model_weights, dtype=torch.float).unsqueeze(1).repeat(1, len(label_list))
+    if attr_weights is not None:
+        assert len(attr_weights) == len(model_weights), 'attr_weights 需要和模型一一对应'
+        for i, model_attr_weights in enumerate(attr_weights):
+            for attr, weight in model_attr_weights.items():
+                weights[i, label_list.index(attr)] *= weight
+    total = weights.sum(dim=0, keepdim=True)
+    assert (total > 0).all(), '每个属性至少要有一个模型权重大于0'
+    return weights / total
+
+
+class OnnxPredictor(Predictor):
+    # comment 用onnxruntime跑export_onnx.py导出的图，只在cpu上用，collate/predict和pytorch版本共用
+    def __init__(self, onnx_path, model_type, tokenizer, batch_size=256, max_len=35, output_dim=13, num_threads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.model_type = model_type
+        self.tokenizer = tokenizer
+        self.device = 'cpu'
+        self.batch_size = batch_size
+        self.max_len = max_len + 2
+        self.output_dim = output_dim
+
+    def forward(self, batch):
+        feed = {name: batch[name].cpu().numpy() for name in self.input_names}
+        return torch.from_numpy(self.session.run(None, feed)[0]).float()
+
+
+class EarlyExitPredictor(Predictor):
+    # comment lxmert early exit: 有把握的样本在中间的x_layer就退出，后面的层只算剩下的样本
+    def __init__(self, model, model_type, tokenizer, device='cpu', batch_size=256, max_len=35, output_dim=13, exit_margin=0.45):
+        assert model_type == 'lxmert' and getattr(model, 'exit_heads', None) is not None, 'early exit 需要用 finetune_lxmert.py --early_exit 训练的模型'
+        super().__init__(model, model_type, tokenizer, device=device, batch_size=batch_size, max_len=max_len, output_dim=output_dim)
+        self.exit_margin = exit_margin
+        self.num_samples = 0
+        self.num_layers = 0
+
+    def forward(self, batch):
+        with torch.inference_mode():
+            batch = {key: batch[key].to(self.device) for key in MODEL_INPUT_NAMES if key in batch}
+            output , exit_layers = self.model.early_exit_forward(
+                input_ids=batch['input_ids'],
+                attention_mask=batch['attention_mask'],
+                token_type_ids=batch['token_type_ids'],
+                visual_feats=batch['visual_embeds'],
+                visual_attention_mask=batch['visual_attention_mask'],
+                exit_margin=self.exit_margin,
+            )
+            self.num_samples += exit_layers.shape[0]
+            self.num_layers += exit_layers.sum().item()
+            return output.float().cpu()
+
+    def average_layers(self):
+        return self.num_layers / max(self.num_samples, 1)
+
+
+class FastPredictor(Predictor):
+    # comment 编译后的推理路径: 优先torch.compile, 不可用或编译失败时退回TorchScript(trace + freeze)
+    #   视觉特征只有一个, visual_attention_mask 恒为1, 按batch大小缓存在目标设备上
+    #   启动时按常见的(batch, seq)形状预热, 把编译/优化的开销放在第一个请求之前
+    def __init__(self, model, model_type, tokenizer, device='cpu', batch_size=256, max_len=35, output_dim=13, backend='compile', warmup_shapes=None):
+        super().__init__(model, model_type, tokenizer, device=device, batch_size=batch_size, max_len=max_len, output_dim=output_dim)
+        self.model.eval()
+        self.input_names = ONNX_INPUT_NAMES[model_type]
+        self.visual_masks = {}
+        self.backend = backend
+        self.runner = self.build_runner(backend)
+        if warmup_shapes is None:
+            warmup_shapes = [(size, seq_len) for size in sorted({1, min(32, batch_size), batch_size}) for seq_len in (16, self.max_len)]
+        self.warmup(warmup_shapes)
+
+    def build_runner(self, backend):
+        wrapper = ForwardWrapper(self.model, self.model_type).eval()
+        if backend == 'compile' and hasattr(torch, 'compile'):
+            try:
+                runner = torch.compile(wrapper, dynamic=True)
+                self.run(runner, self.dummy_batch(2, 8))
+                return runner
+            except Exception as e:
+                print('torch.compile 失败, 退回TorchScript : %r' % (e))
+        self.backend = 'script'
+        with torch.inference_mode(False), torch.no_grad():
+            traced = torch.jit.trace(wrapper, tuple(self.dummy_batch(2, 8)[name] for name in self.input_names), check_trace=False, strict=False)
+            return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+    def dummy_batch(self, batch_size, seq_len):
+        batch = {
+            'input_ids': torch.full((batch_size, seq_len), self.tokenizer.cls_token_id or 0, dtype=torch.long),
+            'attention_mask': torch.ones(batch_size, seq_len, dtype=torch.long),
+            'token_type_ids': torch.zeros(batch_size, seq_len, dtype=torch.long),
+            'visual_embeds': torch.zeros(batch_size, 1, 2048),
+        }
+        batch = {key: value.to(self.device) for key, value in batch.items()}
+        batch['visual_attention_mask'] = self.visual_mask(batch_size)
+        return batch
+
+    def visual_mask(self, batch_size):
+        if batch_size not in self.visual_masks:
+            self.visual_masks[batch_size] = torch.ones(batch_size, 1, dtype=torch.float, device=self.device)
+        return self.visual_masks[batch_size]
+
+    def run(self, runner, batch):
+        with torch.no_grad():
+            return runner(*[batch[name] for name in self.input_names])
+
+    def warmup(self, shapes):
+        for batch_size , seq_len in shapes:
+            since = time.time()
+            self.run(self.runner, self.dummy_batch(batch_size, seq_len))
+            print('预热 %s batch %d seq %d 用时 %.3f s' % (self.backend, batch_size, seq_len, time.time() - since))
+
+    def forward(self, batch):
+        batch_size = batch['input_ids'].shape[0]
+        batch = {key: batch[key].to(self.device) for key in self.input_names if key != 'visual_attention_mask'}
+        batch['visual_attention_mask'] = self.visual_mask(batch_size)
+        return self.run(self.runner, batch).float().cpu()
+
+
+class EnsemblePredictor(Predictor):
+    # comment 多模型融合，数据只读取和tokenize一次，每个batch依次(或并行)送进各个模型
+    def __init__(self, predictors, tokenizer, weights, batch_size=256, max_len=35, output_dim=13, num_workers=1):
+        assert len(predictors) == weights.shape[0]
+        self.predictors = predictors
+        self.tokenizer = tokenizer
+        self.devices = sorted(set(predictor.device for predictor in self.predictors))
+        self.batch_size = batch_size
+        self.max_len = max_len + 2
+        self.output_dim = output_dim
+        self.weights = weights
+        # comment torch的算子会释放GIL，线程池即可让多个模型同时跑
+        self.executor = ThreadPoolExecutor(num_workers) if num_workers > 1 else None
+
+    def forward(self, batch):
+        # comment 同一设备上的模型共用一份拷贝
+        device_batches = {device: {key: batch[key].to(device) for key in MODEL_INPUT_NAMES if key in batch} for device in self.devices}
+        run = lambda predictor: predictor.forward(device_batches[predictor.device])
+        if self.executor is not None:
+            probs = list(self.executor.map(run, self.predictors))
+        else:
+            probs = [run(predictor) for predictor in self.predictors]
+        return (torch.stack(probs) * self.weights.unsqueeze(1)).sum(dim=0)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -1,20 +1,14 @@
 
 
 import time
+import gc
 import numpy as np
 import json
-from transformers import (
-    BertTokenizer, 
-    set_seed,
-    DataCollatorForLanguageModeling,
-)
-from sklearn.model_selection import train_test_split
-from transformers import LxmertConfig
-from transformers import LxmertTokenizer
 from torch.utils.data import DataLoader
 
 import torch
-from lxmert import MyLxmertForPreTraining
+from helper import enable_gradient_checkpointing , build_step_timer , build_profiler , build_memory_reporter , build_checkpoint , ResumableRandomSampler , ModelSaver , get_accum_size
+from model_avg import WEIGHTS_NAMES
 import argparse
 import os
 from datasets import *
@@ -22,6 +16,7 @@ from datasets import *
 device = "cuda"
 import  random
 def seed_everything(seed):
+    from transformers import set_seed
     set_seed(seed)
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
@@ -32,7 +27,10 @@ def seed_everything(seed):
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
 def train(opt):
+    from transformers import DataCollatorForLanguageModeling , LxmertConfig , LxmertTokenizer
+    from lxmert import MyLxmertForPreTraining
     seed_everything(opt.seed)
+    memory = build_memory_reporter(opt)
 
     # 加载颜色词
     
@@ -64,6 +62,7 @@ def train(opt):
         coarse_data = json.loads(f.read())
     with open(fine_train_path, 'r', encoding='utf-8') as f:
         fine_data = json.loads(f.read())
+    memory.phase('read_json', fine_data = fine_data, coarse_data = coarse_data)
     # 获取数据
     print('读取数据花费的时间:', time.time() - t1)
     fine_texts, fine_img_features, fine_labels = fine_data['texts'], fine_data['img_features'], fine_data['labels']
@@ -74,54 +73,42 @@ def train(opt):
     fine_texts = [delete_word(text) for text in fine_texts]
     coarse_texts = [delete_word(text) for text in coarse_texts]
 
-    data_texts = np.array(fine_texts  + coarse_texts )
-    data_img_features = np.array(fine_img_features  + coarse_img_features )
-    data_labels = np.array(fine_labels  + coarse_labels )
-    data_key_attrs = np.array(fine_key_attrs  + coarse_key_attrs )
+    # comment fine和coarse放进同一份语料, 特征只存一份; 训练/测试集只是语料上的索引视图, 不再fancy-index拷贝
+    corpus = SharedMatchCorpus(
+        texts           = fine_texts + coarse_texts,
+        img_features    = fine_img_features + coarse_img_features,
+        labels          = fine_labels + coarse_labels,
+        key_attrs       = fine_key_attrs + coarse_key_attrs,
+    )
+    del fine_data , coarse_data , fine_img_features , coarse_img_features
+    gc.collect()
+    memory.phase('corpus', texts = corpus.texts, visual_embeds = corpus.visual_embeds, labels = corpus.labels, key_attrs = corpus.key_attrs)
     assert 0 <= opt.test_rate < 1
-    # 如果test_size为0，即全部数据一起训练
-    if opt.test_rate == 0:
-        _, test_idxs = train_test_split(range(len(data_texts)), test_size=0.3)
-        train_idxs = [i for i in range(len(data_texts))]
-    else:
-        # 划分训练集和测试集
-        train_idxs, test_idxs = train_test_split(range(len(data_texts)), test_size=opt.test_rate)
-
-    train_texts = data_texts[train_idxs]
-    train_img_features = data_img_features[train_idxs]
-    train_labels = data_labels[train_idxs]
-    train_key_attrs = data_key_attrs[train_idxs]
-    test_texts = data_texts[test_idxs]
-    test_img_features = data_img_features[test_idxs]
-    test_labels = data_labels[test_idxs]
-    test_key_attrs = data_key_attrs[test_idxs]
+    # comment 如果test_rate为0，即全部数据一起训练; 划分写到output_root, --split_path 复用
+    train_idxs , test_idxs = split_indices(len(corpus), opt.test_rate, split_path = opt.split_path)
+    save_split(os.path.join(opt.output_root, 'split.npz'), train_idxs, test_idxs)
 
-    print('构造数据集合完成。训练集合 %d 测试集合 %d'%(len(train_texts),len(test_texts)))
+    print('构造数据集合完成。训练集合 %d 测试集合 %d'%(len(train_idxs),len(test_idxs)))
     tokenizer = LxmertTokenizer.from_pretrained(opt.tokenizer_path)     
     train_dataset = PreDataset_v2(
         tokenizer = tokenizer ,
-        texts = train_texts , 
-        visual_embeds = train_img_features ,
-        labels = train_labels ,
-        key_attrs = train_key_attrs ,
         key_attr_values = key_attr_values ,
         color_set = color_set,
+        **corpus.view(train_idxs),
     )
 
     test_dataset = PreDataset_v2(
         tokenizer = tokenizer ,
-        texts = test_texts,
-        visual_embeds = test_img_features,
-        labels = test_labels,
-        key_attrs = test_key_attrs ,
         key_attr_values = key_attr_values,
         color_set = color_set,
+        **corpus.view(test_idxs),
     )
 
     data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm_probability=0.15)
 
     # DataLoaders creation:
-    train_dataloader = DataLoader(train_dataset , shuffle=True , collate_fn = data_collator , batch_size = opt.batch_size, num_workers=opt.num_workers)
+    train_sampler = ResumableRandomSampler(train_dataset, seed=opt.seed)
+    train_dataloader = DataLoader(train_dataset , sampler=train_sampler , collate_fn = data_collator , batch_size = opt.batch_size, num_workers=opt.num_workers)
     test_dataloader = DataLoader(test_dataset , shuffle=False , collate_fn = data_collator , batch_size = opt.batch_size , num_workers=opt.num_workers)
     
 
@@ -139,8 +126,11 @@ def train(opt):
         x_layers = opt.x_layer,  
     )
     pretrain_mylxmert = MyLxmertForPreTraining(config)
+    if opt.gradient_checkpointing:
+        enable_gradient_checkpointing(pretrain_mylxmert)
     optim = torch.optim.AdamW(pretrain_mylxmert.parameters(), lr=opt.lr,betas=(0.95,0.999),weight_decay=1e-4)   # TODO 用余弦衰减率
     pretrain_mylxmert = torch.nn.parallel.DataParallel(pretrain_mylxmert.to(device))
+    memory.phase('model', model = pretrain_mylxmert.module)
     # pretrain_mylxmert.to(device)
 
     
@@ -148,10 +138,28 @@ def train(opt):
 
     record_epoch_arr = []
     min_loss = float('inf')
-    for epoch in range(opt.epochs):
+    # comment --resume 时从最近的完整checkpoint继续: 跳过已经训练完的epoch和当前epoch里已经训练过的step
+    checkpoint = build_checkpoint(opt, os.path.join(opt.output_root, 'checkpoint'))
+    # comment save_model和checkpoint共用一个后台写盘线程，checkpoint.close()时一起写完
+    saver = ModelSaver(writer=checkpoint.writer)
+    start_epoch , start_step = 0 , 0
+    if opt.resume:
+        start_epoch , start_step , state = checkpoint.restore(pretrain_mylxmert, optim)
+        if state is not None:
+            record_epoch_arr , min_loss = state['record_epoch_arr'] , state['min_loss']
+    timer = build_step_timer(opt)
+    profiler = build_profiler(opt, os.path.join(opt.output_root, 'profile'))
+    profiler.start()
+    memory.watch_workers()
+    for epoch in range(start_epoch, opt.epochs):
+        skip_steps = start_step if epoch == start_epoch else 0
+        train_sampler.set_epoch(epoch, skip_steps * opt.batch_size)
         since = time.time()
         pretrain_mylxmert.train()
-        for _, batch in enumerate(train_dataloader):
+        optim.zero_grad()
+        timer.start()
+        for step, batch in enumerate(train_dataloader, skip_steps):
+            timer.lap('data')
 
             input_ids = batch['input_ids'].to(device)                           # shape[batch_size, seq_len] 
             attention_mask = batch['attention_mask'].to(device)                 # shape[batch_size, seq_len] 
@@ -160,6 +168,7 @@ def train(opt):
             visual_attention_mask = batch['visual_attention_mask'].to(device)   # shape[batch_size, 1]      
             is_pared = batch['sentence_image_labels'].to(device)                # shape[batch_size, 1]      是否图文匹配
             true_mlm_text = batch['labels'].to(device)                          # shape[batch_size, seq_len]   真实文本的标签
+            timer.lap('h2d')
             output_dict = pretrain_mylxmert(
                 input_ids = input_ids , 
                 attention_mask = attention_mask,
@@ -171,11 +180,20 @@ def train(opt):
             )
             mlm_loss , match_loss = output_dict['mlm_loss'],output_dict['match_loss']
             loss = mlm_loss + match_loss
-            optim.zero_grad()
-            loss.backward()
-            optim.step()
+            timer.lap('forward')
+            (loss / get_accum_size(step, len(train_dataloader), opt.grad_accum_steps)).backward()
+            timer.lap('backward')
+            if (step + 1) % opt.grad_accum_steps == 0 or step + 1 == len(train_dataloader):
+                optim.step()
+                optim.zero_grad()
+                if checkpoint.due():
+                    checkpoint.save(epoch, step + 1, pretrain_mylxmert, optim, record_epoch_arr = record_epoch_arr, min_loss = min_loss)
+            timer.lap('optim')
+            timer.end_step()
+            profiler.step()
             
 
+        timer.start()
         with torch.no_grad():
             pretrain_mylxmert.eval()
             count  , test_mlm_losses , test_match_losses  = 0  , 0.0 , 0.0
@@ -205,6 +223,7 @@ def train(opt):
                 test_mlm_losses += mlm_loss.detach().cpu().numpy().item()
                 test_match_losses += match_loss.cpu().numpy().item()
                 count += 1
+        timer.lap('eval')
         test_mlm_losses /= count
         test_match_losses /= count
         correct_rate = total_right_num /total_num 
@@ -216,9 +235,12 @@ def train(opt):
         if current_loss < min_loss:
             min_loss = current_loss
             is_save_model =1 
-            save_model(pretrain_mylxmert , tokenizer , opt)
+            save_model(pretrain_mylxmert , tokenizer , opt , saver = saver)
         print('Epoch %d (t %.2f min) correct_rate %.6f mlm_l %.6f match_l %.6f SaveMode %d.'%(epoch,using_time, correct_rate,test_mlm_losses,test_match_losses,is_save_model))
+        checkpoint.save(epoch + 1, 0, pretrain_mylxmert, optim, record_epoch_arr = record_epoch_arr, min_loss = min_loss)
 
+    profiler.stop()
+    checkpoint.close()
     # 保存模型保存记录结果
     strings = time.strftime('%Y,%m,%d,%H,%M,%S')
     t = strings.split(',')
@@ -229,6 +251,8 @@ def train(opt):
     # 保存训练记录
     full_path = os.path.join(dir_path,'static-%02d%02d.npy'%(number[3],number[4]))
     np.save(full_path,record_epoch_arr)
+    timer.save(dir_path, 'step_time-%02d%02d.json'%(number[3],number[4]))
+    memory.save(dir_path, 'memory-%02d%02d.json'%(number[3],number[4]))
 
     write_opt(opt)
 
@@ -247,17 +271,14 @@ def write_opt(opt):
     with open(os.path.join(dir_path,'opt_parm.txt'),'w+',encoding='utf-8') as file:
         file.write(content)
 
-def save_model(model,tokenizer,opt):
+def save_model(model,tokenizer,opt,saver):
     strings = time.strftime('%Y,%m,%d,%H,%M,%S')
     t = strings.split(',')
     number = [int(i) for i in t]
     dir_path = os.path.join(opt.output_root)  
 
-    os.makedirs(dir_path,exist_ok=True)
-    model_to_save = model.module if hasattr(model, 'module') else model
-    torch.save(model_to_save.state_dict(), os.path.join(dir_path, 'pytorch_model.bin'))
-    model_to_save.config.to_json_file( os.path.join(dir_path, 'config.json'))
-    tokenizer.save_vocabulary(dir_path)
+    # comment 参数拷到cpu后由后台线程原子写入，config.json和词表没变时跳过
+    saver.save(model, tokenizer, dir_path, weights_name=WEIGHTS_NAMES[opt.save_format])
 
 def parse_opt():
     parser = argparse.ArgumentParser()
@@ -266,17 +287,32 @@ def parse_opt():
     parser.add_argument('--tokenizer_path',type=str,default='./',help='tokenizer path') # comment 使用自己创建的字典
     parser.add_argument('--data_root',type = str , default='./data/',help='数据根路径')
     parser.add_argument('--output_root',type = str , default='./lxmert_model/pretrain/',help = '输出根路径' )
+    parser.add_argument('--save_format',type=str,default='safetensors',choices=['safetensors','bin'],help='模型权重格式, safetensors: model.safetensors(mmap加载, 启动快); bin: pytorch_model.bin')
 
     parser.add_argument('--num_workers',type =int,default=16)
     parser.add_argument('--test_rate',type = float,default=0.1,help='测试集的比例')
+    parser.add_argument('--split_path',type=str,default=None,help='复用之前保存的训练/测试集划分(output_root/split.npz), 不设置时按test_rate重新划分')
     parser.add_argument('--epochs',type=int,default=40)
     parser.add_argument('--lr',type=float,default=1e-4) # TODO
     parser.add_argument('--batch_size',type = int,default=512)
     parser.add_argument('--gpu',type = int, default=0,help='GPU')
+    parser.add_argument('--grad_accum_steps',type = int, default=1, help='梯度累积步数, 等效batch = batch_size * grad_accum_steps')
+    parser.add_argument('--gradient_checkpointing',action='store_true', help='encoder各层开启activation checkpointing, 省显存')
 
     parser.add_argument('--r_layer',type = int,default=2,help='r_layer')
     parser.add_argument('--x_layer',type = int,default=3,help='x_layer')
     parser.add_argument('--l_layer',type = int,default=5,help='l_layer')
+    parser.add_argument('--step_timing',action='store_true',help='按step记录 等数据/拷贝/前向/反向/优化器/评估 的耗时, 训练结束把分位数写到output_root')
+    parser.add_argument('--trace_steps',type=int,nargs='+',default=None,help='这些step的计时另外导出成chrome trace')
+    parser.add_argument('--profile',action='store_true',help='用torch.profiler记录一段训练step, tensorboard trace和top-N算子表写到output_root/profile')
+    parser.add_argument('--profile_wait',type=int,default=5,help='profile: 跳过前多少个训练step')
+    parser.add_argument('--profile_steps',type=int,default=5,help='profile: 记录多少个训练step')
+    parser.add_argument('--profile_top',type=int,default=30,help='profile: 算子表的行数')
+    parser.add_argument('--profile_with_stack',action='store_true',help='profile: 记录python调用栈, 可以看到算子属于哪个模块')
+    parser.add_argument('--memory_report',action='store_true',help='每个加载阶段后打印rss和各数据结构的大小, 训练时定时记录DataLoader worker的rss/pss, 结束后写到output_root')
+    parser.add_argument('--memory_interval',type=float,default=30.0,help='memory_report: worker内存的采样间隔(秒)')
+    parser.add_argument('--resume',action='store_true',help='从output_root/checkpoint/last.pt恢复模型/优化器/scheduler/随机数状态和训练进度继续训练, 没有时从头训练')
+    parser.add_argument('--checkpoint_steps',type=int,default=500,help='每多少次参数更新写一次完整checkpoint(后台线程写), 0 表示只在每个epoch结束时写')
 
 
     
@@ -0,0 +1,279 @@
+
+import os
+import copy
+import json
+import time
+import shutil
+import argparse
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from helper import find_attention_units , prune_attention_heads , MyWarmupCosineSchedule
+from predictor import (
+    Predictor,
+    load_finetune_model,
+    split_model_path,
+    load_frozen_val_set,
+    load_match_dataset,
+    model_forward,
+    score_outputs,
+    time_forward,
+    MODEL_INPUT_NAMES,
+)
+from model_avg import WEIGHTS_NAME , SAFE_WEIGHTS_NAME
+
+REPORT_NAME = 'prune_report.json'
+# comment 可整层删除的层: {模型类型: (encoder路径, {层列表属性: config里的层数属性})}
+LAYER_GROUPS = {
+    'lxmert': ('mylxmert.encoder', {'l_layers': 'l_layers', 'x_layers': 'x_layers', 'r_layers': 'r_layers'}),
+    'vilbert': ('myvilbert.encoder', {'l_layer': 'num_hidden_layers', 'v_layer': 'v_num_hidden_layers', 'c_layer': None}),
+}
+
+
+def get_encoder(model, model_type):
+    encoder = model
+    for name in LAYER_GROUPS[model_type][0].split('.'):
+        encoder = getattr(encoder, name)
+    return encoder
+
+def remove_layers(model, model_type, layers):
+    # comment layers: [(层列表属性, 下标)]，从后往前删，同时更新config和encoder里依赖层号的属性
+    encoder = get_encoder(model, model_type)
+    config = model.config
+    for group , idx in sorted(layers, key=lambda layer: -layer[1]):
+        del getattr(encoder, group)[idx]
+        if model_type == 'lxmert':
+            # comment early exit模型每个x_layer(最后一层除外)后有一个中间分类器，删最后一层时去掉新的最后一层的分类器
+            if group == 'x_layers' and getattr(model, 'exit_heads', None) is not None:
+                del model.exit_heads[min(idx, len(model.exit_heads) - 1)]
+            setattr(config, group, len(getattr(encoder, group)))
+            setattr(encoder, 'num_' + group, len(getattr(encoder, group)))
+            continue
+        # comment vilbert: v/t_biattention_id 是每个co-attention层前面的单流层数，fixed_*_layer是冻结的层数
+        if group == 'c_layer':
+            v_ids , t_ids = list(encoder.v_biattention_id) , list(encoder.t_biattention_id)
+            del v_ids[idx] , t_ids[idx]
+            encoder.v_biattention_id , encoder.t_biattention_id = v_ids , t_ids
+        else:
+            prefix = 't' if group == 'l_layer' else 'v'
+            ids = [layer_id - 1 if idx < layer_id else layer_id for layer_id in getattr(encoder, '%s_biattention_id' % (prefix))]
+            setattr(encoder, '%s_biattention_id' % (prefix), ids)
+            fixed = getattr(encoder, 'fixed_%s_layer' % (prefix))
+            setattr(encoder, 'fixed_%s_layer' % (prefix), fixed - 1 if idx < fixed else fixed)
+            setattr(config, LAYER_GROUPS[model_type][1][group], len(getattr(encoder, group)))
+        for attr in ('v_biattention_id', 't_biattention_id', 'fixed_v_layer', 'fixed_t_layer'):
+            setattr(config, attr, getattr(encoder, attr))
+    return model
+
+def compute_loss(output, labels):
+    return F.binary_cross_entropy(output[:,0], labels[:,0]) + F.binary_cross_entropy(output[:,1:], labels[:,1:])
+
+def evaluate(model, model_type, tokenizer, frozen, device, batch_size):
+    predictor = Predictor(model, model_type, tokenizer, device=device, batch_size=batch_size)
+    probs = predictor.predict_batches(frozen)
+    return score_outputs(probs, frozen['labels'], frozen['label_masks'])[0] , time_forward(predictor, frozen, batch_size)
+
+def head_importance(model, model_type, frozen, device, batch_size):
+    # comment 每个头乘一个值为1的门，importance = 验证集上 |dLoss/d门| 的累加(Michel et al. 2019)，每个单元内做L2归一化
+    units = find_attention_units(model)
+    gates , hooks = {} , []
+    for name , (attention, _, _, _) in units.items():
+        gate = torch.ones(attention.num_attention_heads, device=device, requires_grad=True)
+        gates[name] = gate
+        num_context = 2 if hasattr(attention, 'query1') else 1
+        def hook(module, inputs, outputs, gate=gate, num_context=num_context):
+            outputs = list(outputs)
+            for i in range(num_context):
+                context = outputs[i]
+                shape = context.shape
+                outputs[i] = (context.view(*shape[:-1], gate.numel(), -1) * gate.view(-1, 1)).view(shape)
+            return tuple(outputs)
+        hooks.append(attention.register_forward_hook(hook))
+    requires_grad = [param.requires_grad for param in model.parameters()]
+    for param in model.parameters():
+        param.requires_grad_(False)
+    model.to(device).eval()
+    importance = {name: torch.zeros_like(gate) for name, gate in gates.items()}
+    try:
+        for start in range(0, frozen['input_ids'].shape[0], batch_size):
+            batch = {key: frozen[key][start:start + batch_size].to(device) for key in MODEL_INPUT_NAMES}
+            loss = compute_loss(model_forward(model, model_type, batch), frozen['labels'][start:start + batch_size].to(device))
+            # comment 输出不影响loss的单元(比如最后一层只给视觉侧用的注意力)不在计算图里，grad为None，importance按0算
+            grads = torch.autograd.grad(loss, list(gates.values()), allow_unused=True)
+            for name , grad in zip(gates, grads):
+                if grad is not None:
+                    importance[name] += grad.abs().detach()
+    finally:
+        for hook in hooks:
+            hook.remove()
+        for param , flag in zip(model.parameters(), requires_grad):
+            param.requires_grad_(flag)
+    return {name: (score / score.norm().clamp(min=1e-12)).cpu() for name, score in importance.items()}
+
+def select_heads(importance, ratio):
+    # comment 全局按importance从小到大剪掉ratio比例的头，每个单元至少保留一个
+    total = sum(score.numel() for score in importance.values())
+    candidates = sorted((score[head].item(), name, head) for name, score in importance.items() for head in range(score.numel()))
+    remaining = {name: score.numel() for name, score in importance.items()}
+    heads_to_prune = {}
+    for _ , name , head in candidates:
+        if sum(len(heads) for heads in heads_to_prune.values()) >= int(total * ratio):
+            break
+        if remaining[name] > 1:
+            heads_to_prune.setdefault(name, []).append(head)
+            remaining[name] -= 1
+    return heads_to_prune
+
+def layer_importance(model, model_type, tokenizer, frozen, device, batch_size, base_score):
+    # comment 逐层删掉后在验证集上的掉分，每组至少保留一层
+    encoder = get_encoder(model, model_type)
+    drops = []
+    for group in LAYER_GROUPS[model_type][1]:
+        if len(getattr(encoder, group)) <= 1:
+            continue
+        for idx in range(len(getattr(encoder, group))):
+            pruned = remove_layers(copy.deepcopy(model), model_type, [(group, idx)])
+            score , _ = evaluate(pruned, model_type, tokenizer, frozen, device, batch_size)
+            drops.append((base_score - score, group, idx))
+            print('去掉 %s[%d] : score %.4f (drop %.4f)' % (group, idx, score, base_score - score))
+            del pruned
+    return sorted(drops)
+
+def select_layers(drops, num_layers, group_sizes):
+    selected = []
+    for _ , group , idx in drops:
+        if len(selected) >= num_layers:
+            break
+        if group_sizes[group] > 1:
+            selected.append((group, idx))
+            group_sizes[group] -= 1
+    return selected
+
+def record_pruned_heads(model, full_heads):
+    # comment 每个单元剩余的头数写进config，MyLxmertFinetune/MyVilBertFinetune初始化时据此调整形状
+    model.config.pruned_attention_heads = {
+        name: attention.num_attention_heads for name, (attention, _, _, _) in find_attention_units(model).items()
+        if attention.num_attention_heads < full_heads[name]
+    }
+    return model
+
+def recover_finetune(model, model_type, tokenizer, frozen, device, opt):
+    # comment 剪枝后短暂finetune恢复分数，增强参数和finetune一致，保留验证集上最好的一版
+    train_dataset = load_match_dataset(opt.train_path, tokenizer)
+    train_dataloader = DataLoader(train_dataset, shuffle=True, batch_size=opt.batch_size, num_workers=opt.num_workers)
+    optim = torch.optim.AdamW(model.parameters(), lr=opt.recover_lr, weight_decay=opt.weight_decay)
+    total_steps = opt.recover_epochs * len(train_dataloader)
+    scheduler = MyWarmupCosineSchedule(optim, warmup_steps=total_steps * opt.warmup_ratio, t_total=total_steps)
+    best_score , _ = evaluate(model, model_type, tokenizer, frozen, device, opt.batch_size)
+    best_state = copy.deepcopy(model.state_dict())
+    for epoch in range(opt.recover_epochs):
+        since = time.time()
+        model.train()
+        for batch in train_dataloader:
+            output = model_forward(model, model_type, {key: batch[key].to(device) for key in MODEL_INPUT_NAMES})
+            loss = compute_loss(output, batch['labels'].to(device))
+            loss.backward()
+            optim.step()
+            scheduler.step()
+            optim.zero_grad()
+        model.eval()
+        score , _ = evaluate(model, model_type, tokenizer, frozen, device, opt.batch_size)
+        if score > best_score:
+            best_score , best_state = score , copy.deepcopy(model.state_dict())
+        print('recover E%d(t %.2f min) score %.4f best %.4f' % (epoch, (time.time() - since) / 60, score, best_score))
+    model.load_state_dict(best_state)
+    return model
+
+def save_pruned(model, model_dir, output_root):
+    os.makedirs(output_root, exist_ok=True)
+    for file_name in os.listdir(model_dir):
+        src = os.path.join(model_dir, file_name)
+        if file_name not in (WEIGHTS_NAME, SAFE_WEIGHTS_NAME, 'config.json') and os.path.isfile(src):
+            shutil.copy(src, os.path.join(output_root, file_name))
+    torch.save(model.state_dict(), os.path.join(output_root, WEIGHTS_NAME))
+    with open(os.path.join(output_root, 'config.json'), 'w', encoding='utf-8') as f:
+        f.write(model.config.to_json_string())
+
+def main(opt):
+    from transformers import BertTokenizer
+    device = 'cuda:%d' % (opt.gpu) if opt.gpu >= 0 and torch.cuda.is_available() else 'cpu'
+    model_dir , _ = split_model_path(opt.model_path)
+    tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path= opt.tokenizer_path or model_dir)
+    model , model_type = load_finetune_model(opt.model_path, model_type=opt.model_type)
+    assert model_type in LAYER_GROUPS, 'prune.py 只支持 %s' % (','.join(LAYER_GROUPS))
+    model.to(device)
+    frozen = load_frozen_val_set(opt.val_path, tokenizer, cache_path=opt.frozen_val_path, seed=opt.seed)
+    full_heads = {name: attention.num_attention_heads for name, (attention, _, _, _) in find_attention_units(model).items()}
+    base_score , base_ms = evaluate(model, model_type, tokenizer, frozen, device, opt.batch_size)
+    print('原始模型 score %.4f , %.3f ms/batch' % (base_score, base_ms))
+    report = {'model_path': opt.model_path, 'model_type': model_type, 'base_score': base_score, 'base_ms_per_batch': base_ms}
+
+    # comment 先删层，再在删过层的模型上算头的重要性
+    if opt.num_prune_layers > 0:
+        drops = layer_importance(model, model_type, tokenizer, frozen, device, opt.batch_size, base_score)
+        encoder = get_encoder(model, model_type)
+        group_sizes = {group: len(getattr(encoder, group)) for group in LAYER_GROUPS[model_type][1]}
+        layers = select_layers(drops, opt.num_prune_layers, group_sizes)
+        model = remove_layers(model, model_type, layers)
+        report['layer_drops'] = [[group, idx, round(drop, 6)] for drop, group, idx in drops]
+        report['removed_layers'] = layers
+        print('删除的层 : ', layers)
+
+    importance = head_importance(model, model_type, frozen, device, opt.batch_size)
+    curve = []
+    for ratio in sorted(set(opt.curve_ratios + [opt.head_prune_ratio])):
+        pruned = prune_attention_heads(copy.deepcopy(model), select_heads(importance, ratio))
+        score , ms = evaluate(pruned, model_type, tokenizer, frozen, device, opt.batch_size)
+        params = sum(param.numel() for param in pruned.parameters())
+        curve.append({'head_ratio': ratio, 'score': round(score, 6), 'ms_per_batch': round(ms, 3), 'params': params})
+        print('剪掉 %.2f 的头 : score %.4f , %.3f ms/batch , 参数 %d' % (ratio, score, ms, params))
+        del pruned
+    report['curve'] = curve
+    report['head_importance'] = {name: [round(value, 4) for value in score.tolist()] for name, score in importance.items()}
+
+    heads_to_prune = select_heads(importance, opt.head_prune_ratio)
+    model = record_pruned_heads(prune_attention_heads(model, heads_to_prune), full_heads)
+    report['pruned_heads'] = heads_to_prune
+    if opt.recover_epochs > 0:
+        assert opt.train_path is not None, '恢复训练需要 --train_path'
+        model = recover_finetune(model, model_type, tokenizer, frozen, device, opt)
+    final_score , final_ms = evaluate(model, model_type, tokenizer, frozen, device, opt.batch_size)
+    report.update({'final_score': final_score, 'final_ms_per_batch': final_ms, 'speedup': round(base_ms / final_ms, 2)})
+    save_pruned(model, model_dir, opt.output_root)
+    # comment 从磁盘重新加载，确认剪枝后的config和权重能被finetune模型直接加载
+    reloaded , _ = load_finetune_model(opt.output_root, model_type=model_type)
+    reloaded_score , _ = evaluate(reloaded, model_type, tokenizer, frozen, device, opt.batch_size)
+    assert abs(reloaded_score - final_score) < 1e-6, '重新加载后分数不一致'
+    with open(os.path.join(opt.output_root, REPORT_NAME), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(report, indent=2, ensure_ascii=False))
+    print('剪枝后 score %.4f (原始 %.4f) , %.3f ms/batch (原始 %.3f) , 存储路径 %s' % (final_score, base_score, final_ms, base_ms, opt.output_root))
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path',type=str,required=True,help='finetune模型目录或权重文件(pytorch_model.bin/model.safetensors)路径, 支持lxmert和vilbert')
+    parser.add_argument('--model_type',type=str,default='auto',choices=('auto', 'lxmert', 'vilbert'),help='auto: 根据config.json判断')
+    parser.add_argument('--tokenizer_path',type=str,default=None,help='默认和model_path同目录')
+    parser.add_argument('--output_root',type=str,required=True,help='剪枝后模型的输出目录')
+    parser.add_argument('--val_path',type=str,required=True,help='验证集(训练数据格式的json), 用来算重要性和分数')
+    parser.add_argument('--frozen_val_path',type=str,default=None,help='冻结验证集的缓存(.pt), 不存在时生成')
+    parser.add_argument('--seed',type=int,default=42,help='冻结验证集的随机种子')
+    parser.add_argument('--num_prune_layers',type=int,default=0,help='整层删除的层数, 按删掉后掉分从小到大选')
+    parser.add_argument('--head_prune_ratio',type=float,default=0.3,help='全局剪掉的头的比例')
+    parser.add_argument('--curve_ratios',type=float,nargs='+',default=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5],help='报告 剪头比例-分数-延迟 曲线的采样点')
+    parser.add_argument('--recover_epochs',type=int,default=0,help='剪枝后恢复训练的epoch数, 0 表示不训练')
+    parser.add_argument('--train_path',type=str,default=None,help='恢复训练用的训练集(训练数据格式的json)')
+    parser.add_argument('--recover_lr',type=float,default=2e-5)
+    parser.add_argument('--weight_decay', type=float, default=1e-4, help='weight_decay')
+    parser.add_argument('--warmup_ratio', type=float, default=0.1, help='warmup_ratio')
+    parser.add_argument('--num_workers',type =int,default=4)
+    parser.add_argument('--batch_size',type=int,default=128)
+    parser.add_argument('--gpu',type = int, default=0,help='GPU, -1 表示使用cpu')
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    main(opt)
@@ -0,0 +1,100 @@
+
+import os
+import json
+import time
+import shutil
+import argparse
+
+import torch
+
+from predictor import (
+    Predictor,
+    load_finetune_model,
+    quantize_model,
+    split_model_path,
+    load_frozen_val_set,
+    score_outputs,
+    time_forward,
+    MODEL_TYPES,
+    QUANT_WEIGHTS_NAME,
+)
+from model_avg import WEIGHTS_NAME , SAFE_WEIGHTS_NAME
+
+REPORT_NAME = 'quant_report.json'
+
+
+def file_size_mb(path):
+    return os.path.getsize(path) / 1024 / 1024
+
+def save_quantized(model, model_dir, output_root):
+    os.makedirs(output_root, exist_ok=True)
+    torch.save(model.state_dict(), os.path.join(output_root, QUANT_WEIGHTS_NAME))
+    # comment config和词表一起拷过去, run_predict.py --backend int8 直接用这个目录
+    for file_name in os.listdir(model_dir):
+        src = os.path.join(model_dir, file_name)
+        if file_name not in (WEIGHTS_NAME, SAFE_WEIGHTS_NAME) and os.path.isfile(src):
+            shutil.copy(src, os.path.join(output_root, file_name))
+
+def main(opt):
+    from transformers import BertTokenizer
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+    model_dir , weights_path = split_model_path(opt.model_path)
+    model , model_type = load_finetune_model(opt.model_path, model_type=opt.model_type)
+    since = time.time()
+    qmodel = quantize_model(model)
+    save_quantized(qmodel, model_dir, opt.output_root)
+    # comment 重新从磁盘加载一遍，保证评估的就是线上会用到的int8 checkpoint
+    qmodel , _ = load_finetune_model(opt.output_root, model_type=model_type, quantized=True)
+    print('%s 模型量化完成, 用时 %.2f s, 存储路径 %s' % (model_type, time.time() - since, opt.output_root))
+
+    report = {
+        'model_type': model_type,
+        'model_path': opt.model_path,
+        'fp32_size_mb': round(file_size_mb(weights_path), 2),
+        'int8_size_mb': round(file_size_mb(os.path.join(opt.output_root, QUANT_WEIGHTS_NAME)), 2),
+    }
+    report['size_ratio'] = round(report['fp32_size_mb'] / report['int8_size_mb'], 2)
+    if opt.val_path is not None:
+        # comment 量化模型只能跑cpu，两边都在cpu上对比
+        model , _ = load_finetune_model(opt.model_path, model_type=model_type)
+        tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path= opt.tokenizer_path or model_dir)
+        frozen = load_frozen_val_set(opt.val_path, tokenizer, cache_path=opt.frozen_val_path, seed=opt.seed)
+        fp32_predictor = Predictor(model, model_type, tokenizer, device='cpu', batch_size=opt.batch_size)
+        int8_predictor = Predictor(qmodel, model_type, tokenizer, device='cpu', batch_size=opt.batch_size)
+        fp32_probs , int8_probs = fp32_predictor.predict_batches(frozen) , int8_predictor.predict_batches(frozen)
+        fp32_score , int8_score = score_outputs(fp32_probs, frozen['labels'], frozen['label_masks']) , score_outputs(int8_probs, frozen['labels'], frozen['label_masks'])
+        fp32_ms , int8_ms = time_forward(fp32_predictor, frozen, opt.batch_size) , time_forward(int8_predictor, frozen, opt.batch_size)
+        report.update({
+            'val_size': int(frozen['labels'].shape[0]),
+            'fp32_score': [round(score, 6) for score in fp32_score],
+            'int8_score': [round(score, 6) for score in int8_score],
+            'score_delta': round(int8_score[0] - fp32_score[0], 6),
+            'max_prob_diff': round((fp32_probs - int8_probs).abs().max().item(), 6),
+            'batch_size': opt.batch_size,
+            'fp32_ms_per_batch': round(fp32_ms, 3),
+            'int8_ms_per_batch': round(int8_ms, 3),
+            'speedup': round(fp32_ms / int8_ms, 2),
+        })
+    with open(os.path.join(opt.output_root, REPORT_NAME), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(report, indent=2, ensure_ascii=False))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path',type=str,required=True,help='finetune模型目录或权重文件(pytorch_model.bin/model.safetensors)路径')
+    parser.add_argument('--model_type',type=str,default='auto',choices=('auto',) + MODEL_TYPES,help='auto: 根据config.json判断')
+    parser.add_argument('--tokenizer_path',type=str,default=None,help='默认和model_path同目录')
+    parser.add_argument('--output_root',type=str,required=True,help='int8模型的输出目录')
+    parser.add_argument('--val_path',type=str,default=None,help='验证集(训练数据格式的json), 设置后报告量化前后的分数和速度')
+    parser.add_argument('--frozen_val_path',type=str,default=None,help='冻结验证集的缓存(.pt), 不存在时生成')
+    parser.add_argument('--seed',type=int,default=42,help='冻结验证集的随机种子')
+    parser.add_argument('--batch_size',type=int,default=64)
+    parser.add_argument('--num_threads',type=int,default=0,help='cpu线程数, 0 表示默认')
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    main(opt)
@@ -0,0 +1,126 @@
+
+import os
+import json
+import time
+import argparse
+
+import torch
+
+from predictor import (
+    Predictor,
+    OnnxPredictor,
+    FastPredictor,
+    EarlyExitPredictor,
+    EnsemblePredictor,
+    detect_model_type,
+    split_model_path,
+    build_ensemble_weights,
+    load_attr_weights,
+    load_finetune_model,
+    load_label_list,
+    iter_samples,
+    iter_chunks,
+    format_result,
+    MODEL_TYPES,
+    ONNX_NAME,
+)
+from cascade import AttrRuleCascade , CascadePredictor
+
+
+def build_predictor(opt, model_path, model_type, device, tokenizer):
+    if opt.backend == 'onnx':
+        model_dir , onnx_path = split_model_path(model_path, weights_name=ONNX_NAME)
+        if model_type == 'auto':
+            model_type = detect_model_type(model_dir)
+        return OnnxPredictor(onnx_path, model_type, tokenizer, batch_size=opt.batch_size, max_len=opt.max_len, num_threads=opt.num_threads)
+    model , model_type = load_finetune_model(model_path, model_type=model_type, quantized=opt.backend == 'int8')
+    if opt.backend == 'int8':
+        device = 'cpu'
+    if opt.backend == 'early_exit':
+        return EarlyExitPredictor(model, model_type, tokenizer, device=device, batch_size=opt.batch_size, max_len=opt.max_len, exit_margin=opt.exit_margin)
+    if opt.backend in ('compile', 'script'):
+        return FastPredictor(model, model_type, tokenizer, device=device, batch_size=opt.batch_size, max_len=opt.max_len, backend=opt.backend)
+    return Predictor(model, model_type, tokenizer, device=device, batch_size=opt.batch_size, max_len=opt.max_len)
+
+def predict(opt):
+    from transformers import BertTokenizer
+    devices = ['cuda:%d' % (gpu) if gpu >= 0 and torch.cuda.is_available() else 'cpu' for gpu in opt.gpu]
+    concurrency = opt.concurrency if opt.concurrency > 0 else len(opt.model_path)
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+    elif concurrency > 1 and 'cpu' in devices:
+        # comment 多个模型并行跑cpu时平分核数，避免线程过度抢占
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // concurrency))
+    since = time.time()
+    tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path= opt.tokenizer_path)
+    model_types = opt.model_type if len(opt.model_type) == len(opt.model_path) else opt.model_type[:1] * len(opt.model_path)
+    predictors = [
+        build_predictor(opt, model_path, model_type, devices[i % len(devices)], tokenizer)
+        for i, (model_path, model_type) in enumerate(zip(opt.model_path, model_types))
+    ]
+    label_list = load_label_list()
+    label2id = {label: i for i, label in enumerate(label_list)}
+    if len(predictors) == 1:
+        predictor = predictors[0]
+    else:
+        model_weights = opt.model_weights if opt.model_weights is not None else [1.0] * len(predictors)
+        weights = build_ensemble_weights(label_list, model_weights, load_attr_weights(opt.attr_weights))
+        predictor = EnsemblePredictor(predictors, tokenizer, weights, batch_size=opt.batch_size, max_len=opt.max_len, num_workers=concurrency)
+    if opt.cascade_path is not None:
+        # comment 规则能判定的属性不再交给模型
+        predictor = CascadePredictor(predictor, AttrRuleCascade.from_file(opt.cascade_path, label_list=label_list))
+    for model_path , model_predictor in zip(opt.model_path, predictors):
+        print('加载 %s 模型 %s (%s)'%(model_predictor.model_type, model_path, opt.backend))
+    print('加载 %d 个模型用时 %.2f s , device %s'%(len(predictors), time.time() - since, ','.join(devices)))
+
+    save_dir = os.path.dirname(opt.save_path)
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+    since , total = time.time() , 0
+    # comment 分块读取、预测、写出，内存只和chunk_size有关
+    with open(opt.save_path, 'w', encoding='utf-8') as f:
+        for chunk in iter_chunks(iter_samples(opt.test_path), opt.chunk_size):
+            probs = predictor.predict(chunk).numpy()
+            for sample , prob in zip(chunk, probs):
+                result = format_result(sample, prob, label2id, threshold=opt.threshold, save_prob=opt.save_prob)
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+            f.flush()
+            total += len(chunk)
+            print('已预测 %d 条, %.1f 条/分钟'%(total, total / max(time.time() - since, 1e-6) * 60))
+    if isinstance(predictor, CascadePredictor):
+        print('规则判定 : ', json.dumps(predictor.summary(), ensure_ascii=False))
+        predictor.close()
+    elif isinstance(predictor, EnsemblePredictor):
+        predictor.close()
+    for model_path , model_predictor in zip(opt.model_path, predictors):
+        if isinstance(model_predictor, EarlyExitPredictor):
+            print('%s early exit 平均执行 x_layers %.2f / %d 层'%(model_path, model_predictor.average_layers(), len(model_predictor.model.mylxmert.encoder.x_layers)))
+    print('预测完毕，共 %d 条，用时 %.2f s，结果写入 %s'%(total, time.time() - since, opt.save_path))
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu',type = int, nargs='+', default=[-1],help='GPU, -1 表示使用cpu; 多个模型时可以给多个, 按顺序循环分配')
+    parser.add_argument('--tokenizer_path',type=str,required=True,help='tokenizer path')
+    parser.add_argument('--model_path',type=str,nargs='+',required=True,help='模型目录或权重文件(pytorch_model.bin/model.safetensors)路径，目录下需要有config.json; 多个时做融合预测')
+    parser.add_argument('--model_type',type=str,nargs='+',default=['auto'],choices=('auto',) + MODEL_TYPES,help='auto: 根据config.json判断; 给一个时所有模型共用')
+    parser.add_argument('--backend',type=str,default='torch',choices=['torch','compile','script','onnx','int8','early_exit'],help='compile: torch.compile(失败时退回TorchScript); script: TorchScript; onnx: 用onnxruntime跑export_onnx.py导出的model.onnx; int8: quantize.py导出的动态量化模型; onnx和int8只支持cpu; early_exit: finetune_lxmert.py --early_exit 训练的lxmert, 有把握的样本提前退出')
+    parser.add_argument('--exit_margin',type=float,default=0.45,help='early_exit: 13个输出都满足 |p-0.5| >= exit_margin 时提前退出')
+    parser.add_argument('--model_weights',type=float,nargs='+',default=None,help='融合时各模型的权重, 默认等权')
+    parser.add_argument('--attr_weights',type=str,default=None,help='融合时各模型每个属性的权重, json列表, 和model_path一一对应, 例如 [{"图文": 2.0}, {}, {"领型": 0.5}], 没写的属性为1')
+    parser.add_argument('--concurrency',type=int,default=0,help='同时跑几个模型, 0 表示模型个数')
+    parser.add_argument('--test_path',type=str,required=True,help='测试集, jsonl 或训练数据格式的 json')
+    parser.add_argument('--save_path',type=str,required=True,help='预测结果, jsonl')
+    parser.add_argument('--batch_size',type=int,default=256)
+    parser.add_argument('--chunk_size',type=int,default=8192,help='每次从文件读取多少条')
+    parser.add_argument('--max_len',type=int,default=35)
+    parser.add_argument('--num_threads',type=int,default=0,help='cpu推理线程数, 0 表示torch默认')
+    parser.add_argument('--threshold',type=float,default=0.5)
+    parser.add_argument('--cascade_path',type=str,default=None,help='cascade.py校准的规则, 设置后规则能判定的属性不走模型, query全部被判定的样本直接跳过模型')
+    parser.add_argument('--save_prob',action='store_true',help='同时写出概率')
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    predict(opt)
@@ -0,0 +1,290 @@
+
+import os
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from predictor import (
+    Predictor,
+    FastPredictor,
+    load_finetune_model,
+    load_label_list,
+    format_result,
+    MODEL_TYPES,
+)
+
+
+class LatencyStats(object):
+    # comment 记录每个请求的延迟和每个batch的大小，只保留最近window个
+    def __init__(self, window=100000):
+        self.window = window
+        self.latencies = []
+        self.batch_sizes = []
+        self.num_requests = 0
+        self.num_rejected = 0
+        self.since = time.time()
+
+    def add_batch(self, batch_size, latencies):
+        self.batch_sizes.append(batch_size)
+        self.latencies.extend(latencies)
+        self.num_requests += batch_size
+        if len(self.latencies) > self.window:
+            self.latencies = self.latencies[-self.window:]
+        if len(self.batch_sizes) > self.window:
+            self.batch_sizes = self.batch_sizes[-self.window:]
+
+    def summary(self):
+        latencies = np.asarray(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        # comment batch大小按2的幂分桶: 1, 2, 3-4, 5-8, ...
+        histogram = {}
+        for batch_size in self.batch_sizes:
+            bucket = 1 << (batch_size - 1).bit_length()
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+        return {
+            'requests': self.num_requests,
+            'rejected': self.num_rejected,
+            'batches': len(self.batch_sizes),
+            'qps': round(self.num_requests / max(time.time() - self.since, 1e-6), 2),
+            'latency_ms': {
+                'p50': round(float(np.percentile(latencies, 50)), 3),
+                'p90': round(float(np.percentile(latencies, 90)), 3),
+                'p99': round(float(np.percentile(latencies, 99)), 3),
+                'max': round(float(latencies.max()), 3),
+            },
+            'mean_batch_size': round(float(np.mean(self.batch_sizes)), 2) if self.batch_sizes else 0,
+            'batch_size_hist': {'<=%d' % (bucket): histogram[bucket] for bucket in sorted(histogram)},
+        }
+
+
+class MicroBatcher(object):
+    # comment 请求先进有界队列，攒够max_batch_size或者等满max_latency_ms就凑成一个batch，交给线程池做forward
+    def __init__(self, predictor, label2id, max_batch_size=64, max_latency_ms=5.0, queue_size=4096, num_workers=1, threshold=0.5):
+        self.predictor = predictor
+        self.label2id = label2id
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.executor = ThreadPoolExecutor(num_workers)
+        # comment 同时在跑的batch不超过线程数，多余的请求留在队列里继续攒batch
+        self.slots = asyncio.Semaphore(num_workers)
+        self.threshold = threshold
+        self.stats = LatencyStats()
+
+    async def submit(self, sample, save_prob=False):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((sample, save_prob, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.stats.num_rejected += 1
+            raise
+        return await future
+
+    async def collect(self):
+        items = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while len(items) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            items = await self.collect()
+            loop.create_task(self.process(loop, items))
+
+    async def process(self, loop, items):
+        try:
+            samples = [sample for sample, _, _, _ in items]
+            probs = await loop.run_in_executor(self.executor, self.predictor.predict, samples)
+            probs = probs.numpy()
+        except Exception as e:
+            for _, _, future, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.slots.release()
+        now = time.perf_counter()
+        for (sample, save_prob, future, start), prob in zip(items, probs):
+            if not future.done():
+                future.set_result(format_result(sample, prob, self.label2id, threshold=self.threshold, save_prob=save_prob))
+        self.stats.add_batch(len(items), [now - start for _, _, _, start in items])
+
+    def close(self):
+        self.executor.shutdown()
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method , path , _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key , value = line.decode('latin-1').split(':', 1)
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method , path , headers , body
+
+def write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    head = 'HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n' % (
+        status, len(body), 'keep-alive' if keep_alive else 'close')
+    writer.write(head.encode('latin-1') + body)
+
+
+def validate_sample(sample, label2id, feature_dim=2048):
+    # comment 返回错误信息，合法时返回None; 不用assert(python -O会去掉)，
+    #   坏样本要在进队列之前拦下来，不然会让同一个batch里的其他请求一起500
+    if not isinstance(sample, dict):
+        return 'body 必须是json object'
+    if not isinstance(sample.get('title'), str):
+        return 'title 必填且必须是字符串'
+    feature = sample.get('feature')
+    if not isinstance(feature, list) or len(feature) != feature_dim:
+        return 'feature 必填且必须是长度为%d的数组' % (feature_dim)
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in feature):
+        return 'feature 的元素必须都是数字'
+    if 'query' in sample:
+        query = sample['query']
+        if not isinstance(query, list) or not all(isinstance(attr, str) and attr in label2id for attr in query):
+            return 'query 必须是已知标签的数组'
+    return None
+
+
+class ScoringServer(object):
+    # comment 极简HTTP/1.1(支持keep-alive)，tcp和unix socket都可以
+    #   POST /predict  {"title": ..., "feature": [...2048], "query": [...]} -> {"img_name": ..., "match": {...}}
+    #   GET  /stats    延迟分位数和batch大小直方图
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except ValueError as e:
+                    # comment 请求行/header格式不对、Content-Length不是整数，或者一行超过StreamReader的limit(readline抛ValueError)
+                    write_response(writer, '400 Bad Request', {'error': str(e)}, keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method , path , headers , body = request
+                keep_alive = headers.get('connection', 'keep-alive').lower() != 'close'
+                status , payload = await self.dispatch(method, path.split('?')[0], body)
+                write_response(writer, status, payload, keep_alive=keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return '200 OK' , self.batcher.stats.summary()
+        if method == 'GET' and path == '/health':
+            return '200 OK' , {'status': 'ok'}
+        if method != 'POST' or path != '/predict':
+            return '404 Not Found' , {'error': 'unknown route %s %s' % (method, path)}
+        try:
+            sample = json.loads(body.decode('utf-8'))
+        except ValueError as e:
+            return '400 Bad Request' , {'error': str(e)}
+        error = validate_sample(sample, self.batcher.label2id)
+        if error is not None:
+            return '400 Bad Request' , {'error': error}
+        try:
+            return '200 OK' , await self.batcher.submit(sample, save_prob=sample.pop('save_prob', False))
+        except asyncio.QueueFull:
+            return '503 Service Unavailable' , {'error': 'queue full'}
+        except Exception as e:
+            return '500 Internal Server Error' , {'error': repr(e)}
+
+
+async def serve(opt):
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+    device = 'cuda:%d' % (opt.gpu) if opt.gpu >= 0 and torch.cuda.is_available() else 'cpu'
+    from transformers import BertTokenizer
+    tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path= opt.tokenizer_path)
+    model , model_type = load_finetune_model(opt.model_path, model_type=opt.model_type)
+    if opt.backend == 'torch':
+        predictor = Predictor(model, model_type, tokenizer, device=device, batch_size=opt.max_batch_size, max_len=opt.max_len)
+    else:
+        # comment 启动时就把常见形状编译/预热好，第一批请求不用等
+        predictor = FastPredictor(model, model_type, tokenizer, device=device, batch_size=opt.max_batch_size, max_len=opt.max_len, backend=opt.backend)
+    label2id = {label: i for i, label in enumerate(load_label_list())}
+    batcher = MicroBatcher(
+        predictor, label2id,
+        max_batch_size=opt.max_batch_size,
+        max_latency_ms=opt.max_latency_ms,
+        queue_size=opt.queue_size,
+        num_workers=opt.num_workers,
+        threshold=opt.threshold,
+    )
+    server = ScoringServer(batcher)
+    if opt.unix_socket:
+        if os.path.exists(opt.unix_socket):
+            os.remove(opt.unix_socket)
+        listener = await asyncio.start_unix_server(server.handle, path=opt.unix_socket)
+        address = 'unix:' + opt.unix_socket
+    else:
+        listener = await asyncio.start_server(server.handle, host=opt.host, port=opt.port)
+        address = 'http://%s:%d' % (opt.host, opt.port)
+    print('%s 模型 %s 已加载, device %s, 监听 %s' % (model_type, opt.model_path, device, address))
+    batch_task = asyncio.get_running_loop().create_task(batcher.run())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        batch_task.cancel()
+        batcher.close()
+        print(json.dumps(batcher.stats.summary(), ensure_ascii=False, indent=2))
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu',type = int, default=-1,help='GPU, -1 表示使用cpu')
+    parser.add_argument('--tokenizer_path',type=str,required=True,help='tokenizer path')
+    parser.add_argument('--model_path',type=str,required=True,help='模型目录或权重文件(pytorch_model.bin/model.safetensors)路径，目录下需要有config.json')
+    parser.add_argument('--model_type',type=str,default='auto',choices=('auto',) + MODEL_TYPES,help='auto: 根据config.json判断')
+    parser.add_argument('--backend',type=str,default='torch',choices=['torch','compile','script'],help='compile: torch.compile(失败时退回TorchScript); script: TorchScript')
+    parser.add_argument('--host',type=str,default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8080)
+    parser.add_argument('--unix_socket',type=str,default=None,help='设置后监听unix socket, 不再监听tcp')
+    parser.add_argument('--max_batch_size',type=int,default=64,help='一个micro-batch最多多少条')
+    parser.add_argument('--max_latency_ms',type=float,default=5.0,help='第一条请求进队列后最多等多久凑batch')
+    parser.add_argument('--queue_size',type=int,default=4096,help='请求队列上限, 满了直接返回503')
+    parser.add_argument('--num_workers',type=int,default=1,help='做forward的线程数')
+    parser.add_argument('--num_threads',type=int,default=0,help='cpu推理线程数, 0 表示torch默认')
+    parser.add_argument('--max_len',type=int,default=35)
+    parser.add_argument('--threshold',type=float,default=0.5)
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    try:
+        asyncio.run(serve(opt))
+    except KeyboardInterrupt:
+        pass
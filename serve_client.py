@@ -0,0 +1,102 @@
+
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+
+from predictor import iter_samples, iter_chunks
+
+
+def build_fake_samples(num, feature_dim=2048, attr_path='./data/attr_to_attrvals.json'):
+    # comment 没有测试集时用属性值随机拼title，feature用高斯噪声代替
+    with open(attr_path, 'r', encoding='utf-8') as f:
+        key_attr_values = json.loads(f.read())
+    keys = list(key_attr_values)
+    samples = []
+    for i in range(num):
+        query = random.sample(keys, k=random.randint(1, 3))
+        words = [random.choice(key_attr_values[key]).split('=')[0] for key in query]
+        samples.append({
+            'img_name': 'fake%06d' % (i),
+            'title': ''.join(words) + '女装',
+            'feature': np.random.randn(feature_dim).astype(np.float32).round(5).tolist(),
+            'query': ['图文'] + query,
+        })
+    return samples
+
+async def open_connection(opt):
+    if opt.unix_socket:
+        return await asyncio.open_unix_connection(path=opt.unix_socket)
+    return await asyncio.open_connection(host=opt.host, port=opt.port)
+
+async def request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8') if payload is not None else b''
+    head = '%s %s HTTP/1.1\r\nHost: local\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' % (method, path, len(body))
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key , value = line.decode('latin-1').split(':', 1)
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    return status , json.loads(await reader.readexactly(length))
+
+async def client_worker(opt, samples, latencies, statuses):
+    # comment 每个worker一条keep-alive连接，串行发请求
+    reader , writer = await open_connection(opt)
+    try:
+        for sample in samples:
+            start = time.perf_counter()
+            status , _ = await request(reader, writer, 'POST', '/predict', sample)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+async def load_test(opt):
+    if opt.test_path is not None:
+        samples = next(iter_chunks(iter_samples(opt.test_path), opt.num_requests))
+    else:
+        samples = build_fake_samples(min(opt.num_requests, 1024))
+    samples = [samples[i % len(samples)] for i in range(opt.num_requests)]
+    latencies , statuses = [] , {}
+    since = time.time()
+    await asyncio.gather(*[
+        client_worker(opt, samples[i::opt.concurrency], latencies, statuses)
+        for i in range(opt.concurrency)
+    ])
+    cost = time.time() - since
+    latencies = np.asarray(latencies) * 1000
+    print('请求 %d 条, 并发 %d, 用时 %.2f s, qps %.1f' % (len(latencies), opt.concurrency, cost, len(latencies) / cost))
+    print('状态码 : ', statuses)
+    print('客户端延迟(ms) p50 %.2f p90 %.2f p99 %.2f max %.2f' % (
+        np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99), latencies.max()))
+    reader , writer = await open_connection(opt)
+    _ , stats = await request(reader, writer, 'GET', '/stats')
+    writer.close()
+    print('服务端统计 : ')
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host',type=str,default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8080)
+    parser.add_argument('--unix_socket',type=str,default=None)
+    parser.add_argument('--test_path',type=str,default=None,help='用测试集里的样本发请求, 不设置则随机生成')
+    parser.add_argument('--num_requests',type=int,default=10000)
+    parser.add_argument('--concurrency',type=int,default=64,help='同时在发请求的连接数')
+    opt = parser.parse_args()
+    return opt
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    print(opt)
+    asyncio.run(load_test(opt))
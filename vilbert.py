@@ -11,6 +11,9 @@ from io import open
 import torch
 import torch.nn as nn
 import numpy as np
+from torch.utils.checkpoint import checkpoint
+from helper import resize_attention_heads
+from model_avg import find_weights , load_state_dict
 
 logger = logging.getLogger(__name__)
 PRETRAINED_MODEL_ARCHIVE_MAP = {
@@ -347,7 +350,7 @@ class BertPreTrainedModel(nn.Module):
         tempdir = None
         if os.path.isdir(resolved_archive_file) or from_tf:
             serialization_dir = resolved_archive_file
-        elif resolved_archive_file[-3:] == 'bin':
+        elif resolved_archive_file.endswith(('.bin', '.safetensors')):
             serialization_dir = '/'.join(resolved_archive_file.split('/')[:-1])
             WEIGHTS_NAME = resolved_archive_file.split('/')[-1]
         else:
@@ -389,10 +392,10 @@ class BertPreTrainedModel(nn.Module):
         model = cls(config, *inputs, **kwargs)
         if state_dict is None and not from_tf:
             weights_path = os.path.join(serialization_dir, WEIGHTS_NAME)
-            state_dict = torch.load(
-                weights_path,
-                map_location="cpu",
-            )
+            if os.path.isdir(resolved_archive_file) or tempdir:
+                # comment 目录里有model.safetensors时优先使用，mmap加载不需要unpickle
+                weights_path = find_weights(serialization_dir)
+            state_dict = load_state_dict(weights_path)
             if 'state_dict' in dir(state_dict):
                 state_dict = state_dict.state_dict()
 
@@ -961,6 +964,14 @@ class MyBertEncoder(nn.Module):
         self.l_layer = nn.ModuleList([BertLayer(config) for _ in range(config.num_hidden_layers)])
         self.v_layer = nn.ModuleList([BertImageLayer(config) for _ in range(config.v_num_hidden_layers)])
         self.c_layer = nn.ModuleList([BertConnectionLayer(config) for _ in range(len(config.v_biattention_id))])
+        # comment 打开后训练时每层只保留输入，反向传播时重算，用计算换显存
+        self.gradient_checkpointing = False
+
+    def run_layer(self, layer_module, *inputs):
+        # comment 输入不需要梯度时(例如fixed层之后)重算拿不到参数梯度，直接正常前向
+        if self.gradient_checkpointing and self.training and inputs[0].requires_grad:
+            return checkpoint(layer_module, *inputs)
+        return layer_module(*inputs)
 
     def forward(
         self,
@@ -984,16 +995,17 @@ class MyBertEncoder(nn.Module):
                     img_embedding, _ = self.v_layer[idx](img_embedding,img_attention_mask)
                     v_start = self.fixed_v_layer
             for idx in range(v_start,v_end):
-                img_embedding , _ = self.v_layer[idx](img_embedding,img_attention_mask)
+                img_embedding , _ = self.run_layer(self.v_layer[idx],img_embedding,img_attention_mask)
             # txt
             for idx in range(t_start , self.fixed_t_layer):
                 with torch.no_grad():
                     txt_embedding , _ = self.l_layer[idx](txt_embedding,txt_attention_mask)
                     t_start = self.fixed_t_layer
             for idx in range(t_start,t_end):
-                txt_embedding , _ = self.l_layer[idx](txt_embedding,txt_attention_mask)
+                txt_embedding , _ = self.run_layer(self.l_layer[idx],txt_embedding,txt_attention_mask)
             # bi attention
-            img_embedding, txt_embedding , _ = self.c_layer[count](
+            img_embedding, txt_embedding , _ = self.run_layer(
+                self.c_layer[count],
                 img_embedding,
                 img_attention_mask,
                 txt_embedding,txt_attention_mask,
@@ -1003,9 +1015,9 @@ class MyBertEncoder(nn.Module):
             v_start , t_start = v_end , t_end
             count += 1
         for idx in range(v_start , len(self.v_layer)):
-            img_embedding , _ = self.v_layer[idx](img_embedding,img_attention_mask)
+            img_embedding , _ = self.run_layer(self.v_layer[idx],img_embedding,img_attention_mask)
         for idx in range(t_start,len(self.l_layer)):
-            txt_embedding , _ =self.l_layer[idx](txt_embedding,txt_attention_mask)
+            txt_embedding , _ = self.run_layer(self.l_layer[idx],txt_embedding,txt_attention_mask)
         return txt_embedding , img_embedding 
 
 
@@ -1124,20 +1136,18 @@ class MyVilBert(BertPreTrainedModel):
         feats , 
         feats_attention_mask,
     ):
+        dtype = self.img_embedding.layerNorm.weight.dtype
         # lang attention mask
         extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
-        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype)
+        extended_attention_mask = extended_attention_mask.to(dtype=dtype)
         extended_attention_mask = (1.0- extended_attention_mask) * -10000.0
         # feats attention mask
         extended_feats_attention_mask = feats_attention_mask.unsqueeze(1).unsqueeze(2)
-        extended_feats_attention_mask = extended_feats_attention_mask.to(dtype = next(self.parameters()).dtype)
+        extended_feats_attention_mask = extended_feats_attention_mask.to(dtype = dtype)
         extended_feats_attention_mask = (1.0 - extended_feats_attention_mask) * -10000.0
-        # co attention mask
+        # co attention mask, 全0(乘5.0之后仍然是0), 直接在目标设备上按dtype创建
         batch_size , feats_num , seq_len = input_ids.size()[0], feats.size()[1], input_ids.size()[1]
-        co_attention_mask = torch.zeros(batch_size , feats_num , seq_len).type_as(extended_feats_attention_mask)
-        extended_co_attention_mask = co_attention_mask.unsqueeze(1)
-        extended_co_attention_mask = extended_co_attention_mask * 5.0
-        extended_co_attention_mask = extended_co_attention_mask.to(dtype=next(self.parameters()).dtype) 
+        extended_co_attention_mask = extended_feats_attention_mask.new_zeros(batch_size , 1 , feats_num , seq_len)
         # word embedding & img embedding
         embedding_output = self.word_embedding(input_ids,token_type_ids)    # shape[bs,seq_len,768]
         v_embedding_output = self.img_embedding(feats)                     # shape[bs,1,768]
@@ -1213,6 +1223,8 @@ class MyVilBertFinetune(BertPreTrainedModel):
         # downstream task
         self.cls = nn.Linear(config.hidden_size, output_dim)
         self.sigmoid = nn.Sigmoid()
+        # comment prune.py剪过头的模型，config里记录了每个attention单元剩余的头数
+        resize_attention_heads(self, getattr(config, 'pruned_attention_heads', None))
     def forward(
         self,
         input_ids , 